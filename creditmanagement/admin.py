@@ -1,7 +1,7 @@
 from django.contrib import admin
 
 from creditmanagement.models import FixedTransaction, PendingTransaction, PendingDiningTransaction, \
-    PendingDiningListTracker, UserCredit
+    PendingDiningListTracker, UserCredit, AssociationCredit
 from userdetails.models import Association, UserMembership
 
 
@@ -74,6 +74,12 @@ class UserCreditAdmin(admin.ModelAdmin):
     list_filter = [MemberOfFilter]
     readonly_fields = ('negative_since',)
 
+    def get_changelist_instance(self, request):
+        changelist = super().get_changelist_instance(request)
+        # Compute negative_since of the whole page at once instead of per row
+        UserCredit.prefetch_negative_since(changelist.result_list)
+        return changelist
+
     def is_verified(self, obj):
         return obj.user.is_verified()
 
@@ -89,8 +95,22 @@ class UserCreditAdmin(admin.ModelAdmin):
         return False
 
 
+class AssociationCreditAdmin(admin.ModelAdmin):
+    list_display = ('association', 'balance', 'balance_fixed')
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+
 admin.site.register(FixedTransaction, FixedTransactionAdmin)
 admin.site.register(PendingTransaction, PendingTransactionAdmin)
 admin.site.register(PendingDiningTransaction, PendingDiningTransactionAdmin)
 admin.site.register(PendingDiningListTracker, PendingDiningListTrackerAdmin)
 admin.site.register(UserCredit, UserCreditAdmin)
+admin.site.register(AssociationCredit, AssociationCreditAdmin)
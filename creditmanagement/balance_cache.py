@@ -0,0 +1,109 @@
+"""Caching of user and association balances on top of the Django cache framework.
+
+A single page can request the balance of the same user several times (navbar, account pages). The values are
+cached per user/association and are invalidated by the receivers in creditmanagement/receivers.py as soon as a
+transaction, dining entry or dining list changes.
+
+An invalidation replaces the generation of the party, which is part of the key of the cached balance. A request
+that read the balance before the change was committed caches it under the old generation, where it is never read.
+
+The cache backend is configured with DINING_CACHE_URL, e.g. locmem:// (default) or a local Redis instance. With
+locmem:// each worker process has its own cache and an invalidation only reaches the worker that handled the
+change, the other workers can show an old balance for up to BALANCE_CACHE_TIMEOUT seconds. The cached balances are
+therefore only meant for display, checks against a minimum balance read UserCredit.get_balance directly.
+"""
+from decimal import Decimal
+from uuid import uuid4
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+from creditmanagement.models import UserCredit, AssociationCredit
+
+KEY_PREFIX = 'balance'
+HITS_KEY = 'balance:stats:hits'
+MISSES_KEY = 'balance:stats:misses'
+
+
+def _generation_key(party_type, party_id):
+    return '{}:{}:{}:generation'.format(KEY_PREFIX, party_type, party_id)
+
+
+def _key(party_type, party_id):
+    """Returns the key of the balance for the current generation of the party."""
+    generation_key = _generation_key(party_type, party_id)
+    generation = cache.get(generation_key)
+    if generation is None:
+        # Random, so that an evicted generation can not make an old balance valid again
+        cache.add(generation_key, uuid4().hex, timeout=None)
+        generation = cache.get(generation_key)
+    return '{}:{}:{}:{}'.format(KEY_PREFIX, party_type, party_id, generation)
+
+
+def _new_generations(generation_keys):
+    cache.set_many({key: uuid4().hex for key in generation_keys}, timeout=None)
+
+
+def _count(key):
+    # add() is a no-op when the counter already exists, incr() fails when it does not
+    cache.add(key, 0, timeout=None)
+    try:
+        cache.incr(key)
+    except ValueError:
+        # The counter got evicted in between, losing a single count is fine
+        pass
+
+
+def _get_balance(credit_model, party_type, party) -> Decimal:
+    key = _key(party_type, party.pk)
+    balance = cache.get(key)
+    if balance is not None:
+        _count(HITS_KEY)
+        return balance
+
+    _count(MISSES_KEY)
+    balance = credit_model.get_balance(party)
+    # Only cache the balance once it is committed, a value read inside a transaction can still be rolled back.
+    # Outside a transaction on_commit() executes immediately.
+    transaction.on_commit(lambda: cache.add(key, balance, timeout=settings.BALANCE_CACHE_TIMEOUT))
+    return balance
+
+
+def get_user_balance(user) -> Decimal:
+    """Returns the (cached) balance of the user."""
+    return _get_balance(UserCredit, 'user', user)
+
+
+def get_association_balance(association) -> Decimal:
+    """Returns the (cached) balance of the association."""
+    return _get_balance(AssociationCredit, 'association', association)
+
+
+def invalidate(user_ids=(), association_ids=()):
+    """Invalidates the cached balances of the given users and associations by replacing their generations.
+
+    The generations are replaced again when the current database transaction commits, otherwise a concurrent
+    request could cache the old balance under the new generation before the new balance is visible.
+    """
+    keys = [_generation_key('user', pk) for pk in user_ids if pk is not None]
+    keys += [_generation_key('association', pk) for pk in association_ids if pk is not None]
+    if keys:
+        _new_generations(keys)
+        transaction.on_commit(lambda: _new_generations(keys))
+
+
+def get_statistics():
+    """Returns a dictionary with the number of cache hits and misses and the hit ratio."""
+    hits = cache.get(HITS_KEY) or 0
+    misses = cache.get(MISSES_KEY) or 0
+    total = hits + misses
+    return {
+        'hits': hits,
+        'misses': misses,
+        'hit_ratio': hits / total if total else None,
+    }
+
+
+def reset_statistics():
+    cache.delete_many([HITS_KEY, MISSES_KEY])
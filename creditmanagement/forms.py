@@ -1,9 +1,10 @@
 from dal_select2.widgets import ModelSelect2
 from django import forms
 from django.core.exceptions import ValidationError
-from django.db.models import Sum
 
+from creditmanagement import balance_cache
 from creditmanagement.models import PendingTransaction, UserCredit
+from userdetails.models import UserMembership
 
 
 class TransactionForm(forms.ModelForm):
@@ -22,6 +23,17 @@ class TransactionForm(forms.ModelForm):
         else:
             raise ValueError("source is neither user nor association")
 
+    def save(self, commit=True):
+        """Saves the transaction using PendingTransaction.transfer.
+
+        Raises:
+            ValidationError: When the balance of the source user becomes too low.
+        """
+        instance = super().save(commit=False)
+        if commit:
+            instance.transfer()
+        return instance
+
     class Meta:
         model = PendingTransaction
         fields = ['origin', 'amount', 'target_user', 'target_association']
@@ -65,30 +77,35 @@ class UserTransactionForm(TransactionForm):
 
 
 class ClearOpenExpensesForm(forms.Form):
-    """Creates pending transactions for all members of this associations who are negative."""
+    """Creates pending transactions for all members of this associations who are negative.
+
+    The form shows a preview of the number of members and the total amount, the transactions are only created when
+    these have not changed in the meantime.
+    """
+    expected_count = forms.IntegerField(widget=forms.HiddenInput)
+    expected_total = forms.DecimalField(widget=forms.HiddenInput, decimal_places=2)
 
     def __init__(self, *args, association=None, **kwargs):
         assert association is not None
         self.association = association
         super(ClearOpenExpensesForm, self).__init__(*args, **kwargs)
+        self.preview = PendingTransaction.get_negative_balances_preview(self.get_applicable_user_credits())
+        self.fields['expected_count'].initial, self.fields['expected_total'].initial = self.preview
 
     def get_applicable_user_credits(self):
+        # Use the balance to correct for any pending transactions
         return UserCredit.objects.filter(
-            user__usermembership__association=self.association,
-            balance__lt=0,  # Use this to correct for any pending transactions
+            user__in=UserMembership.objects.filter(association=self.association).values('related_user'),
+            balance__lt=0,
         )
 
     @property
     def negative_members_count(self):
-        return self.get_applicable_user_credits().count()
+        return self.preview[0]
 
     @property
     def negative_member_credit_total(self):
-        balance_sum = self.get_applicable_user_credits().aggregate(Sum('balance'))['balance__sum']
-        if balance_sum is None:
-            balance_sum = 0
-        # Remember the - value to correct for the negative outcomes
-        return "{:.2f}".format(-balance_sum)
+        return "{:.2f}".format(self.preview[1])
 
     def clean(self):
         if not self.association.has_min_exception:
@@ -100,13 +117,11 @@ class ClearOpenExpensesForm(forms.Form):
         return super(ClearOpenExpensesForm, self).clean()
 
     def save(self):
-        credits = self.get_applicable_user_credits()
-        description = f"Process open costs to {self.association}"
-
-        for credit in credits:
-            PendingTransaction.objects.create(
-                source_association=self.association,
-                amount=-credit.balance,
-                target_user=credit.user,
-                description=description
-            )
+        """Creates the transactions, raises ValidationError when the balances differ from the preview."""
+        expected = (self.cleaned_data['expected_count'], self.cleaned_data['expected_total'])
+        transactions = PendingTransaction.clear_negative_balances(
+            self.get_applicable_user_credits(), self.association,
+            description=f"Process open costs to {self.association}", expected=expected)
+        balance_cache.invalidate(user_ids=[t.target_user_id for t in transactions],
+                                 association_ids=[self.association.pk])
+        return transactions
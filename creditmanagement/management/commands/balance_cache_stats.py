@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from creditmanagement import balance_cache
+
+
+class Command(BaseCommand):
+    help = 'Shows the hit and miss counters of the balance cache'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true', help='Reset the counters after displaying them')
+
+    def handle(self, *args, **options):
+        stats = balance_cache.get_statistics()
+        ratio = 'n/a' if stats['hit_ratio'] is None else '{:.1%}'.format(stats['hit_ratio'])
+        self.stdout.write('Hits: {hits}\nMisses: {misses}\nHit ratio: {ratio}'.format(ratio=ratio, **stats))
+
+        if options['reset']:
+            balance_cache.reset_statistics()
+            self.stdout.write(self.style.SUCCESS('Counters have been reset'))
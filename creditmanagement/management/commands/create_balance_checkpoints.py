@@ -0,0 +1,27 @@
+from datetime import datetime, time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from creditmanagement.models import BalanceCheckpoint
+
+
+class Command(BaseCommand):
+    help = 'Stores the fixed balances of all users and associations with recent transactions as checkpoints'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--date', type=lambda value: datetime.strptime(value, '%Y-%m-%d').date(),
+                            help='Create the checkpoints at the start of this date (YYYY-MM-DD), defaults to today')
+
+    def handle(self, *args, **options):
+        as_of = timezone.make_aware(datetime.combine(options['date'] or timezone.localdate(), time()))
+        if as_of > timezone.now() - settings.BALANCE_CHECKPOINT_MARGIN:
+            raise CommandError('Checkpoints can only be created at least {} in the past'.format(
+                settings.BALANCE_CHECKPOINT_MARGIN))
+
+        try:
+            count = BalanceCheckpoint.create_checkpoints(as_of)
+        except ValueError as e:
+            raise CommandError(str(e))
+        self.stdout.write(self.style.SUCCESS('Created {} checkpoints at {}'.format(count, as_of)))
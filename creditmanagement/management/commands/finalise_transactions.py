@@ -1,12 +1,32 @@
+from time import perf_counter
+
 from django.core.management.base import BaseCommand
 
 from creditmanagement.models import AbstractPendingTransaction
+from general import metrics
 
 
 class Command(BaseCommand):
     help = 'Finalises all expired transactions'
 
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=None,
+                            help='The number of transactions finalised per database transaction, '
+                                 'defaults to the FINALISATION_BATCH_SIZE setting')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only report what would be finalised')
+
     def handle(self, *args, **options):
-        results = AbstractPendingTransaction.finalise_all_expired()
-        for transaction in results:
-            self.stdout.write(self.style.SUCCESS('Successfully finalised "%s"' % transaction))
+        verb = 'Would finalise' if options['dry_run'] else 'Finalised'
+        start = perf_counter()
+        for child in AbstractPendingTransaction.get_children():
+            child_start = perf_counter()
+            result = child.finalise_all_expired(batch_size=options['batch_size'], dry_run=options['dry_run'])
+            duration = perf_counter() - child_start
+            if not options['dry_run']:
+                metrics.FINALISATION_DURATION.observe(duration, model=child.__name__)
+                metrics.FINALISED_TRANSACTIONS.inc(result.count, model=child.__name__)
+            self.stdout.write(self.style.SUCCESS('{} {}: {} in {:.2f}s'.format(
+                verb, child.__name__, result, duration)))
+        self.stdout.write('Total duration: {:.2f}s'.format(perf_counter() - start))
+        metrics.flush()
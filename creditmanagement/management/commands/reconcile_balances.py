@@ -0,0 +1,90 @@
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from creditmanagement.models import AbstractTransaction, FixedTransaction, UserCredit, AssociationCredit, \
+    BalanceCheckpoint
+from userdetails.models import User, Association
+
+
+def _to_decimal(value):
+    # The balance annotation is cast to a float (or an integer), round it back to cents
+    return Decimal(value or 0).quantize(Decimal('.01'))
+
+
+class Command(BaseCommand):
+    help = 'Compares the materialised user and association balances and the balance checkpoints with the ' \
+           'complete transaction history'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rebuild', action='store_true',
+                            help='Overwrite the materialised balances with the recomputed values')
+
+    def reconcile(self, credit_model, expected, rebuild):
+        """Compares the stored balances of credit_model with expected and optionally rebuilds them.
+
+        Args:
+            credit_model: UserCredit or AssociationCredit.
+            expected: A dictionary from party id to a (balance, balance_fixed) tuple.
+            rebuild: Whether mismatching or missing rows need to be rewritten.
+
+        Returns:
+            The number of parties of which the balance did not match.
+        """
+        stored = {row[0]: (row[1], row[2]) for row in
+                  credit_model.objects.values_list(credit_model.party_field, 'balance', 'balance_fixed')}
+        mismatches = 0
+        for party_id, values in expected.items():
+            if stored.get(party_id) == values:
+                continue
+            mismatches += 1
+            self.stdout.write(self.style.WARNING('{} {}: stored {}, computed {}'.format(
+                credit_model.__name__, party_id, stored.get(party_id), values)))
+            if rebuild:
+                credit_model.objects.update_or_create(**{credit_model.party_field: party_id},
+                                                      defaults={'balance': values[0], 'balance_fixed': values[1]})
+        return mismatches
+
+    def verify_checkpoints(self, rebuild):
+        """Recomputes the balance checkpoints and deletes all of them when one is incorrect and rebuild is set.
+
+        The checkpoints build on each other, the create_balance_checkpoints command recreates them from scratch.
+
+        Returns:
+            The number of incorrect checkpoints.
+        """
+        mismatches = BalanceCheckpoint.get_mismatches()
+        for checkpoint, computed in mismatches:
+            self.stdout.write(self.style.WARNING('Checkpoint {}: computed {}'.format(checkpoint, computed)))
+        if mismatches and rebuild:
+            BalanceCheckpoint.objects.all().delete()
+        return len(mismatches)
+
+    def handle(self, *args, **options):
+        fixed_name = FixedTransaction.balance_annotation_name
+        balance_name = AbstractTransaction.balance_annotation_name
+
+        with transaction.atomic():
+            users = AbstractTransaction.annotate_balance(users=User.objects.all())
+            expected_users = {u.id: (_to_decimal(getattr(u, balance_name)), _to_decimal(getattr(u, fixed_name)))
+                              for u in users}
+            expected_associations = {}
+            # annotate_balance falls back to users when the association queryset is empty
+            if Association.objects.exists():
+                associations = AbstractTransaction.annotate_balance(associations=Association.objects.all())
+                expected_associations = {a.id: (_to_decimal(getattr(a, balance_name)),
+                                                _to_decimal(getattr(a, fixed_name)))
+                                         for a in associations}
+
+            mismatches = self.reconcile(UserCredit, expected_users, options['rebuild'])
+            mismatches += self.reconcile(AssociationCredit, expected_associations, options['rebuild'])
+            mismatches += self.verify_checkpoints(options['rebuild'])
+
+        if mismatches == 0:
+            self.stdout.write(self.style.SUCCESS('All balances are consistent'))
+        elif options['rebuild']:
+            self.stdout.write(self.style.SUCCESS('Rebuilt {} balances'.format(mismatches)))
+        else:
+            self.stdout.write(self.style.ERROR('{} balances are inconsistent, use --rebuild to repair'.format(
+                mismatches)))
@@ -0,0 +1,88 @@
+from collections import defaultdict
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Sum
+import django.db.models.deletion
+
+from general.db_view_migration import DeleteView
+
+
+def populate_credits(apps, schema_editor):
+    """Computes the initial materialised balances from the transaction history."""
+    User = apps.get_model('userdetails', 'User')
+    Association = apps.get_model('userdetails', 'Association')
+    DiningEntry = apps.get_model('dining', 'DiningEntry')
+    UserCredit = apps.get_model('creditmanagement', 'UserCredit')
+    AssociationCredit = apps.get_model('creditmanagement', 'AssociationCredit')
+
+    # Maps (party type, id) to [balance, balance_fixed]
+    balances = defaultdict(lambda: [Decimal('0.00'), Decimal('0.00')])
+
+    for model_name, is_fixed in (('FixedTransaction', True), ('PendingTransaction', False)):
+        model = apps.get_model('creditmanagement', model_name)
+        for party in ('user', 'association'):
+            for column, sign in (('source_' + party, -1), ('target_' + party, 1)):
+                rows = model.objects.filter(**{column + '__isnull': False}).values(column).annotate(total=Sum('amount'))
+                for row in rows:
+                    balance = balances[(party, row[column])]
+                    balance[0] += sign * row['total']
+                    if is_fixed:
+                        balance[1] += sign * row['total']
+
+    # Kitchen costs of dining lists that are not yet finalised
+    rows = DiningEntry.objects.filter(dining_list__pendingdininglisttracker__isnull=False).values('user').annotate(
+        total=Sum('dining_list__kitchen_cost'))
+    for row in rows:
+        balances[('user', row['user'])][0] -= row['total']
+
+    UserCredit.objects.bulk_create([
+        UserCredit(user_id=pk, balance=balances[('user', pk)][0], balance_fixed=balances[('user', pk)][1])
+        for pk in User.objects.values_list('pk', flat=True)
+    ])
+    AssociationCredit.objects.bulk_create([
+        AssociationCredit(association_id=pk, balance=balances[('association', pk)][0],
+                          balance_fixed=balances[('association', pk)][1])
+        for pk in Association.objects.values_list('pk', flat=True)
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('userdetails', '0018_association_has_site_stats_access'),
+        ('dining', '0016_auto_20190514_1317'),
+        ('creditmanagement', '0010_auto_20200817_1230'),
+    ]
+
+    operations = [
+        DeleteView(
+            name='UserCredit',
+        ),
+        migrations.CreateModel(
+            name='UserCredit',
+            fields=[
+                ('balance', models.DecimalField(decimal_places=2, default=Decimal('0.00'), max_digits=12)),
+                ('balance_fixed', models.DecimalField(decimal_places=2, default=Decimal('0.00'), max_digits=12)),
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, serialize=False, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+        migrations.CreateModel(
+            name='AssociationCredit',
+            fields=[
+                ('balance', models.DecimalField(decimal_places=2, default=Decimal('0.00'), max_digits=12)),
+                ('balance_fixed', models.DecimalField(decimal_places=2, default=Decimal('0.00'), max_digits=12)),
+                ('association', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, serialize=False, to='userdetails.Association')),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+        # Irreversible, the UserCredit view can no longer be generated from the current models
+        migrations.RunPython(populate_credits),
+    ]
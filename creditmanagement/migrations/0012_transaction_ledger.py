@@ -0,0 +1,115 @@
+from decimal import Decimal
+
+from django.conf import settings
+import django.core.validators
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+# The columns that are shared by the old transaction tables and the ledger
+COLUMNS = ['source_user_id', 'source_association_id', 'amount', 'target_user_id', 'target_association_id',
+           'order_moment', 'confirm_moment', 'description']
+
+
+def _copy(schema_editor, source_table, target_table, extra_columns=(), extra_values=(), where=''):
+    quote = schema_editor.quote_name
+    schema_editor.execute(
+        "INSERT INTO {target} ({target_columns}) SELECT {source_columns} FROM {source} {where} ORDER BY {id}".format(
+            target=quote(target_table),
+            target_columns=", ".join(quote(column) for column in COLUMNS + list(extra_columns)),
+            source_columns=", ".join([quote(column) for column in COLUMNS] + list(extra_values)),
+            source=quote(source_table),
+            where=where,
+            id=quote('id'),
+        )
+    )
+
+
+def copy_to_ledger(apps, schema_editor):
+    ledger = apps.get_model('creditmanagement', 'Transaction')._meta.db_table
+    for model_name, state in (('FixedTransaction', 'fixed'), ('PendingTransaction', 'pending')):
+        table = apps.get_model('creditmanagement', model_name)._meta.db_table
+        _copy(schema_editor, table, ledger, extra_columns=['state'], extra_values=["'{}'".format(state)])
+
+
+def copy_from_ledger(apps, schema_editor):
+    ledger = apps.get_model('creditmanagement', 'Transaction')._meta.db_table
+    for model_name, state in (('FixedTransaction', 'fixed'), ('PendingTransaction', 'pending')):
+        table = apps.get_model('creditmanagement', model_name)._meta.db_table
+        _copy(schema_editor, ledger, table, where="WHERE {} = '{}'".format(schema_editor.quote_name('state'), state))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('userdetails', '0018_association_has_site_stats_access'),
+        ('creditmanagement', '0011_materialised_credits'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Transaction',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=5, validators=[django.core.validators.MinValueValidator(Decimal('0.01'))], verbose_name='Money transferred')),
+                ('order_moment', models.DateTimeField(default=django.utils.timezone.now)),
+                ('confirm_moment', models.DateTimeField(blank=True, default=django.utils.timezone.now)),
+                ('description', models.CharField(blank=True, default='', max_length=50)),
+                ('state', models.CharField(choices=[('pending', 'Pending'), ('fixed', 'Fixed')], max_length=7)),
+                ('source_association', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='transaction_transaction_source', to='userdetails.Association', verbose_name='The association giving the money')),
+                ('source_user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='transaction_transaction_source', to=settings.AUTH_USER_MODEL, verbose_name='The user giving the money')),
+                ('target_association', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='transaction_transaction_target', to='userdetails.Association', verbose_name='The association recieving the money')),
+                ('target_user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='transaction_transaction_target', to=settings.AUTH_USER_MODEL, verbose_name='The user receiving the money')),
+            ],
+        ),
+        migrations.RunPython(copy_to_ledger, copy_from_ledger),
+        migrations.DeleteModel(
+            name='FixedTransaction',
+        ),
+        migrations.DeleteModel(
+            name='PendingTransaction',
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['source_user', 'order_moment'], name='creditmanag_source__9437b7_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['target_user', 'order_moment'], name='creditmanag_target__7423e5_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['source_association', 'order_moment'], name='creditmanag_source__8c5475_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['target_association', 'order_moment'], name='creditmanag_target__00f874_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['state', 'confirm_moment'], name='creditmanag_state_15d012_idx'),
+        ),
+        migrations.CreateModel(
+            name='FixedTransaction',
+            fields=[
+            ],
+            options={
+                'proxy': True,
+                'indexes': [],
+                'constraints': [],
+            },
+            bases=('creditmanagement.transaction',),
+        ),
+        migrations.CreateModel(
+            name='PendingTransaction',
+            fields=[
+            ],
+            options={
+                'proxy': True,
+                'indexes': [],
+                'constraints': [],
+            },
+            bases=('creditmanagement.transaction',),
+        ),
+    ]
@@ -0,0 +1,55 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def create_dining_transactions(apps, schema_editor):
+    """Charges the kitchen costs of the dining lists that are not finalised yet.
+
+    The materialised balances already include these costs, so they do not change.
+    """
+    DiningEntry = apps.get_model('dining', 'DiningEntry')
+    Transaction = apps.get_model('creditmanagement', 'Transaction')
+
+    entries = DiningEntry.objects.filter(dining_list__pendingdininglisttracker__isnull=False).values_list(
+        'id', 'user_id', 'dining_list__kitchen_cost', 'dining_list__sign_up_deadline')
+    Transaction.objects.bulk_create([
+        Transaction(dining_entry_id=entry_id, source_user_id=user_id, amount=kitchen_cost, order_moment=deadline,
+                    confirm_moment=deadline, description='DINING', state='pending')
+        for entry_id, user_id, kitchen_cost, deadline in entries.iterator()
+    ])
+
+
+def remove_dining_transactions(apps, schema_editor):
+    Transaction = apps.get_model('creditmanagement', 'Transaction')
+    Transaction.objects.filter(state='pending', dining_entry__isnull=False).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dining', '0017_dailyassociationstats'),
+        ('creditmanagement', '0012_transaction_ledger'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='transaction',
+            name='dining_entry',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='transactions', to='dining.DiningEntry'),
+        ),
+        migrations.RunPython(create_dining_transactions, remove_dining_transactions),
+        migrations.DeleteModel(
+            name='PendingDiningTransaction',
+        ),
+        migrations.CreateModel(
+            name='PendingDiningTransaction',
+            fields=[
+            ],
+            options={
+                'proxy': True,
+                'indexes': [],
+                'constraints': [],
+            },
+            bases=('creditmanagement.transaction',),
+        ),
+    ]
@@ -1,18 +1,40 @@
+from collections import defaultdict
 from datetime import date
 from decimal import Decimal
+from itertools import groupby
+from operator import attrgetter
 
 from django.conf import settings
-from django.core.exceptions import ValidationError
+from django.core.exceptions import ValidationError, ImproperlyConfigured
 from django.core.validators import MinValueValidator
-from django.db import models, transaction
-from django.db.models import F
-from django.db.models.functions import Cast
+from django.db import models, transaction, connections
+from django.db.models import F, Q, Sum, Count, Value, OuterRef, Subquery
+from django.db.models.functions import Cast, Coalesce
 from django.utils import timezone
 
-from dining.models import DiningList
+from dining.models import DiningList, DiningEntry
 from userdetails.models import Association, User
-from .querysets import TransactionQuerySet, DiningTransactionQuerySet, \
-    PendingDiningTrackerQuerySet, PendingTransactionQuerySet
+from .querysets import TransactionQuerySet, PendingDiningTrackerQuerySet, PendingTransactionQuerySet
+
+
+class FinalisationResult:
+    """The number of transactions and the total amount that have been finalised."""
+
+    def __init__(self, count=0, amount=Decimal('0.00')):
+        self.count = count
+        self.amount = amount
+
+    @classmethod
+    def from_queryset(cls, queryset):
+        """Computes the result for a queryset of pending transactions."""
+        totals = queryset.aggregate(count=Count('id'), amount=Coalesce(Sum('amount'), Value(0)))
+        return cls(totals['count'], Decimal(totals['amount']))
+
+    def __add__(self, other):
+        return FinalisationResult(self.count + other.count, self.amount + other.amount)
+
+    def __str__(self):
+        return "{} transactions with a total of {:.2f}".format(self.count, self.amount)
 
 
 class AbstractTransaction(models.Model):
@@ -45,6 +67,9 @@ class AbstractTransaction(models.Model):
 
     balance_annotation_name = "balance"
 
+    # The fields required to apply a transaction to the materialised balances
+    credit_fields = ('source_user_id', 'source_association_id', 'target_user_id', 'target_association_id', 'amount')
+
     class Meta:
         abstract = True
 
@@ -67,23 +92,14 @@ class AbstractTransaction(models.Model):
     def get_all_transactions(cls, user=None, association=None):
         """Gets all credit instances defined in its immediate children and present them as a queryset.
 
+        All children are stored in the Transaction ledger, so this is a single query on that table.
+
         :param user: The user(s) that need to be part of the transactions
                      Can be single instance or queryset of instances
         :param association: The association(s) that need to be part of the transactions.
                             Can be single instance or queryset of instances
         """
-        result = None
-        # Get all child classes
-        children = cls.get_children()
-
-        # Loop over all children, get their respective transaction queries, union the transaction queries
-        for child in children:
-            if result is None:
-                result = child.get_all_transactions(user, association)
-            else:
-                result = result.union(child.get_all_transactions(user, association))
-
-        return result
+        return Transaction.get_all_transactions(user, association)
 
     @classmethod
     def get_user_balance(cls, user):
@@ -121,6 +137,8 @@ class AbstractTransaction(models.Model):
     def annotate_balance(cls, users=None, associations=None):
         """Returns a list of all users or associations with their respective credits.
 
+        With the 'grouped' BALANCE_ENGINE setting this uses annotate_grouped_balance instead.
+
         :param users: A list of users to annotate, defaults to users if none is given
         :param associations: a list of associations to annotate
         :return: The list annotated with 'balance'
@@ -128,6 +146,11 @@ class AbstractTransaction(models.Model):
         if users is not None and associations is not None:
             raise ValueError("Either users or associations need to have a value, not both")
 
+        if settings.BALANCE_ENGINE == 'grouped':
+            return cls.annotate_grouped_balance(users=users, associations=associations)
+        if settings.BALANCE_ENGINE != 'subquery':
+            raise ImproperlyConfigured("Unknown BALANCE_ENGINE '{}'".format(settings.BALANCE_ENGINE))
+
         # Set the query result
         if associations:
             result = associations
@@ -160,6 +183,60 @@ class AbstractTransaction(models.Model):
 
         return result
 
+    @classmethod
+    def annotate_grouped_balance(cls, users=None, associations=None):
+        """Returns all users or associations with their balance, computed in a single grouped query.
+
+        Unlike annotate_balance this does not need two correlated subqueries per child for each row, but the result
+        is a RawQuerySet (ordered by primary key) that can only be iterated.
+
+        :param users: A queryset of users to annotate, defaults to all users
+        :param associations: A queryset of associations to annotate
+        :return: The users or associations with the balance and the fixed balance as attributes
+        """
+        totals = {
+            cls.balance_annotation_name: None,
+            FixedTransaction.balance_annotation_name: Q(state=Transaction.FIXED),
+        }
+        transactions = cls.get_all_transactions()
+        if associations is not None:
+            return transactions.annotate_grouped_association_balance(totals, associations=associations)
+        return transactions.annotate_grouped_user_balance(totals, users=User.objects.all() if users is None else users)
+
+    @staticmethod
+    def update_credits(values, sign=1, fixed=False):
+        """Applies a transaction to the materialised UserCredit and AssociationCredit balances.
+
+        Args:
+            values: A dictionary containing the credit_fields of the transaction.
+            sign: 1 to apply the transaction, -1 to revert it.
+            fixed: Whether the transaction also counts towards the fixed balance.
+        """
+        amount = values['amount'] * sign
+        fixed_amount = amount if fixed else Decimal('0.00')
+
+        UserCredit.apply_change(values['source_user_id'], -amount, -fixed_amount)
+        AssociationCredit.apply_change(values['source_association_id'], -amount, -fixed_amount)
+        UserCredit.apply_change(values['target_user_id'], amount, fixed_amount)
+        AssociationCredit.apply_change(values['target_association_id'], amount, fixed_amount)
+
+    @staticmethod
+    def update_fixed_credits(queryset):
+        """Adds a queryset of pending transactions that are being finalised to the fixed balances.
+
+        The total balances do not change as the transactions were already included as pending transactions.
+        """
+        for party, credit_model in (('user', UserCredit), ('association', AssociationCredit)):
+            for column, sign in (('source_' + party, -1), ('target_' + party, 1)):
+                totals = queryset.filter(**{column + '__isnull': False}).order_by().values(column).annotate(
+                    total=Sum('amount'))
+                for row in totals:
+                    credit_model.apply_change(row[column], 0, sign * row['total'])
+
+    def get_credit_values(self):
+        """Returns the credit_fields of this instance as a dictionary."""
+        return {field: getattr(self, field) for field in self.credit_fields}
+
     def source(self):
         return self.source_association if self.source_association else self.source_user
 
@@ -167,16 +244,59 @@ class AbstractTransaction(models.Model):
         return self.target_association if self.target_association else self.target_user
 
 
-class FixedTransaction(AbstractTransaction):
-    """Transaction model for immutable final transactions."""
+class LedgerManager(models.Manager):
+    """Manager of the proxy models of Transaction, only returns the transactions in the given state.
+
+    Additional keyword arguments are applied as filter as well.
+    """
+
+    def __init__(self, state, **filters):
+        super().__init__()
+        self.state = state
+        self.filters = filters
+
+    def get_queryset(self):
+        return super().get_queryset().filter(state=self.state, **self.filters)
+
+
+class Transaction(AbstractTransaction):
+    """The ledger, containing both the pending and the fixed transactions.
+
+    Use the FixedTransaction, PendingTransaction and PendingDiningTransaction proxy models to work with the
+    transactions in one state. Finalising a pending transaction only changes its state.
+
+    The kitchen cost of a dining entry is charged by a transaction linked to the entry, see
+    PendingDiningTransaction.
+    """
+    PENDING = 'pending'
+    FIXED = 'fixed'
+    STATE_CHOICES = (
+        (PENDING, 'Pending'),
+        (FIXED, 'Fixed'),
+    )
+
+    state = models.CharField(max_length=7, choices=STATE_CHOICES)
+    dining_entry = models.ForeignKey(DiningEntry, related_name='transactions', on_delete=models.SET_NULL,
+                                     null=True, blank=True)
 
     objects = TransactionQuerySet.as_manager()
-    balance_annotation_name = "balance_fixed"
 
-    def save(self, *args, **kwargs):
-        if self.id is None:
-            self.confirm_moment = timezone.now()
-            super(FixedTransaction, self).save(*args, **kwargs)
+    # The state of new instances, set by the proxy models
+    ledger_state = None
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['source_user', 'order_moment']),
+            models.Index(fields=['target_user', 'order_moment']),
+            models.Index(fields=['source_association', 'order_moment']),
+            models.Index(fields=['target_association', 'order_moment']),
+            models.Index(fields=['state', 'confirm_moment']),
+        ]
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if not self.state:
+            self.state = self.ledger_state
 
     @classmethod
     def get_all_transactions(cls, user=None, association=None):
@@ -201,13 +321,40 @@ class FixedTransaction(AbstractTransaction):
         return cls.objects.compute_association_balance(association)
 
     @classmethod
-    def annotate_balance(cls, users=None, associations=None, output_name=balance_annotation_name):
+    def annotate_balance(cls, users=None, associations=None, output_name=None):
+        output_name = output_name or cls.balance_annotation_name
         if associations:
             return cls.objects.annotate_association_balance(associations=associations, output_name=output_name)
         else:
             return cls.objects.annotate_user_balance(users=users, output_name=output_name)
 
 
+class FixedTransaction(Transaction):
+    """Transaction model for immutable final transactions."""
+
+    objects = LedgerManager.from_queryset(TransactionQuerySet)(Transaction.FIXED)
+    balance_annotation_name = "balance_fixed"
+    ledger_state = Transaction.FIXED
+
+    class Meta:
+        proxy = True
+
+    @classmethod
+    def get_user_balance(cls, user):
+        return BalanceCheckpoint.compute_balance('user', user)
+
+    @classmethod
+    def get_association_balance(cls, association: Association) -> Decimal:
+        return BalanceCheckpoint.compute_balance('association', association)
+
+    def save(self, *args, **kwargs):
+        if self.id is None:
+            self.confirm_moment = timezone.now()
+            # Atomic so that the balance update in the receivers is stored together with the transaction
+            with transaction.atomic():
+                super(FixedTransaction, self).save(*args, **kwargs)
+
+
 class AbstractPendingTransaction(AbstractTransaction):
     balance_annotation_name = "balance_pending"
 
@@ -218,262 +365,485 @@ class AbstractPendingTransaction(AbstractTransaction):
     def get_children(cls):
         return [PendingTransaction, PendingDiningTransaction]
 
+    @classmethod
+    def get_all_transactions(cls, user=None, association=None):
+        return Transaction.get_all_transactions(user, association).filter(state=Transaction.PENDING)
+
     def finalise(self):
         raise NotImplementedError()
 
     @classmethod
-    def finalise_all_expired(cls):
-        """Moves all pending transactions to the fixed transactions table.
+    def finalise_all_expired(cls, batch_size=None, dry_run=False):
+        """Finalises all expired pending transactions.
+
+        Args:
+            batch_size: The number of pending transactions finalised per database transaction.
+            dry_run: If True, only computes what would be finalised.
 
         Returns:
-            The new entries that were added to the fixed transactions table.
+            A FinalisationResult with the number of finalised transactions and their total amount.
         """
-        # Get all child classes
-        children = cls.get_children()
-
-        # Loop over all children, finalise them and add all retrieved items to a combined list
-        result = []
-        for child in children:
-            result = result + child.finalise_all_expired()
-
+        result = FinalisationResult()
+        for child in cls.get_children():
+            result += child.finalise_all_expired(batch_size=batch_size, dry_run=dry_run)
         return result
 
 
-class PendingTransaction(AbstractPendingTransaction):
-    objects = PendingTransactionQuerySet.as_manager()
+class PendingTransaction(Transaction):
+    """Transaction model for transactions that can still be changed, they are finalised after some time."""
+
+    objects = LedgerManager.from_queryset(PendingTransactionQuerySet)(Transaction.PENDING, dining_entry__isnull=True)
     balance_annotation_name = "balance_pending_normal"
+    ledger_state = Transaction.PENDING
+
+    class Meta:
+        proxy = True
 
     def clean(self):
-        """Performs entry checks on model contents."""
+        """Checks that the balance of the source user does not become too low, e.g. in the admin site."""
         super().clean()
+        if self.source_user_id is not None:
+            self._check_balance(UserCredit.get_balance(self.source_user))
+
+    def _check_balance(self, balance):
+        """Raises a ValidationError when the given balance of the source user becomes too low by this transaction."""
+        change = self.amount
+        if self.pk is not None:
+            # The saved transaction is already included in the balance
+            old = PendingTransaction.objects.filter(pk=self.pk, source_user_id=self.source_user_id) \
+                .values_list('amount', flat=True).first()
+            change -= old or Decimal('0.00')
+        if balance - change < settings.MINIMUM_BALANCE_FOR_USER_TRANSACTION:
+            raise ValidationError("Balance becomes too low")
+
+    def transfer(self):
+        """Saves this new transaction, unless the balance of the source user would become too low.
+
+        The balance of the source user is locked until the transaction is saved, so concurrent transfers of the
+        same user can not both pass the check. The number of queries does not depend on the transaction history.
+
+        Raises:
+            ValidationError: When the balance would drop below MINIMUM_BALANCE_FOR_USER_TRANSACTION.
+        """
+        if self.pk is not None:
+            raise ValueError("Only new transactions can be transferred")
 
-        # Check whether balance does not exceed set limit on balance
-        # Checked here as this is primary user interaction. Check in fixed introduces possible problems where old
-        # entries are not yet removed resulting in new fixed entries not allowed
-        if self.source_user:
-            balance = AbstractTransaction.get_user_balance(self.source_user)
-            # If the object is being altered instead of created, take difference into account
-            if self.pk:
-                change = self.amount - self.objects.get(id=self.id).amount
-            else:
-                change = self.amount
-            new_balance = balance - change
-            if new_balance < settings.MINIMUM_BALANCE_FOR_USER_TRANSACTION:
-                raise ValidationError("Balance becomes too low")
+        with transaction.atomic():
+            if self.source_user_id is not None:
+                # Checked again with the locked balance, clean() can be passed concurrently
+                self._check_balance(UserCredit.lock_balance(self.source_user_id))
+            self.save()
+
+    @classmethod
+    def clear_negative_balances(cls, credits, association, description, expected=None):
+        """Creates transactions from the association that bring the negative balances of the credits back to zero.
+
+        The balances are locked and read in a single query and the transactions are created with a single bulk
+        insert, all in one database transaction. bulk_create skips the receivers, so the materialised balances are
+        updated here, the balance cache needs to be invalidated by the caller.
+
+        Args:
+            credits: A UserCredit queryset of the negative balances.
+            association: The association that pays the balances.
+            description: The description of the transactions.
+            expected: The (count, total) that the user agreed to, see get_negative_balances_preview.
+
+        Returns:
+            The created transactions.
+
+        Raises:
+            ValidationError: When the balances do not match expected anymore.
+        """
+        now = timezone.now()
+        with transaction.atomic():
+            credits = credits.filter(balance__lt=0)
+            balances = list(UserCredit.lock(credits).values_list('user_id', 'balance'))
+            total = -sum((balance for _, balance in balances), Decimal('0.00'))
+            if expected is not None and expected != (len(balances), total):
+                raise ValidationError("The balances have changed, check the new amounts")
+
+            transactions = [cls(source_association=association, target_user_id=user_id, amount=-balance,
+                                description=description, order_moment=now,
+                                confirm_moment=now + settings.TRANSACTION_PENDING_DURATION)
+                            for user_id, balance in balances]
+            cls.objects.bulk_create(transactions)
+            # The rows are locked, so all balances are still equal to the amounts of the transactions
+            credits.update(balance=Decimal('0.00'))
+            AssociationCredit.apply_change(association.pk, -total, Decimal('0.00'))
+        return transactions
+
+    @staticmethod
+    def get_negative_balances_preview(credits):
+        """Returns the number of negative balances in the credits queryset and the total needed to clear them."""
+        preview = credits.filter(balance__lt=0).aggregate(count=Count('pk'), total=Sum('balance'))
+        return preview['count'], -(preview['total'] or Decimal('0.00'))
 
     def finalise(self):
-        """Moves the pending transaction over as a fixed transaction."""
-        # Create the fixed database entry
-        fixed_transaction = FixedTransaction(source_user=self.source_user, source_association=self.source_association,
-                                             target_user=self.target_user, target_association=self.target_association,
-                                             amount=self.amount,
-                                             order_moment=self.order_moment, description=self.description)
-        # Move the transaction to the other database
+        """Changes the pending transaction into a fixed transaction."""
         with transaction.atomic():
-            self.delete()
-            fixed_transaction.save()
+            queryset = PendingTransaction.objects.filter(pk=self.pk)
+            self.update_fixed_credits(queryset)
+            queryset.update(state=Transaction.FIXED, confirm_moment=timezone.now())
 
-        return fixed_transaction
+        return FixedTransaction.objects.get(pk=self.pk)
 
     def save(self, *args, **kwargs):
         # If no confirm moment is given, set it to the standard
         if not self.confirm_moment:
             self.confirm_moment = self.order_moment + settings.TRANSACTION_PENDING_DURATION
 
-        super(PendingTransaction, self).save(*args, **kwargs)
+        with transaction.atomic():
+            super(PendingTransaction, self).save(*args, **kwargs)
 
     @classmethod
-    def finalise_all_expired(cls):
-        # Get all finalised items
-        expired_transactions = cls.objects.get_expired_transactions()
-        new_transactions = []
-        for transaction_obj in expired_transactions:
-            # finalise transaction
-            new_transactions.append(transaction_obj.finalise())
+    def finalise_all_expired(cls, batch_size=None, dry_run=False):
+        """Finalises the expired transactions in batches.
+
+        The state of every batch is changed in place using a single ranged UPDATE.
+        """
+        batch_size = batch_size or settings.FINALISATION_BATCH_SIZE
+        moment = timezone.now()
+        expired = cls.objects.get_expired_transactions(moment=moment).order_by('id')
+
+        if dry_run:
+            return FinalisationResult.from_queryset(expired)
+
+        result = FinalisationResult()
+        while True:
+            with transaction.atomic():
+                ids = list(expired.select_for_update().values_list('id', flat=True)[:batch_size])
+                if not ids:
+                    break
+                batch = expired.filter(id__gte=ids[0], id__lte=ids[-1])
+
+                result += FinalisationResult.from_queryset(batch)
+                cls.update_fixed_credits(batch)
+                # Signals are skipped deliberately, the balances have been updated above
+                batch.update(state=Transaction.FIXED, confirm_moment=moment)
 
-        return new_transactions
+        return result
+
+
+class PendingDiningTransaction(Transaction):
+    """The kitchen cost of a dining entry, charged to the user of the entry.
+
+    The transaction is created together with the entry by the receivers in creditmanagement/receivers.py, it is
+    changed or removed when the kitchen cost or the entry changes. It is finalised together with the other
+    transactions of the dining list when the list can no longer be adjusted, see PendingDiningListTracker.
+    """
+    objects = LedgerManager.from_queryset(TransactionQuerySet)(Transaction.PENDING, dining_entry__isnull=False)
+    balance_annotation_name = "balance_pending_dining"
+    ledger_state = Transaction.PENDING
+
+    dining_identifier = "DINING"
+
+    class Meta:
+        proxy = True
 
     @classmethod
-    def get_all_transactions(cls, user=None, association=None):
-        """Get all credit instances defined in its immediate children and present them as a queryset.
+    def create_for_entry(cls, entry):
+        """Charges the kitchen cost of the dining list to the user of the entry.
 
-        :param user: The user(s) that need to be part of the transactions
-                     Can be single instance or queryset of instances
-        :param association: The association(s) that need to be part of the transactions.
-                            Can be single instance or queryset of instances
+        Returns:
+            The created transaction or None when the costs of the dining list are not pending anymore.
         """
-        # Get all objects
-        return cls.objects.filter_user(user).filter_association(association)
+        dining_list = DiningList.objects.filter(id=entry.dining_list_id, pendingdininglisttracker__isnull=False) \
+            .values('kitchen_cost', 'sign_up_deadline').first()
+        if dining_list is None:
+            return None
+        return cls.objects.create(dining_entry=entry, source_user_id=entry.user_id,
+                                  amount=dining_list['kitchen_cost'],
+                                  order_moment=dining_list['sign_up_deadline'],
+                                  confirm_moment=dining_list['sign_up_deadline'],
+                                  description=cls.dining_identifier)
 
     @classmethod
-    def get_user_balance(cls, user):
-        return cls.objects.compute_user_balance(user)
+    def finalise_all_expired(cls, batch_size=None, dry_run=False):
+        # Finalise all finished dining lists
+        return PendingDiningListTracker.finalise_all(PendingDiningListTracker.objects.filter_lists_expired(),
+                                                     batch_size=batch_size, dry_run=dry_run)
+
+    def finalise(self):
+        raise NotImplementedError("PendingDiningTransactions are finalised per dining list")
+
+
+class PendingDiningListTracker(models.Model):
+    """Model to track all Dining Lists that are pending.
+
+    The kitchen costs of the entries on a tracked dining list are charged by PendingDiningTransactions.
+    """
+    dining_list = models.OneToOneField(DiningList, on_delete=models.CASCADE)
+
+    objects = PendingDiningTrackerQuerySet.as_manager()
+
+    def finalise(self):
+        return self.finalise_all(PendingDiningListTracker.objects.filter(pk=self.pk))
 
     @classmethod
-    def get_association_balance(cls, association) -> Decimal:
-        """Compute the balance according to this model based on the given association."""
-        return cls.objects.compute_association_balance(association)
+    def finalise_to_date(cls, d: date):
+        """Finalises all pending dining list transactions.
+
+        Args:
+            d: The date until which all tracked dining lists need to be finalised.
+        """
+        return cls.finalise_all(cls.objects.filter_lists_for_date(d))
+
+    @staticmethod
+    def get_transactions(trackers):
+        """Returns the pending transactions of the dining lists of the given trackers."""
+        return PendingDiningTransaction.objects.filter(dining_entry__dining_list__pendingdininglisttracker__in=trackers)
 
     @classmethod
-    def annotate_balance(cls, users=None, associations=None, output_name=balance_annotation_name):
-        if associations:
-            return cls.objects.annotate_association_balance(associations=associations, output_name=output_name)
-        else:
-            return cls.objects.annotate_user_balance(users=users, output_name=output_name)
+    def finalise_all(cls, trackers, batch_size=None, dry_run=False):
+        """Finalises the dining lists of the given trackers in batches.
 
+        The state of the transactions of a batch is changed with a single UPDATE, which skips the model signals, so
+        the balances are updated here. The trackers are removed afterwards.
 
-class PendingDiningTransactionManager(models.Manager):
-    # Created specially due to the different behaviour of the model (different database and model use)
+        Args:
+            trackers: A queryset of PendingDiningListTrackers.
+            batch_size: The number of dining lists that are finalised per database transaction.
+            dry_run: If True, only computes what would be finalised.
 
-    @staticmethod
-    def get_queryset(user=None, dining_list=None):
-        return DiningTransactionQuerySet.generate_queryset(user=user, dining_list=dining_list)
+        Returns:
+            A FinalisationResult with the number of finalised transactions and their total amount.
+        """
+        batch_size = batch_size or settings.FINALISATION_BATCH_SIZE
+        trackers = trackers.order_by('id')
 
-    @staticmethod
-    def annotate_users_balance(users, output_name=None):
-        return DiningTransactionQuerySet.annotate_user_balance(users=users, output_name=output_name)
+        if dry_run:
+            return FinalisationResult.from_queryset(cls.get_transactions(trackers.values('id')))
+
+        result = FinalisationResult()
+        while True:
+            with transaction.atomic():
+                ids = list(trackers.select_for_update().values_list('id', flat=True)[:batch_size])
+                if not ids:
+                    break
+                transactions = cls.get_transactions(ids)
+
+                result += FinalisationResult.from_queryset(transactions)
+                AbstractTransaction.update_fixed_credits(transactions)
+                transactions.update(state=Transaction.FIXED, confirm_moment=timezone.now())
+
+                # The transactions are fixed now, so refund_pending_dining_list finds nothing to refund
+                cls.objects.filter(id__in=ids).delete()
+
+        return result
 
-    @staticmethod
-    def annotate_association_balance(associations, output_name=None):
-        return DiningTransactionQuerySet.annotate_association_balance(associations=associations,
-                                                                      output_name=output_name)
 
+class BalanceCheckpoint(models.Model):
+    """The fixed balance of a user or association at the as_of moment.
 
-class PendingDiningTransaction(AbstractPendingTransaction):
-    """Model for the Pending Dining Transactions.
+    The fixed balance is the balance of the latest checkpoint plus the fixed transactions confirmed after it, so
+    computing it does not need the complete transaction history. Fixed transactions get their confirm_moment when
+    they become fixed and are immutable, which keeps the checkpoints valid (reconcile_balances verifies them).
 
-    Does NOT create a table, information is obtained elsewhere as specified in the manager/queryset.
+    The checkpoints are created by the create_balance_checkpoints management command, only for the parties that
+    had fixed transactions since the previous checkpoints.
     """
-    balance_annotation_name = "balance_pending_dining"
-    objects = PendingDiningTransactionManager()
+    user = models.ForeignKey(User, related_name='balance_checkpoints', on_delete=models.CASCADE,
+                             null=True, blank=True)
+    association = models.ForeignKey(Association, related_name='balance_checkpoints', on_delete=models.CASCADE,
+                                    null=True, blank=True)
+    as_of = models.DateTimeField()
+    balance = models.DecimalField(decimal_places=2, max_digits=12)
+
+    party_fields = ('user', 'association')
 
     class Meta:
-        managed = False  # There's no actual table in the database
+        unique_together = (('user', 'as_of'), ('association', 'as_of'))
 
-    @classmethod
-    def finalise_all_expired(cls):
-        # Get all finished dining lists
-        results = []
-        for dining_list in PendingDiningListTracker.objects.filter_lists_expired():
-            results += dining_list.finalise()
-        return results
+    def __str__(self):
+        return "{} at {}: {}".format(self.user or self.association, self.as_of, self.balance)
 
-    @classmethod
-    def get_all_transactions(cls, user=None, association=None):
-        if association:
-            # Return none, no associations can be involved in dining lists
-            return cls.objects.none()
-        return cls.objects.get_queryset(user=user)
+    @staticmethod
+    def _get_deltas(party_field, start, end):
+        """Returns the change of the fixed balances by the transactions confirmed in the given period.
 
-    @classmethod
-    def get_user_balance(cls, user):
-        return cls.objects.all().compute_user_balance(user)
+        Args:
+            party_field: 'user' or 'association'.
+            start: The (exclusive) start of the period, None for the complete history.
+            end: The (inclusive) end of the period.
 
-    @classmethod
-    def get_association_balance(cls, association):
-        return cls.objects.all().compute_association_balance(association)
+        Returns:
+            A dictionary from party id to the change of its balance.
+        """
+        transactions = FixedTransaction.objects.filter(confirm_moment__lte=end)
+        if start is not None:
+            transactions = transactions.filter(confirm_moment__gt=start)
+
+        deltas = defaultdict(Decimal)
+        for column, sign in (('source_' + party_field, -1), ('target_' + party_field, 1)):
+            totals = transactions.filter(**{column + '__isnull': False}).order_by().values(column).annotate(
+                total=Sum('amount'))
+            for row in totals:
+                deltas[row[column]] += sign * row['total']
+        return deltas
 
     @classmethod
-    def annotate_balance(cls, users=None, associations=None, output_name=balance_annotation_name):
-        if associations:
-            return cls.objects.annotate_association_balance(associations, output_name=cls.balance_annotation_name)
-        else:
-            return cls.objects.annotate_users_balance(users, output_name=cls.balance_annotation_name)
+    def compute_balance(cls, party_field, party) -> Decimal:
+        """Returns the fixed balance of the given user or association using its latest checkpoint."""
+        checkpoint = cls.objects.filter(**{party_field: party}).order_by('-as_of').first()
+        transactions = FixedTransaction.objects.all()
+        balance = Decimal('0.00')
+        if checkpoint:
+            # The state and confirm_moment index limits this to the transactions since the checkpoint
+            transactions = transactions.filter(confirm_moment__gt=checkpoint.as_of)
+            balance = checkpoint.balance
+        compute = getattr(transactions, 'compute_{}_balance'.format(party_field))
+        return balance + compute(party)
 
     @classmethod
-    def get_association_credit(cls, association):
-        return Decimal('0.00')
+    def create_checkpoints(cls, as_of):
+        """Creates checkpoints at the given moment for all parties with fixed transactions since the last checkpoints.
 
-    def finalise(self):
-        raise NotImplementedError("PendingDiningTransactions are read-only")
+        Args:
+            as_of: The moment of the checkpoints, it needs to be after the latest checkpoint and far enough in the
+                past that no transactions confirmed before it are still being committed.
 
-    def _get_fixed_form(self):
-        return FixedTransaction(source_user=self.source_user, source_association=self.source_association,
-                                target_user=self.target_user, target_association=self.target_association,
-                                amount=self.amount,
-                                order_moment=self.order_moment, description=self.description)
+        Returns:
+            The number of created checkpoints.
+        """
+        previous = cls.objects.order_by('-as_of').values_list('as_of', flat=True).first()
+        if previous is not None and previous >= as_of:
+            raise ValueError("Checkpoints can only be created after the latest checkpoint ({})".format(previous))
 
+        checkpoints = []
+        with transaction.atomic():
+            for party_field in cls.party_fields:
+                deltas = cls._get_deltas(party_field, previous, as_of)
+                # Parties without fixed transactions since their last checkpoint do not need a new one, so the
+                # latest checkpoint of each party is still the current one
+                latest = cls.objects.filter(**{party_field: OuterRef(party_field)}).order_by('-as_of')
+                balances = dict(cls.objects.filter(**{party_field + '__isnull': False}).filter(
+                    as_of=Subquery(latest.values('as_of')[:1])).values_list(party_field, 'balance'))
+                checkpoints += [
+                    cls(**{party_field + '_id': party_id}, as_of=as_of,
+                        balance=balances.get(party_id, Decimal('0.00')) + delta)
+                    for party_id, delta in deltas.items()
+                ]
+            cls.objects.bulk_create(checkpoints)
+        return len(checkpoints)
 
-class PendingDiningListTracker(models.Model):
-    """Model to track all Dining Lists that are pending.
+    @classmethod
+    def get_mismatches(cls):
+        """Recomputes all checkpoints from the fixed transactions.
 
-    Used for creating Pending Dining Transactions.
-    """
-    dining_list = models.OneToOneField(DiningList, on_delete=models.CASCADE)
+        Returns:
+            A list of (checkpoint, computed balance) tuples of the checkpoints that are incorrect.
+        """
+        mismatches = []
+        for party_field in cls.party_fields:
+            balances = defaultdict(Decimal)
+            previous = None
+            checkpoints = cls.objects.filter(**{party_field + '__isnull': False}).order_by('as_of')
+            for as_of, group in groupby(checkpoints.iterator(), key=attrgetter('as_of')):
+                for party_id, delta in cls._get_deltas(party_field, previous, as_of).items():
+                    balances[party_id] += delta
+                previous = as_of
+                for checkpoint in group:
+                    computed = balances[getattr(checkpoint, party_field + '_id')]
+                    if checkpoint.balance != computed:
+                        mismatches.append((checkpoint, computed))
+        return mismatches
 
-    objects = PendingDiningTrackerQuerySet.as_manager()
 
-    def finalise(self):
-        # Generate the initial list
-        transactions = []
+# User and association views
 
-        # Get all corresponding dining transactions
-        # loop over all items and make the transactions
-        for dining_transaction in PendingDiningTransaction.objects.get_queryset(dining_list=self.dining_list):
-            transactions.append(dining_transaction._get_fixed_form())
 
-        # Save the changes
-        with transaction.atomic():
-            for fixed_transaction in transactions:
-                fixed_transaction.save()
-            self.delete()
+class AbstractCredit(models.Model):
+    """Materialised balance of a single user or association.
 
-        return transactions
+    The rows are kept up to date incrementally by the receivers in creditmanagement/receivers.py, so reading a
+    balance is a single primary key lookup. The reconcile_balances management command compares them with the
+    balance computed from the complete transaction history.
+    """
+    balance = models.DecimalField(default=Decimal('0.00'), decimal_places=2, max_digits=12)
+    balance_fixed = models.DecimalField(default=Decimal('0.00'), decimal_places=2, max_digits=12)
+
+    # The name of the primary key column of the party
+    party_field = None
+
+    class Meta:
+        abstract = True
 
     @classmethod
-    def finalise_to_date(cls, d: date):
-        """Finalises all pending dining list transactions.
+    def apply_change(cls, party_id, balance, balance_fixed):
+        """Adds the given amounts to the balance of the party (does nothing when party_id is None)."""
+        if party_id is None or (not balance and not balance_fixed):
+            return
+        updated = cls.objects.filter(**{cls.party_field: party_id}).update(
+            balance=F('balance') + balance,
+            balance_fixed=F('balance_fixed') + balance_fixed,
+        )
+        if not updated:
+            # The row did not exist yet, which can only happen for parties created outside the receivers
+            cls.objects.create(**{cls.party_field: party_id, 'balance': balance, 'balance_fixed': balance_fixed})
 
-        Args:
-            d: The date until which all tracked dining lists need to be finalised.
+    @staticmethod
+    def lock(credits):
+        """Locks the rows of the credits queryset until the end of the current database transaction.
+
+        Returns:
+            The queryset that selects the rows for update.
         """
-        query = cls.objects.filter_lists_for_date(d)
-        for pending_dining_list_tracker in query:
-            pending_dining_list_tracker.finalise()
+        if not connections[credits.db].features.has_select_for_update:
+            # SQLite has no row locks, writing takes the database lock for the rest of the transaction instead
+            credits.update(balance=F('balance'))
+        return credits.select_for_update()
 
+    @classmethod
+    def lock_balance(cls, party_id) -> Decimal:
+        """Returns the balance of the party and locks it until the end of the current database transaction."""
+        balance = cls.lock(cls.objects.filter(**{cls.party_field: party_id})).values_list('balance', flat=True).first()
+        return Decimal('0.00') if balance is None else balance
 
-# User and association views
+    @classmethod
+    def get_balance(cls, party) -> Decimal:
+        """Returns the current balance of the given user or association."""
+        balance = cls.objects.filter(**{cls.party_field: party.pk}).values_list('balance', flat=True).first()
+        return Decimal('0.00') if balance is None else balance
 
 
-class UserCredit(models.Model):
-    """User credit model, implemented as Database VIEW (see migrations/usercredit_view.py)."""
+class UserCredit(AbstractCredit):
+    """The materialised balance of a user."""
 
-    user = models.OneToOneField(User, primary_key=True,
-                                db_column='id',
-                                on_delete=models.DO_NOTHING)
-    balance = models.DecimalField(blank=True, null=True,
-                                  db_column=AbstractTransaction.balance_annotation_name,
-                                  decimal_places=2,
-                                  max_digits=6)
-    balance_fixed = models.DecimalField(blank=True,
-                                        null=True,
-                                        db_column=FixedTransaction.balance_annotation_name,
-                                        decimal_places=2,
-                                        max_digits=6)
+    user = models.OneToOneField(User, primary_key=True, on_delete=models.CASCADE)
 
-    def negative_since(self):
-        """Computes the date from the balance_fixed table when the users balance has become negative."""
-        balance = self.balance_fixed
-        if balance >= 0:
-            # balance is already positive, return nothing
-            return None
+    party_field = 'user_id'
 
-        # Loop over all transactions from new to old, reverse its balance
-        transactions = FixedTransaction.get_all_transactions(user=self.user).order_by('-order_moment')
-        for fixed_transaction in transactions:
-            balance += fixed_transaction.amount
-            # If balance is positive now, return the current transaction date
-            if balance >= 0:
-                return fixed_transaction.order_moment
+    def negative_since(self):
+        """Returns the moment from which the fixed balance of the user has been negative, None if it is not negative.
 
-        # This should not be reached, it would indicate that the starting balance was below 0
-        raise RuntimeError("Balance started as negative, negative_since could not be computed")
+        Uses the value of prefetch_negative_since when it was computed for multiple credits at once.
+        """
+        if not hasattr(self, '_negative_since'):
+            self.prefetch_negative_since([self])
+        return self._negative_since
 
-    @classmethod
-    def view(cls):
-        """This method returns the SQL string that creates the view."""
-        qs = AbstractTransaction.annotate_balance(
-            users=User.objects.all()).values('id',
-                                             AbstractTransaction.balance_annotation_name,
-                                             FixedTransaction.balance_annotation_name)
-        return str(qs.query)
+    @staticmethod
+    def prefetch_negative_since(credits):
+        """Computes negative_since of all given credits with a single running balance query."""
+        negative = [credit.user_id for credit in credits if credit.balance_fixed < 0]
+        since = {}
+        if negative:
+            running = FixedTransaction.objects.running_user_balance(User.objects.filter(pk__in=negative))
+            for fixed_transaction in running:
+                # Round the sum, it is a float on SQLite
+                if round(fixed_transaction.balance, 2) >= 0:
+                    since.pop(fixed_transaction.party, None)
+                else:
+                    # The balance became negative with this transaction when it was not negative already
+                    since.setdefault(fixed_transaction.party, fixed_transaction.order_moment)
+
+        for credit in credits:
+            credit._negative_since = since.get(credit.user_id) if credit.balance_fixed < 0 else None
+
+
+class AssociationCredit(AbstractCredit):
+    """The materialised balance of an association."""
+
+    association = models.OneToOneField(Association, primary_key=True, on_delete=models.CASCADE)
+
+    party_field = 'association_id'
@@ -1,11 +1,10 @@
 from datetime import date
 
-from django.db import models
-from django.db.models import Q, F, Value, Sum, OuterRef, Subquery, ExpressionWrapper, QuerySet
-from django.db.models.functions import Coalesce, Cast
+from django.db import models, connections
+from django.db.models import Q, F, Value, Sum, OuterRef, Subquery, ExpressionWrapper, Case, When
+from django.db.models.functions import Coalesce
 from django.utils import timezone
 
-from dining.models import DiningEntry
 from userdetails.models import User, Association
 
 
@@ -48,14 +47,14 @@ class AbstractTransactionQuerySet(models.QuerySet):
         source_sum_qs = source_sum_qs.values(source_column)
         # Annotate the sum
         source_sum_qs = source_sum_qs.annotate(source_sum=Sum('amount')).values('source_sum')
-        # Encapsulate in subquery
-        source_sum_qs = Coalesce(Subquery(source_sum_qs), Value(0))
+        # Encapsulate in subquery, the output field can not be derived when the queryset filters on other columns
+        source_sum_qs = Coalesce(Subquery(source_sum_qs, output_field=models.DecimalField()), Value(0))
 
         # Same as above
         target_sum_qs = transaction_queries.filter(**{target_column: OuterRef('pk')})
         target_sum_qs = target_sum_qs.values(target_column)
         target_sum_qs = target_sum_qs.annotate(target_sum=Sum('amount')).values('target_sum')
-        target_sum_qs = Coalesce(Subquery(target_sum_qs), Value(0))
+        target_sum_qs = Coalesce(Subquery(target_sum_qs, output_field=models.DecimalField()), Value(0))
 
         # Combine
         return items.annotate(**{output_name: target_sum_qs - source_sum_qs})
@@ -82,6 +81,104 @@ class AbstractTransactionQuerySet(models.QuerySet):
 
         return target_sum_qs - source_sum_qs
 
+    def _signed_amounts(self, items, party_column, sign, totals, fields=()):
+        """Returns the party and the signed amount of each total for one side of the transactions.
+
+        :param items: The items that are annotated, the transactions are limited to them when it is filtered
+        :param party_column: The source or target column of the transaction
+        :param sign: -1 for the source column, 1 for the target column
+        :param totals: A dictionary from output name to the condition of the transactions included in the total
+        :param fields: Additional transaction fields that are selected
+        :return: a values queryset with the fields, the party and a column for each total
+        """
+        queryset = self.filter(**{party_column + '__isnull': False}).order_by()
+        if items.query.has_filters():
+            queryset = queryset.filter(**{party_column + '__in': items.order_by().values('pk')})
+
+        columns = {}
+        for name, condition in totals.items():
+            amount = F('amount')
+            if condition is not None:
+                amount = Case(When(condition, then=amount), default=Value(0), output_field=models.DecimalField())
+            columns[name] = amount if sign > 0 else -amount
+        return queryset.annotate(party=F(party_column), **columns).values(*fields, 'party', *totals)
+
+    def _annotate_grouped_balance(self, items, source_column, target_column, totals):
+        """Annotates the balances to the items using a single grouped query instead of correlated subqueries.
+
+        The signed amounts of both sides of the transactions are combined with UNION ALL, summed per party in one
+        pass over the transactions and joined back to the items once.
+
+        :param items: a queryset of the items that needs their credits computed
+        :param source_column: The source column of the transaction
+        :param target_column: The target column of the transaction
+        :param totals: A dictionary from output name to the condition of the transactions included in the total,
+                       None includes all transactions
+        :return: a RawQuerySet of the items, ordered by primary key, with the totals as attributes
+        """
+        quote = connections[self.db].ops.quote_name
+        sides = [self._signed_amounts(items, target_column, 1, totals),
+                 self._signed_amounts(items, source_column, -1, totals)]
+        sides = [side.query.sql_with_params() for side in sides]
+        items_sql, items_params = items.order_by().values('pk').query.sql_with_params()
+
+        table = quote(items.model._meta.db_table)
+        pk = quote(items.model._meta.pk.column)
+        sql = (
+            "SELECT {table}.*, {balances} FROM {table} LEFT JOIN ("
+            "SELECT {party}, {sums} FROM ({union}) signed_amounts GROUP BY {party}"
+            ") balances ON balances.{party} = {table}.{pk} WHERE {table}.{pk} IN ({items}) ORDER BY {table}.{pk}"
+        ).format(
+            table=table,
+            pk=pk,
+            party=quote('party'),
+            balances=", ".join("COALESCE(balances.{0}, 0) AS {0}".format(quote(name)) for name in totals),
+            sums=", ".join("SUM({0}) AS {0}".format(quote(name)) for name in totals),
+            union=" UNION ALL ".join(sql for sql, _ in sides),
+            items=items_sql,
+        )
+        params = tuple(param for _, side_params in sides for param in side_params) + tuple(items_params)
+        return items.model.objects.db_manager(self.db).raw(sql, params)
+
+    def _running_balance(self, items, source_column, target_column):
+        """Returns the transactions of the items with the balance of the item after each transaction.
+
+        The balances are computed in a single query with a window function over the signed amounts of both sides
+        of the transactions, a transaction between two of the items is returned for both.
+
+        :param items: a queryset of the items that need their balance history
+        :param source_column: The source column of the transaction
+        :param target_column: The target column of the transaction
+        :return: a RawQuerySet of the transactions ordered by item and order_moment, with the item id as party, the
+                 signed amount as change and the balance after the transaction as balance
+        """
+        quote = connections[self.db].ops.quote_name
+        totals = {'change': None}
+        fields = ('id', 'order_moment')
+        sides = [self._signed_amounts(items, column, sign, totals, fields=fields)
+                 for column, sign in ((target_column, 1), (source_column, -1))]
+        sides = [side.query.sql_with_params() for side in sides]
+
+        table = quote(self.model._meta.db_table)
+        sql = (
+            "SELECT {table}.*, running.{party}, running.{change}, running.{balance} FROM ("
+            "SELECT {id}, {party}, {change}, "
+            "SUM({change}) OVER (PARTITION BY {party} ORDER BY {order_moment}, {id}) AS {balance} "
+            "FROM ({union}) signed_amounts"
+            ") running INNER JOIN {table} ON {table}.{id} = running.{id} "
+            "ORDER BY running.{party}, {table}.{order_moment}, {table}.{id}"
+        ).format(
+            table=table,
+            id=quote('id'),
+            party=quote('party'),
+            change=quote('change'),
+            balance=quote('balance'),
+            order_moment=quote('order_moment'),
+            union=" UNION ALL ".join(sql for sql, _ in sides),
+        )
+        params = tuple(param for _, side_params in sides for param in side_params)
+        return self.model.objects.db_manager(self.db).raw(sql, params)
+
 
 class TransactionQuerySet(AbstractTransactionQuerySet):
     """Queryset for Transactions (both Fixed and Pending) Model."""
@@ -108,150 +205,35 @@ class TransactionQuerySet(AbstractTransactionQuerySet):
                                       self.target_association_column,
                                       output_name=output_name)
 
-    def compute_user_balance(self, user):
-        return self._compute_balance(user, self.source_user_column, self.target_user_column)
-
-    def compute_association_balance(self, association):
-        return self._compute_balance(association, self.source_association_column, self.target_association_column)
+    def annotate_grouped_user_balance(self, totals, users=User.objects.all()):
+        return self._annotate_grouped_balance(users, self.source_user_column, self.target_user_column, totals)
 
+    def annotate_grouped_association_balance(self, totals, associations=Association.objects.all()):
+        return self._annotate_grouped_balance(associations,
+                                              self.source_association_column,
+                                              self.target_association_column,
+                                              totals)
 
-class PendingTransactionQuerySet(TransactionQuerySet):
-    def get_expired_transactions(self):
-        """Returns all transactions that are expired and should be moved to Fixed Transactions."""
-        return self.filter(confirm_moment__lte=timezone.now())
-
+    def running_user_balance(self, users):
+        return self._running_balance(users, self.source_user_column, self.target_user_column)
 
-class DiningTransactionQuerySet(AbstractTransactionQuerySet):
-    """Queryset for the DiningTransaction, uses special implementation to 'imitate' a working database model."""
-    dining_identifier = "DINING"
+    def running_association_balance(self, associations):
+        return self._running_balance(associations, self.source_association_column, self.target_association_column)
 
     def compute_user_balance(self, user):
-        # Select all entries in the pending dininglists, filter on the intended user in that dining list
-        entries = DiningEntry.objects.filter(dining_list__pendingdininglisttracker__isnull=False)
-        entries = entries.filter(user=user)
-
-        # compute the total costs of the dining list
-        entries = entries.aggregate(amount_sum=Coalesce(Sum('dining_list__kitchen_cost'), Value(0)))
-
-        return -entries['amount_sum']
+        return self._compute_balance(user, self.source_user_column, self.target_user_column)
 
     def compute_association_balance(self, association):
-        # associations can not pay for dining lists
-        return 0
-
-    @classmethod
-    def annotate_user_balance(cls, users=User.objects.all(), output_name="balance"):
-        """Annotates the user balance behind all the users.
-
-        :param users: The users which need their balance calculated
-        :param output_name: The name of the column for the balance
-        :return: The users with 'balance' annotated
-        """
-        # Select all entries in the pending dininglists, filter on the intended user in that dining list
-        entries = DiningEntry.objects.filter(dining_list__pendingdininglisttracker__isnull=False)
-        entries = entries.annotate(kitch_cost=F('dining_list__kitchen_cost'))
-
-        target_sum_qs = entries.filter(user=OuterRef('pk'))
-        target_sum_qs = target_sum_qs.values('user')
-        target_sum_qs = target_sum_qs.annotate(total_cost=Coalesce(Sum('kitch_cost'), Value(0)))
-        target_sum_qs = target_sum_qs.values('total_cost')
-        target_sum_qs = Coalesce(Subquery(target_sum_qs), Value(0))
-
-        users = users.annotate(**{output_name: - Cast(target_sum_qs, models.FloatField())})
-
-        # DIT HEEFT ME ZO VEEL MEER GEDOE GEGEVEN AAARGH NIET NORMAAL
-        # Uiteindelijk gefixed met de Cast, daar zat het probleem, maar GVD dit was een zeer frustrerend stukje code
-        # Dus ik claim hier even mijn credit
-        # Wouter
-
-        return users
-
-    @classmethod
-    def annotate_association_balance(cls, associations=Association.objects.all(), output_name="balance"):
-        return associations.annotate(**{output_name: -Value(0.00, output_field=models.FloatField())})
-
-    @staticmethod
-    def _filter_entries(entries, user=None, dining_list=None) -> QuerySet:
-        """Filters the Dining Entries on the given users and/or dining lists.
-
-        :param entries: The dining entries model
-        :param user: The user(s) that needs to be kept in (can be single instance or query)
-        :param dining_list: The dining_list to be kept in (can be single instance or query)
-        """
-        if user:
-            if type(user) is QuerySet:
-                # Filter for the given set of users
-                entries = entries.filter(user__id__in=user)
-            else:
-                # Filter for the given user
-                entries = entries.filter(user=user)
-
-        if dining_list:
-            if type(dining_list) is QuerySet:
-                # Filter for the given set of users
-                entries = entries.filter(dining_list__id__in=dining_list)
-            else:
-                # Filter for the given user
-                entries = entries.filter(dining_list=dining_list)
-
-        return entries
+        return self._compute_balance(association, self.source_association_column, self.target_association_column)
 
-    @classmethod
-    def generate_queryset(cls, user=None, dining_list=None):
-        """Generates a query for all the Pending Dining Transactions.
 
-        These can not be taken directly from the database as storing it has
-        been done elsewhere (indirectly through DiningEntry).
+class PendingTransactionQuerySet(TransactionQuerySet):
+    def get_expired_transactions(self, moment=None):
+        """Returns all transactions that are expired and should be finalised.
 
-        :param user: The user(s) that needs to be part of the set. Can be single instance or Query of instances
-        :param dining_list: The dining list(s) that needs to be part of the set. Can be single instance or Query of instances
-        :return: The queryset of PendingDiningTransactions
-        """
-        # Select all entries in the pending dininglists
-        entries = DiningEntry.objects.filter(dining_list__pendingdininglisttracker__isnull=False)
-        entries = DiningTransactionQuerySet._filter_entries(entries, user=user, dining_list=dining_list)
-
-        # Rename the user parameter and merge contents (user entries on each dining list)
-        entries = entries.annotate(source_user=F('user'))
-        entries = entries.values('dining_list', 'source_user')
-
-        # annotate empty association object
-        entries = entries.annotate(source_association=Value(None, output_field=models.IntegerField()))
-
-        # compute the total costs
-        entries = entries.annotate(amount=Sum('dining_list__kitchen_cost'))
-
-        # add the residual data
-        entries = entries.annotate(target_user=Value(None, output_field=models.IntegerField()))
-        entries = entries.annotate(target_association=Value(None, output_field=models.IntegerField()))
-        entries = entries.annotate(order_moment=F('dining_list__sign_up_deadline'))
-        entries = entries.annotate(confirm_moment=F('dining_list__sign_up_deadline'))
-        entries = entries.annotate(description=Value(cls.dining_identifier, output_field=models.CharField()))
-
-        # Treat the queryset as a queryset  from the given class
-        from creditmanagement.models import PendingDiningTransaction
-        return cls.set_queryset_to_class_type(entries, PendingDiningTransaction)
-
-    @staticmethod
-    def set_queryset_to_class_type(qs, class_name):
-        """Adjusts the queryset to the given class type.
-
-        :param qs: the queryset
-        :param class_name: the class name of the items in the queryset
-        :return: the new queryset with the contents treated as the given class type
+        :param moment: The moment at which the transactions need to be expired, defaults to now
         """
-        # Below code heavily inspired by the _combinator_query method in the QuerySet
-        # Current implementation relies on an empty set of the class being merged with the new contents while
-        # not keeping the old query (which is empty)
-
-        # Clone the query to inherit the select list and everything
-        new_qs = DiningTransactionQuerySet(model=class_name)
-        # Clear limits and ordering so they can be reapplied
-        new_qs.query.clear_ordering(True)
-        new_qs.query.clear_limits()
-        new_qs.query.combined_queries = tuple([qs.query])
-        new_qs.query.combinator = 'union'
-        return new_qs
+        return self.filter(confirm_moment__lte=moment or timezone.now())
 
 
 class PendingDiningTrackerQuerySet(models.QuerySet):
@@ -1,8 +1,12 @@
-from django.db.models.signals import post_save
+from django.db.models import Count
+from django.db.models.signals import post_save, pre_save, post_delete, pre_delete
 from django.dispatch import receiver
 
-from creditmanagement.models import PendingDiningListTracker
-from dining.models import DiningList
+from creditmanagement import balance_cache
+from creditmanagement.models import PendingDiningListTracker, FixedTransaction, PendingTransaction, UserCredit, \
+    AssociationCredit, AbstractTransaction, PendingDiningTransaction
+from dining.models import DiningList, DiningEntry, DiningEntryUser, DiningEntryExternal
+from userdetails.models import User, Association
 
 
 @receiver(post_save, sender=DiningList)
@@ -10,3 +14,164 @@ def create_pending_dining_list_tracker(sender, instance=False, created=False, **
     """Creates a new PendingDiningListTracker when a new dining list is added."""
     if created:
         PendingDiningListTracker(dining_list=instance).save()
+
+
+# Materialised balances
+#
+# The receivers below keep UserCredit and AssociationCredit up to date. Changes that bypass the model signals
+# (e.g. QuerySet.update()) are not tracked, use the reconcile_balances command to repair the balances afterwards.
+
+
+@receiver(post_save, sender=User)
+def create_user_credit(sender, instance=False, created=False, raw=False, **kwargs):
+    if created and not raw:
+        # Pass the id so that the (soon outdated) credit is not cached on the instance
+        UserCredit.objects.get_or_create(user_id=instance.pk)
+        # The id might have been used before (e.g. after a rollback)
+        balance_cache.invalidate(user_ids=[instance.pk])
+
+
+@receiver(post_save, sender=Association)
+def create_association_credit(sender, instance=False, created=False, raw=False, **kwargs):
+    if created and not raw:
+        AssociationCredit.objects.get_or_create(association_id=instance.pk)
+        balance_cache.invalidate(association_ids=[instance.pk])
+
+
+@receiver(post_save, sender=FixedTransaction)
+def apply_fixed_transaction(sender, instance=False, created=False, **kwargs):
+    # Fixed transactions are immutable, so they only need to be processed on creation
+    if created:
+        AbstractTransaction.update_credits(instance.get_credit_values(), fixed=True)
+
+
+@receiver(post_delete, sender=FixedTransaction)
+def revert_fixed_transaction(sender, instance=False, **kwargs):
+    AbstractTransaction.update_credits(instance.get_credit_values(), sign=-1, fixed=True)
+
+
+@receiver(pre_save, sender=PendingTransaction)
+@receiver(pre_save, sender=PendingDiningTransaction)
+def store_pending_transaction_state(sender, instance=False, **kwargs):
+    """Stores the saved state of the transaction so that it can be reverted when it is changed."""
+    instance._credit_values_old = None
+    if instance.pk:
+        instance._credit_values_old = sender.objects.filter(pk=instance.pk).values(
+            *AbstractTransaction.credit_fields).first()
+
+
+@receiver(post_save, sender=PendingTransaction)
+@receiver(post_save, sender=PendingDiningTransaction)
+def apply_pending_transaction(sender, instance=False, **kwargs):
+    old_values = getattr(instance, '_credit_values_old', None)
+    if old_values:
+        AbstractTransaction.update_credits(old_values, sign=-1)
+    AbstractTransaction.update_credits(instance.get_credit_values())
+
+
+@receiver(post_delete, sender=PendingTransaction)
+@receiver(post_delete, sender=PendingDiningTransaction)
+def revert_pending_transaction(sender, instance=False, **kwargs):
+    AbstractTransaction.update_credits(instance.get_credit_values(), sign=-1)
+
+
+# Kitchen costs
+#
+# The kitchen cost of every entry on a dining list that is not finalised yet is charged by a PendingDiningTransaction,
+# which updates the balances through the receivers above.
+
+
+@receiver(pre_save, sender=DiningEntry)
+@receiver(pre_save, sender=DiningEntryUser)
+@receiver(pre_save, sender=DiningEntryExternal)
+def store_dining_entry_state(sender, instance=False, **kwargs):
+    instance._credit_values_old = None
+    if instance.pk:
+        instance._credit_values_old = DiningEntry.objects.filter(pk=instance.pk).values(
+            'user_id', 'dining_list_id').first()
+
+
+@receiver(post_save, sender=DiningEntry)
+@receiver(post_save, sender=DiningEntryUser)
+@receiver(post_save, sender=DiningEntryExternal)
+def charge_dining_entry(sender, instance=False, **kwargs):
+    old_values = getattr(instance, '_credit_values_old', None)
+    if old_values:
+        if old_values['user_id'] == instance.user_id and old_values['dining_list_id'] == instance.dining_list_id:
+            # Nothing changed that influences the balance (e.g. has_paid was updated)
+            return
+        # Replace the charge of the old dining list or user
+        for pending in PendingDiningTransaction.objects.filter(dining_entry_id=instance.pk):
+            pending.delete()
+    PendingDiningTransaction.create_for_entry(instance)
+
+
+@receiver(pre_delete, sender=DiningEntry)
+@receiver(pre_delete, sender=DiningEntryUser)
+@receiver(pre_delete, sender=DiningEntryExternal)
+def refund_dining_entry(sender, instance=False, **kwargs):
+    # Before the deletion, as the link of the transactions to the entry is cleared on deletion
+    for pending in PendingDiningTransaction.objects.filter(dining_entry_id=instance.pk):
+        pending.delete()
+
+
+@receiver(pre_save, sender=DiningList)
+def store_dining_list_state(sender, instance=False, **kwargs):
+    instance._kitchen_cost_old = None
+    if instance.pk:
+        instance._kitchen_cost_old = sender.objects.filter(pk=instance.pk).values_list(
+            'kitchen_cost', flat=True).first()
+
+
+@receiver(post_save, sender=DiningList)
+def apply_kitchen_cost_change(sender, instance=False, **kwargs):
+    old_cost = getattr(instance, '_kitchen_cost_old', None)
+    if old_cost is None or old_cost == instance.kitchen_cost:
+        return
+    pending = PendingDiningTransaction.objects.filter(dining_entry__dining_list=instance)
+    # A single UPDATE instead of saving every transaction, so the balances are changed here
+    difference = instance.kitchen_cost - old_cost
+    for row in pending.order_by().values('source_user_id').annotate(count=Count('id')):
+        UserCredit.apply_change(row['source_user_id'], -difference * row['count'], 0)
+    pending.update(amount=instance.kitchen_cost)
+
+
+@receiver(post_save, sender=PendingDiningListTracker)
+def charge_pending_dining_list(sender, instance=False, created=False, **kwargs):
+    if created:
+        for entry in DiningEntry.objects.filter(dining_list_id=instance.dining_list_id):
+            PendingDiningTransaction.create_for_entry(entry)
+
+
+@receiver(post_delete, sender=PendingDiningListTracker)
+def refund_pending_dining_list(sender, instance=False, **kwargs):
+    """Refunds the kitchen costs that are still pending, finalised costs are no longer pending."""
+    for pending in PendingDiningTransaction.objects.filter(dining_entry__dining_list_id=instance.dining_list_id):
+        pending.delete()
+
+
+# Balance cache invalidation
+
+
+@receiver(post_save, sender=FixedTransaction)
+@receiver(post_delete, sender=FixedTransaction)
+@receiver(post_save, sender=PendingTransaction)
+@receiver(post_delete, sender=PendingTransaction)
+@receiver(post_save, sender=PendingDiningTransaction)
+@receiver(post_delete, sender=PendingDiningTransaction)
+def invalidate_transaction_balances(sender, instance=False, **kwargs):
+    user_ids = [instance.source_user_id, instance.target_user_id]
+    association_ids = [instance.source_association_id, instance.target_association_id]
+    old_values = getattr(instance, '_credit_values_old', None)
+    if old_values:
+        user_ids += [old_values['source_user_id'], old_values['target_user_id']]
+        association_ids += [old_values['source_association_id'], old_values['target_association_id']]
+    balance_cache.invalidate(user_ids=user_ids, association_ids=association_ids)
+
+
+@receiver(post_save, sender=DiningList)
+def invalidate_dining_list_balances(sender, instance=False, created=False, **kwargs):
+    # Only a kitchen cost change influences the balances of the diners
+    old_cost = getattr(instance, '_kitchen_cost_old', None)
+    if not created and old_cost != instance.kitchen_cost:
+        balance_cache.invalidate(user_ids=instance.dining_entries.values_list('user_id', flat=True))
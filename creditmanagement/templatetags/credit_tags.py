@@ -1,6 +1,9 @@
 from django import template
 from django.utils.safestring import mark_safe
 
+from creditmanagement import balance_cache
+from userdetails.models import User
+
 register = template.Library()
 
 
@@ -16,3 +19,11 @@ def euro(value):
 def negate(value):
     """Negates given numeric value."""
     return -value
+
+
+@register.filter
+def balance(party):
+    """Returns the (cached) balance of the given user or association."""
+    if isinstance(party, User):
+        return balance_cache.get_user_balance(party)
+    return balance_cache.get_association_balance(party)
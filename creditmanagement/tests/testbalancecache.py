@@ -0,0 +1,70 @@
+from datetime import date, datetime
+from decimal import Decimal
+from unittest.mock import patch
+
+from django.core.cache import cache
+from django.test import TransactionTestCase
+from django.utils import timezone
+
+from creditmanagement import balance_cache
+from creditmanagement.models import FixedTransaction
+from dining.models import DiningList, DiningEntryUser
+from userdetails.models import User, Association
+
+
+class BalanceCacheTestCase(TransactionTestCase):
+    """Uses TransactionTestCase because balances are only cached after the transaction commits."""
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('ankie', email='ankie@universe.cat')
+        self.association = Association.objects.create(name='C&M')
+
+    def tearDown(self):
+        cache.clear()
+
+    def test_hit_and_miss(self):
+        self.assertEqual(Decimal('0.00'), balance_cache.get_user_balance(self.user))
+        self.assertEqual(Decimal('0.00'), balance_cache.get_user_balance(self.user))
+        stats = balance_cache.get_statistics()
+        self.assertEqual(1, stats['hits'])
+        self.assertEqual(1, stats['misses'])
+        self.assertEqual(0.5, stats['hit_ratio'])
+
+    def test_cached_lookup_has_no_queries(self):
+        balance_cache.get_user_balance(self.user)
+        with self.assertNumQueries(0):
+            balance_cache.get_user_balance(self.user)
+
+    def test_invalidate_on_transaction(self):
+        balance_cache.get_user_balance(self.user)
+        balance_cache.get_association_balance(self.association)
+        FixedTransaction.objects.create(source_association=self.association, target_user=self.user,
+                                        amount=Decimal('5.00'))
+        self.assertEqual(Decimal('5.00'), balance_cache.get_user_balance(self.user))
+        self.assertEqual(Decimal('-5.00'), balance_cache.get_association_balance(self.association))
+
+    def test_invalidate_on_dining_entry(self):
+        dining_list = DiningList.objects.create(date=date(2100, 1, 1), association=self.association,
+                                                sign_up_deadline=datetime(2100, 1, 1, tzinfo=timezone.utc))
+        balance_cache.get_user_balance(self.user)
+        entry = DiningEntryUser.objects.create(dining_list=dining_list, user=self.user, created_by=self.user)
+        self.assertEqual(Decimal('-0.50'), balance_cache.get_user_balance(self.user))
+
+        dining_list.kitchen_cost = Decimal('1.00')
+        dining_list.save()
+        self.assertEqual(Decimal('-1.00'), balance_cache.get_user_balance(self.user))
+
+        entry.delete()
+        self.assertEqual(Decimal('0.00'), balance_cache.get_user_balance(self.user))
+
+    def test_late_write_after_invalidation(self):
+        # A request reads the balance while another request commits a transaction
+        with patch('creditmanagement.balance_cache.transaction.on_commit') as on_commit:
+            self.assertEqual(Decimal('0.00'), balance_cache.get_user_balance(self.user))
+        write_back, = on_commit.call_args[0]
+        FixedTransaction.objects.create(source_association=self.association, target_user=self.user,
+                                        amount=Decimal('5.00'))
+        # The old balance is cached after the invalidation
+        write_back()
+        self.assertEqual(Decimal('5.00'), balance_cache.get_user_balance(self.user))
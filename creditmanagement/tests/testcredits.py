@@ -0,0 +1,296 @@
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from io import StringIO
+
+from django.core.management import call_command, CommandError
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from creditmanagement.models import FixedTransaction, PendingTransaction, PendingDiningListTracker, UserCredit, \
+    AssociationCredit, AbstractTransaction, Transaction, BalanceCheckpoint
+from dining.models import DiningList, DiningEntryUser, DiningEntryExternal
+from userdetails.models import User, Association
+
+
+class CreditTestCase(TestCase):
+    """Tests that the materialised balances follow the transaction history."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('ankie', email='ankie@universe.cat')
+        cls.user2 = User.objects.create_user('noortje', email='noortje@universe.cat')
+        cls.association = Association.objects.create(name='C&M')
+
+    def setUp(self):
+        self.dining_list = DiningList.objects.create(date=date(2100, 1, 1), association=self.association,
+                                                     sign_up_deadline=datetime(2100, 1, 1, tzinfo=timezone.utc))
+
+    def assert_credit(self, party, balance, balance_fixed):
+        credit_model = UserCredit if isinstance(party, User) else AssociationCredit
+        credit = credit_model.objects.get(pk=party.pk)
+        self.assertEqual(Decimal(balance), credit.balance)
+        self.assertEqual(Decimal(balance_fixed), credit.balance_fixed)
+
+    def assert_consistent(self):
+        out = StringIO()
+        call_command('reconcile_balances', stdout=out)
+        self.assertIn('All balances are consistent', out.getvalue())
+
+    def test_rows_created(self):
+        self.assert_credit(self.user, '0.00', '0.00')
+        self.assert_credit(self.association, '0.00', '0.00')
+
+    def test_fixed_transaction(self):
+        FixedTransaction.objects.create(source_association=self.association, target_user=self.user,
+                                        amount=Decimal('10.00'))
+        self.assert_credit(self.user, '10.00', '10.00')
+        self.assert_credit(self.association, '-10.00', '-10.00')
+        self.assert_consistent()
+
+    def test_pending_transaction_change_and_finalise(self):
+        pending = PendingTransaction.objects.create(source_user=self.user, target_user=self.user2,
+                                                    amount=Decimal('2.00'))
+        self.assert_credit(self.user, '-2.00', '0.00')
+        pending.amount = Decimal('3.00')
+        pending.target_user = None
+        pending.target_association = self.association
+        pending.save()
+        self.assert_credit(self.user, '-3.00', '0.00')
+        self.assert_credit(self.user2, '0.00', '0.00')
+        self.assert_credit(self.association, '3.00', '0.00')
+
+        pending.finalise()
+        self.assert_credit(self.user, '-3.00', '-3.00')
+        self.assert_credit(self.association, '3.00', '3.00')
+        self.assert_consistent()
+
+    def test_dining_entries(self):
+        entry = DiningEntryUser.objects.create(dining_list=self.dining_list, user=self.user, created_by=self.user)
+        DiningEntryExternal.objects.create(dining_list=self.dining_list, user=self.user, created_by=self.user,
+                                           name='Guest')
+        self.assert_credit(self.user, '-1.00', '0.00')
+
+        # Updating non-financial fields does not charge again
+        entry.has_paid = True
+        entry.save()
+        self.assert_credit(self.user, '-1.00', '0.00')
+
+        entry.delete()
+        self.assert_credit(self.user, '-0.50', '0.00')
+        self.assert_consistent()
+
+    def test_kitchen_cost_change(self):
+        DiningEntryUser.objects.create(dining_list=self.dining_list, user=self.user, created_by=self.user)
+        DiningEntryUser.objects.create(dining_list=self.dining_list, user=self.user2, created_by=self.user2)
+        self.dining_list.kitchen_cost = Decimal('0.75')
+        self.dining_list.save()
+        self.assert_credit(self.user, '-0.75', '0.00')
+        self.assert_credit(self.user2, '-0.75', '0.00')
+        self.assert_consistent()
+
+    def test_dining_list_finalise(self):
+        DiningEntryUser.objects.create(dining_list=self.dining_list, user=self.user, created_by=self.user)
+        PendingDiningListTracker.objects.get(dining_list=self.dining_list).finalise()
+        self.assert_credit(self.user, '-0.50', '-0.50')
+        self.assert_consistent()
+
+    def test_reconcile_rebuild(self):
+        FixedTransaction.objects.create(source_user=self.user, amount=Decimal('4.00'),
+                                        order_moment=timezone.now() - timedelta(days=1))
+        UserCredit.objects.filter(user=self.user).update(balance=Decimal('100.00'))
+
+        out = StringIO()
+        call_command('reconcile_balances', stdout=out)
+        self.assertIn('1 balances are inconsistent', out.getvalue())
+
+        call_command('reconcile_balances', '--rebuild', stdout=StringIO())
+        self.assert_credit(self.user, '-4.00', '-4.00')
+        self.assert_consistent()
+
+
+class TransactionHistoryTestCase(TestCase):
+    """Tests the transaction history that combines the ledger and the pending dining costs."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('ankie', email='ankie@universe.cat')
+        cls.association = Association.objects.create(name='C&M')
+        FixedTransaction.objects.create(source_association=cls.association, target_user=cls.user,
+                                        amount=Decimal('10.00'))
+        PendingTransaction.objects.create(source_user=cls.user, target_association=cls.association,
+                                          amount=Decimal('2.00'))
+        dining_list = DiningList.objects.create(date=date(2100, 1, 1), association=cls.association,
+                                                sign_up_deadline=datetime(2100, 1, 1, tzinfo=timezone.utc),
+                                                kitchen_cost=Decimal('0.50'))
+        DiningEntryUser.objects.create(dining_list=dining_list, user=cls.user, created_by=cls.user)
+
+    def test_user_history(self):
+        transactions = AbstractTransaction.get_all_transactions(user=self.user).order_by('-order_moment')
+        self.assertEqual(sorted(t.amount for t in transactions), [Decimal('0.50'), Decimal('2.00'), Decimal('10.00')])
+
+    def test_association_history_is_single_query(self):
+        transactions = AbstractTransaction.get_all_transactions(association=self.association)
+        # Associations do not pay for dining lists, so only the ledger is needed
+        self.assertIsNone(transactions.query.combinator)
+        self.assertEqual({t.state for t in transactions}, {Transaction.FIXED, Transaction.PENDING})
+
+
+class BalanceEngineTestCase(TestCase):
+    """Tests that the grouped balance engine computes the same balances as the subquery engine."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('ankie', email='ankie@universe.cat')
+        cls.user2 = User.objects.create_user('noortje', email='noortje@universe.cat')
+        cls.user3 = User.objects.create_user('jerry', email='jerry@universe.cat')
+        cls.association = Association.objects.create(name='C&M', slug='cm')
+        cls.association2 = Association.objects.create(name='Q', slug='q')
+        FixedTransaction.objects.create(source_association=cls.association, target_user=cls.user,
+                                        amount=Decimal('10.00'))
+        FixedTransaction.objects.create(source_user=cls.user, target_user=cls.user2, amount=Decimal('1.25'))
+        PendingTransaction.objects.create(source_user=cls.user2, target_association=cls.association2,
+                                          amount=Decimal('2.00'))
+        dining_list = DiningList.objects.create(date=date(2100, 1, 1), association=cls.association,
+                                                sign_up_deadline=datetime(2100, 1, 1, tzinfo=timezone.utc))
+        DiningEntryUser.objects.create(dining_list=dining_list, user=cls.user, created_by=cls.user)
+
+    def get_balances(self, engine, **kwargs):
+        with override_settings(BALANCE_ENGINE=engine):
+            return {item.pk: (round(Decimal(item.balance), 2), round(Decimal(item.balance_fixed), 2))
+                    for item in AbstractTransaction.annotate_balance(**kwargs)}
+
+    def test_user_balances(self):
+        balances = self.get_balances('grouped', users=User.objects.all())
+        self.assertEqual(balances, self.get_balances('subquery', users=User.objects.all()))
+        self.assertEqual(balances[self.user.pk], (Decimal('8.25'), Decimal('8.75')))
+        # Users without transactions are included
+        self.assertEqual(balances[self.user3.pk], (Decimal('0.00'), Decimal('0.00')))
+
+    def test_association_balances(self):
+        balances = self.get_balances('grouped', associations=Association.objects.all())
+        self.assertEqual(balances, self.get_balances('subquery', associations=Association.objects.all()))
+        self.assertEqual(balances[self.association2.pk], (Decimal('2.00'), Decimal('0.00')))
+
+    def test_filtered_users(self):
+        balances = self.get_balances('grouped', users=User.objects.filter(pk=self.user2.pk))
+        self.assertEqual(balances, {self.user2.pk: (Decimal('-0.75'), Decimal('1.25'))})
+
+    def test_grouped_is_single_query(self):
+        with override_settings(BALANCE_ENGINE='grouped'):
+            with self.assertNumQueries(1):
+                list(AbstractTransaction.annotate_balance(users=User.objects.all()))
+
+    def test_reconcile(self):
+        with override_settings(BALANCE_ENGINE='grouped'):
+            out = StringIO()
+            call_command('reconcile_balances', stdout=out)
+            self.assertIn('All balances are consistent', out.getvalue())
+
+
+class BalanceCheckpointTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('ankie', email='ankie@universe.cat')
+        cls.user2 = User.objects.create_user('noortje', email='noortje@universe.cat')
+        cls.association = Association.objects.create(name='C&M')
+        cls.day1 = timezone.now() - timedelta(days=3)
+        cls.day2 = timezone.now() - timedelta(days=2)
+
+    def create_fixed(self, confirm_moment, **kwargs):
+        fixed = FixedTransaction.objects.create(**kwargs)
+        # Fixed transactions are confirmed on creation, move them to the past
+        FixedTransaction.objects.filter(pk=fixed.pk).update(confirm_moment=confirm_moment)
+
+    def test_checkpoints(self):
+        self.create_fixed(self.day1 - timedelta(hours=1), source_association=self.association, target_user=self.user,
+                          amount=Decimal('10.00'))
+        self.assertEqual(BalanceCheckpoint.create_checkpoints(self.day1), 2)
+        self.create_fixed(self.day2 - timedelta(hours=1), source_user=self.user, target_user=self.user2,
+                          amount=Decimal('3.00'))
+        # The association had no transactions since the previous checkpoint
+        self.assertEqual(BalanceCheckpoint.create_checkpoints(self.day2), 2)
+        self.create_fixed(timezone.now(), source_user=self.user, target_association=self.association,
+                          amount=Decimal('1.50'))
+
+        self.assertEqual(BalanceCheckpoint.objects.get(user=self.user, as_of=self.day2).balance, Decimal('7.00'))
+        self.assertEqual(FixedTransaction.get_user_balance(self.user), Decimal('5.50'))
+        self.assertEqual(FixedTransaction.get_user_balance(self.user2), Decimal('3.00'))
+        self.assertEqual(FixedTransaction.get_association_balance(self.association), Decimal('-8.50'))
+        self.assertEqual(BalanceCheckpoint.get_mismatches(), [])
+
+    def test_only_after_latest(self):
+        self.create_fixed(self.day1 - timedelta(hours=1), source_user=self.user, amount=Decimal('4.00'))
+        BalanceCheckpoint.create_checkpoints(self.day2)
+        with self.assertRaises(ValueError):
+            BalanceCheckpoint.create_checkpoints(self.day1)
+
+    def test_reconcile_deletes_incorrect_checkpoints(self):
+        self.create_fixed(self.day1 - timedelta(hours=1), source_user=self.user, amount=Decimal('4.00'))
+        BalanceCheckpoint.create_checkpoints(self.day1)
+        BalanceCheckpoint.objects.filter(user=self.user).update(balance=Decimal('100.00'))
+
+        out = StringIO()
+        call_command('reconcile_balances', stdout=out)
+        self.assertIn('1 balances are inconsistent', out.getvalue())
+        call_command('reconcile_balances', '--rebuild', stdout=StringIO())
+        self.assertFalse(BalanceCheckpoint.objects.exists())
+
+    def test_command(self):
+        self.create_fixed(self.day1, source_user=self.user, amount=Decimal('4.00'))
+        call_command('create_balance_checkpoints', stdout=StringIO())
+        self.assertEqual(BalanceCheckpoint.objects.get(user=self.user).balance, Decimal('-4.00'))
+        with self.assertRaises(CommandError):
+            call_command('create_balance_checkpoints', '--date', '2100-01-01', stdout=StringIO())
+
+
+class RunningBalanceTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('ankie', email='ankie@universe.cat')
+        cls.user2 = User.objects.create_user('noortje', email='noortje@universe.cat')
+        cls.association = Association.objects.create(name='C&M')
+        start = timezone.now() - timedelta(days=10)
+        cls.moments = [start + timedelta(days=i) for i in range(4)]
+        for moment, kwargs in zip(cls.moments, [
+            {'source_association': cls.association, 'target_user': cls.user, 'amount': Decimal('10.00')},
+            {'source_user': cls.user, 'target_user': cls.user2, 'amount': Decimal('12.00')},
+            {'source_association': cls.association, 'target_user': cls.user, 'amount': Decimal('5.00')},
+            {'source_user': cls.user, 'target_association': cls.association, 'amount': Decimal('4.00')},
+        ]):
+            FixedTransaction.objects.create(order_moment=moment, **kwargs)
+
+    def test_running_balance(self):
+        transactions = FixedTransaction.objects.running_user_balance(User.objects.all())
+        balances = [(t.party, round(Decimal(t.balance), 2)) for t in transactions]
+        self.assertEqual(balances, [
+            (self.user.pk, Decimal('10.00')),
+            (self.user.pk, Decimal('-2.00')),
+            (self.user.pk, Decimal('3.00')),
+            (self.user.pk, Decimal('-1.00')),
+            (self.user2.pk, Decimal('12.00')),
+        ])
+
+    def test_negative_since(self):
+        credits = list(UserCredit.objects.order_by('pk'))
+        with self.assertNumQueries(1):
+            UserCredit.prefetch_negative_since(credits)
+        self.assertEqual(credits[0].negative_since(), self.moments[3])
+        self.assertIsNone(credits[1].negative_since())
+        # Without prefetching
+        self.assertEqual(UserCredit.objects.get(pk=self.user.pk).negative_since(), self.moments[3])
+
+    def test_admin_changelist(self):
+        self.user.is_superuser = True
+        self.user.is_staff = True
+        self.user.save()
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('admin:creditmanagement_usercredit_changelist'))
+        self.assertEqual(response.status_code, 200)
+
+    def test_balance_history_view(self):
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('credits:balance_history'))
+        self.assertEqual([point['balance'] for point in response.json()['balance']],
+                         ['10.00', '-2.00', '3.00', '-1.00'])
+        self.assertEqual(response.json()['balance'][1]['change'], '-12.00')
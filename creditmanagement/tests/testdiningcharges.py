@@ -0,0 +1,144 @@
+from datetime import date, timedelta
+from decimal import Decimal
+from importlib import import_module
+from io import StringIO
+from unittest.mock import patch
+
+from django.apps import apps
+from django.core.management import call_command
+from django.test import TestCase
+from django.utils import timezone
+
+from creditmanagement.models import PendingDiningTransaction, PendingDiningListTracker, FixedTransaction, \
+    UserCredit, Transaction
+from dining.models import DiningList, DiningEntry, DiningEntryUser, DiningEntryExternal
+from userdetails.models import User, Association
+
+
+class DiningChargesTestCase(TestCase):
+    """Tests the kitchen cost charges of the dining entries, see creditmanagement/receivers.py."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('ankie', email='ankie@universe.cat')
+        cls.user2 = User.objects.create_user('noortje', email='noortje@universe.cat')
+        cls.association = Association.objects.create(name='C&M')
+        deadline = timezone.now() + timedelta(days=1)
+        cls.dining_list = DiningList.objects.create(date=date(2123, 1, 4), association=cls.association,
+                                                    sign_up_deadline=deadline, kitchen_cost=Decimal('0.50'))
+        cls.other_list = DiningList.objects.create(date=date(2123, 1, 5), association=cls.association,
+                                                   sign_up_deadline=deadline, kitchen_cost=Decimal('0.75'))
+
+    def get_balance(self, user):
+        return UserCredit.objects.get(user=user).balance
+
+    def assert_consistent(self):
+        out = StringIO()
+        call_command('reconcile_balances', stdout=out)
+        self.assertIn('All balances are consistent', out.getvalue())
+
+    def test_add_entry(self):
+        entry = DiningEntryUser.objects.create(dining_list=self.dining_list, user=self.user, created_by=self.user)
+        pending = PendingDiningTransaction.objects.get()
+        self.assertEqual(pending.dining_entry_id, entry.pk)
+        self.assertEqual(pending.source_user, self.user)
+        self.assertEqual(pending.amount, Decimal('0.50'))
+        self.assertEqual(self.get_balance(self.user), Decimal('-0.50'))
+
+        # A guest is charged to the user that added the guest
+        DiningEntryExternal.objects.create(dining_list=self.dining_list, user=self.user, created_by=self.user,
+                                           name='Guest')
+        self.assertEqual(PendingDiningTransaction.objects.count(), 2)
+        self.assertEqual(self.get_balance(self.user), Decimal('-1.00'))
+        self.assert_consistent()
+
+    def test_unrelated_change(self):
+        entry = DiningEntryUser.objects.create(dining_list=self.dining_list, user=self.user, created_by=self.user)
+        pending = PendingDiningTransaction.objects.get()
+        entry.has_paid = True
+        entry.save()
+        self.assertEqual(PendingDiningTransaction.objects.get(), pending)
+        self.assertEqual(self.get_balance(self.user), Decimal('-0.50'))
+
+    def test_move_entry(self):
+        entry = DiningEntryUser.objects.create(dining_list=self.dining_list, user=self.user, created_by=self.user)
+        old = PendingDiningTransaction.objects.get()
+
+        entry.user = self.user2
+        entry.save()
+        pending = PendingDiningTransaction.objects.get()
+        self.assertNotEqual(pending.pk, old.pk)
+        self.assertEqual((pending.source_user, pending.amount), (self.user2, Decimal('0.50')))
+        self.assertEqual(self.get_balance(self.user), Decimal('0.00'))
+        self.assertEqual(self.get_balance(self.user2), Decimal('-0.50'))
+
+        entry.dining_list = self.other_list
+        entry.save()
+        pending = PendingDiningTransaction.objects.get()
+        self.assertEqual((pending.dining_entry_id, pending.amount), (entry.pk, Decimal('0.75')))
+        self.assertEqual(self.get_balance(self.user2), Decimal('-0.75'))
+        self.assert_consistent()
+
+    def test_delete_entry(self):
+        entry = DiningEntryUser.objects.create(dining_list=self.dining_list, user=self.user, created_by=self.user)
+        # Deleted through the base model, as the views do
+        DiningEntry.objects.get(pk=entry.pk).delete()
+        self.assertFalse(Transaction.objects.exists())
+        self.assertEqual(self.get_balance(self.user), Decimal('0.00'))
+        self.assert_consistent()
+
+    def test_kitchen_cost_change(self):
+        for user in (self.user, self.user, self.user2):
+            DiningEntryUser.objects.create(dining_list=self.dining_list, user=user, created_by=user)
+        DiningEntryUser.objects.create(dining_list=self.other_list, user=self.user, created_by=self.user)
+
+        self.dining_list.kitchen_cost = Decimal('1.00')
+        with patch.object(UserCredit, 'apply_change', wraps=UserCredit.apply_change) as apply_change:
+            self.dining_list.save()
+        # Once per user
+        self.assertEqual(apply_change.call_count, 2)
+
+        amounts = PendingDiningTransaction.objects.filter(dining_entry__dining_list=self.dining_list) \
+            .values_list('amount', flat=True)
+        self.assertEqual(list(amounts), [Decimal('1.00')] * 3)
+        self.assertEqual(self.get_balance(self.user), Decimal('-2.75'))
+        self.assertEqual(self.get_balance(self.user2), Decimal('-1.00'))
+        self.assert_consistent()
+
+    def test_finalise(self):
+        DiningEntryUser.objects.create(dining_list=self.dining_list, user=self.user, created_by=self.user)
+        DiningEntryUser.objects.create(dining_list=self.dining_list, user=self.user2, created_by=self.user2)
+        DiningEntryUser.objects.create(dining_list=self.other_list, user=self.user, created_by=self.user)
+
+        trackers = PendingDiningListTracker.objects.filter(dining_list=self.dining_list)
+        result = PendingDiningListTracker.finalise_all(trackers)
+        self.assertEqual((result.count, result.amount), (2, Decimal('1.00')))
+        self.assertEqual(FixedTransaction.objects.filter(dining_entry__dining_list=self.dining_list).count(), 2)
+        self.assertEqual(PendingDiningTransaction.objects.count(), 1)
+        self.assertFalse(trackers.exists())
+
+        # The balances are not charged again
+        self.assertEqual(self.get_balance(self.user), Decimal('-1.25'))
+        self.assertEqual(self.get_balance(self.user2), Decimal('-0.50'))
+        credit = UserCredit.objects.get(user=self.user2)
+        self.assertEqual(credit.balance_fixed, Decimal('-0.50'))
+        self.assertEqual(PendingDiningListTracker.finalise_all(trackers).count, 0)
+        self.assert_consistent()
+
+    def test_backfill_migration(self):
+        """The migration charges the entries of the pending dining lists, without changing the balances."""
+        migration = import_module('creditmanagement.migrations.0013_pending_dining_transactions')
+        DiningEntryUser.objects.create(dining_list=self.dining_list, user=self.user, created_by=self.user)
+        DiningEntryUser.objects.create(dining_list=self.other_list, user=self.user, created_by=self.user)
+        self.other_list.pendingdininglisttracker.delete()
+        # Before the migration the view included the costs, the materialised balance already does
+        Transaction.objects.filter(state=Transaction.PENDING).delete()
+        balance = self.get_balance(self.user)
+
+        migration.create_dining_transactions(apps, None)
+        pending = PendingDiningTransaction.objects.get()
+        self.assertEqual((pending.dining_entry.dining_list, pending.amount), (self.dining_list, Decimal('0.50')))
+        self.assertEqual(self.get_balance(self.user), balance)
+
+        migration.remove_dining_transactions(apps, None)
+        self.assertFalse(PendingDiningTransaction.objects.exists())
@@ -0,0 +1,85 @@
+from datetime import date, timedelta
+from decimal import Decimal
+from io import StringIO
+
+from django.core.management import call_command
+from django.test import TestCase
+from django.utils import timezone
+
+from creditmanagement.models import FixedTransaction, PendingTransaction, PendingDiningListTracker, UserCredit, \
+    AbstractPendingTransaction, Transaction
+from dining.models import DiningList, DiningEntryUser
+from userdetails.models import User, Association
+
+
+class FinalisationTestCase(TestCase):
+    """Tests the bulk finalisation of pending transactions and dining lists."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('ankie', email='ankie@universe.cat')
+        cls.user2 = User.objects.create_user('noortje', email='noortje@universe.cat')
+        cls.association = Association.objects.create(name='C&M')
+
+    def setUp(self):
+        past = timezone.now() - timedelta(days=10)
+        for amount in ('1.00', '2.00', '3.00'):
+            PendingTransaction.objects.create(source_association=self.association, target_user=self.user,
+                                              amount=Decimal(amount), order_moment=past)
+        # Not yet expired
+        PendingTransaction.objects.create(source_user=self.user, target_user=self.user2, amount=Decimal('0.50'),
+                                          confirm_moment=timezone.now() + timedelta(days=1))
+
+        for day in (1, 2):
+            dining_list = DiningList.objects.create(date=date(2000, 1, day), association=self.association,
+                                                    sign_up_deadline=past)
+            DiningEntryUser.objects.create(dining_list=dining_list, user=self.user, created_by=self.user)
+            DiningEntryUser.objects.create(dining_list=dining_list, user=self.user2, created_by=self.user2)
+
+    def assert_consistent(self):
+        out = StringIO()
+        call_command('reconcile_balances', stdout=out)
+        self.assertIn('All balances are consistent', out.getvalue())
+
+    def test_finalise_all_expired(self):
+        balance = UserCredit.objects.get(user=self.user).balance
+        result = AbstractPendingTransaction.finalise_all_expired(batch_size=2)
+
+        # 3 pending transactions and 2 dining lists with 2 diners
+        self.assertEqual(result.count, 7)
+        self.assertEqual(result.amount, Decimal('8.00'))
+        self.assertEqual(PendingTransaction.objects.count(), 1)
+        self.assertFalse(PendingDiningListTracker.objects.exists())
+        self.assertEqual(FixedTransaction.objects.count(), 7)
+
+        credit = UserCredit.objects.get(user=self.user)
+        self.assertEqual(credit.balance, balance)
+        self.assertEqual(credit.balance_fixed, Decimal('5.00'))
+        self.assert_consistent()
+
+    def test_dry_run(self):
+        result = AbstractPendingTransaction.finalise_all_expired(dry_run=True)
+        self.assertEqual(result.count, 7)
+        self.assertEqual(result.amount, Decimal('8.00'))
+        self.assertFalse(FixedTransaction.objects.exists())
+        self.assertEqual(PendingTransaction.objects.count(), 4)
+
+    def test_command(self):
+        out = StringIO()
+        call_command('finalise_transactions', '--batch-size', '1', stdout=out)
+        self.assertIn('Finalised PendingTransaction: 3 transactions with a total of 6.00', out.getvalue())
+        self.assertIn('Finalised PendingDiningTransaction: 4 transactions with a total of 2.00', out.getvalue())
+        self.assert_consistent()
+
+    def test_finalise_changes_state_in_place(self):
+        ids = set(PendingTransaction.objects.get_expired_transactions().values_list('id', flat=True))
+        AbstractPendingTransaction.finalise_all_expired()
+        self.assertTrue(ids <= set(FixedTransaction.objects.values_list('id', flat=True)))
+
+    def test_finalise_single(self):
+        pending = PendingTransaction.objects.get(amount=Decimal('0.50'))
+        fixed = pending.finalise()
+        self.assertEqual(fixed.pk, pending.pk)
+        self.assertEqual(fixed.state, Transaction.FIXED)
+        self.assertEqual(UserCredit.objects.get(user=self.user2).balance_fixed, Decimal('0.50'))
+        self.assert_consistent()
@@ -0,0 +1,119 @@
+import threading
+import time
+from decimal import Decimal
+
+from django.core.exceptions import ValidationError
+from django.db import connection, OperationalError
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+
+from creditmanagement.forms import UserTransactionForm
+from creditmanagement.models import FixedTransaction, PendingTransaction, UserCredit
+from userdetails.models import Association, User
+
+
+class TransferTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('ankie', email='ankie@universe.cat')
+        cls.user2 = User.objects.create_user('noortje', email='noortje@universe.cat')
+        cls.association = Association.objects.create(name='C&M')
+        FixedTransaction.objects.create(source_association=cls.association, target_user=cls.user,
+                                        amount=Decimal('10.00'))
+
+    def transfer(self, amount):
+        form = UserTransactionForm(self.user, {'amount': amount, 'target_user': self.user2.pk})
+        self.assertTrue(form.is_valid(), form.errors)
+        return form.save()
+
+    def test_transfer(self):
+        self.transfer('4.00')
+        self.assertEqual(UserCredit.get_balance(self.user), Decimal('6.00'))
+        self.assertEqual(UserCredit.get_balance(self.user2), Decimal('4.00'))
+
+    def test_overdraft(self):
+        self.transfer('6.00')
+        form = UserTransactionForm(self.user, {'amount': '6.00', 'target_user': self.user2.pk})
+        self.assertFalse(form.is_valid())
+        # E.g. when a concurrent transfer passed the form validation as well
+        with self.assertRaises(ValidationError):
+            PendingTransaction(source_user=self.user, target_user=self.user2, amount=Decimal('6.00')).transfer()
+        self.assertEqual(PendingTransaction.objects.count(), 1)
+
+    def test_clean(self):
+        """The check is also done for forms that only validate the model, e.g. on the admin site."""
+        with self.assertRaises(ValidationError):
+            PendingTransaction(source_user=self.user, target_user=self.user2, amount=Decimal('20.00')).full_clean()
+        # Editing only counts the change of the amount
+        pending = self.transfer('6.00')
+        pending.amount = Decimal('10.00')
+        pending.full_clean()
+        pending.amount = Decimal('20.00')
+        with self.assertRaises(ValidationError):
+            pending.full_clean()
+
+    def test_constant_number_of_queries(self):
+        with CaptureQueriesContext(connection) as before:
+            self.transfer('0.50')
+        for _ in range(20):
+            FixedTransaction.objects.create(source_association=self.association, target_user=self.user,
+                                            amount=Decimal('1.00'))
+        with CaptureQueriesContext(connection) as after:
+            self.transfer('0.50')
+        self.assertEqual(len(before), len(after))
+
+    def test_view_shows_error(self):
+        self.client.force_login(self.user)
+        response = self.client.post('/credit/transactions/add', {'amount': '20.00', 'target_user': self.user2.pk})
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'Balance becomes too low')
+
+
+class ConcurrentTransferTestCase(TransactionTestCase):
+    """Transfers from many threads at once may not overdraw the balance.
+
+    The in-memory SQLite test database locks complete tables, run the tests on PostgreSQL to test the row locks.
+    """
+
+    threads = 20
+
+    def setUp(self):
+        self.user = User.objects.create_user('ankie', email='ankie@universe.cat')
+        self.user2 = User.objects.create_user('noortje', email='noortje@universe.cat')
+        association = Association.objects.create(name='C&M')
+        FixedTransaction.objects.create(source_association=association, target_user=self.user,
+                                        amount=Decimal('10.00'))
+
+    def transfer(self, barrier, results):
+        try:
+            barrier.wait()
+            # SQLite reports a locked database instead of waiting, retry like a user would
+            for _ in range(100):
+                try:
+                    PendingTransaction(source_user_id=self.user.pk, target_user_id=self.user2.pk,
+                                       amount=Decimal('1.00')).transfer()
+                    results.append('transferred')
+                    return
+                except ValidationError:
+                    results.append('rejected')
+                    return
+                except OperationalError:
+                    time.sleep(0.01)
+            results.append('failed')
+        finally:
+            connection.close()
+
+    def test_no_overdraft(self):
+        barrier = threading.Barrier(self.threads)
+        results = []
+        threads = [threading.Thread(target=self.transfer, args=(barrier, results)) for _ in range(self.threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(results.count('transferred'), 10)
+        self.assertEqual(results.count('rejected'), 10)
+        self.assertEqual(PendingTransaction.objects.count(), 10)
+        self.assertEqual(UserCredit.get_balance(self.user), Decimal('0.00'))
+        self.assertEqual(UserCredit.get_balance(self.user2), Decimal('10.00'))
@@ -1,13 +1,14 @@
 from django.urls import path
 
 from creditmanagement.views import TransactionListView, TransactionAddView, TransactionFinalisationView, \
-    MoneyObtainmentView
+    MoneyObtainmentView, BalanceHistoryView
 
 app_name = 'credits'
 
 urlpatterns = [
     path('transactions/', TransactionListView.as_view(), name='transaction_list'),
     path('transactions/add', TransactionAddView.as_view(), name='transaction_add'),
+    path('transactions/balance.json', BalanceHistoryView.as_view(), name='balance_history'),
     path('finalise_transactions/', TransactionFinalisationView.as_view(), name='transactions_finalise'),
     path('dining_money/', MoneyObtainmentView.as_view(), name='dining_money')
 ]
@@ -1,26 +1,46 @@
 from datetime import datetime
+from decimal import Decimal
 
 from django.contrib import messages
 from django.contrib.auth.mixins import LoginRequiredMixin
+from django.core.exceptions import ValidationError
 from django.db.models import Sum
-from django.http import HttpResponseForbidden, HttpResponseRedirect, HttpResponse
+from django.http import HttpResponseForbidden, HttpResponseRedirect, HttpResponse, JsonResponse
 from django.shortcuts import render
 from django.utils import timezone
 from django.views.generic import View
 from django.views.generic.list import ListView
 
 from creditmanagement.forms import UserTransactionForm, AssociationTransactionForm
-from creditmanagement.models import AbstractTransaction, AbstractPendingTransaction, FixedTransaction
-from userdetails.models import Association
+from creditmanagement.models import AbstractTransaction, AbstractPendingTransaction, FixedTransaction, Transaction
+from general.views import CursorPaginationMixin
+from userdetails.models import Association, User
 
 
-class TransactionListView(ListView):
+class TransactionListView(CursorPaginationMixin, ListView):
     template_name = "credit_management/history_credits.html"
     paginate_by = 10
     context_object_name = 'transactions'
+    cursor_ordering = ('-order_moment', '-pk')
 
     def get_queryset(self):
-        return AbstractTransaction.get_all_transactions(user=self.request.user).order_by('-pk')
+        return AbstractTransaction.get_all_transactions(user=self.request.user).select_related(
+            'source_user', 'source_association', 'target_user', 'target_association')
+
+
+class BalanceHistoryView(LoginRequiredMixin, View):
+    """Returns the balance of the user after each of their transactions as JSON, oldest first."""
+
+    def get(self, request, *args, **kwargs):
+        transactions = Transaction.objects.running_user_balance(User.objects.filter(pk=request.user.pk))
+        return JsonResponse({'balance': [{
+            'moment': t.order_moment.isoformat(),
+            'description': t.description,
+            'pending': t.state == Transaction.PENDING,
+            'change': str(Decimal(t.change).quantize(Decimal('.01'))),
+            # The sum is a float on SQLite
+            'balance': str(Decimal(t.balance).quantize(Decimal('.01'))),
+        } for t in transactions]})
 
 
 class TransactionAddView(LoginRequiredMixin, View):
@@ -52,9 +72,14 @@ class TransactionAddView(LoginRequiredMixin, View):
             form = UserTransactionForm(request.user, request.POST)
 
         if form.is_valid():
-            form.save()
-            messages.add_message(request, messages.SUCCESS, "Transaction has been successfully added.")
-            return HttpResponseRedirect(request.path_info)
+            try:
+                form.save()
+            except ValidationError as e:
+                # The balance is checked while saving
+                form.add_error(None, e)
+            else:
+                messages.add_message(request, messages.SUCCESS, "Transaction has been successfully added.")
+                return HttpResponseRedirect(request.path_info)
 
         self.context['slot_form'] = form
         return render(request, self.template_name, self.context)
@@ -68,7 +93,7 @@ class TransactionFinalisationView(View):
         return render(request, self.template_name, self.context)
 
     def post(self, request):
-        self.context['transactions'] = AbstractPendingTransaction.finalise_all_expired()
+        self.context['result'] = AbstractPendingTransaction.finalise_all_expired()
 
         return render(request, self.template_name, self.context)
 
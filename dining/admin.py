@@ -1,7 +1,7 @@
 from django.contrib import admin
 
 from dining.models import DiningEntryUser, DiningEntryExternal, DiningDayAnnouncement, \
-    DiningComment, DiningWork, DiningList
+    DiningComment, DiningList
 
 
 @admin.register(DiningEntryUser, DiningEntryExternal)
@@ -27,4 +27,3 @@ class DiningDayAnnouncementAdmin(admin.ModelAdmin):
 
 
 admin.site.register(DiningComment)
-admin.site.register(DiningWork)
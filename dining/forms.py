@@ -10,6 +10,7 @@ from django.db.models import OuterRef, Exists
 from django.forms import ValidationError
 from django.utils import timezone
 
+from creditmanagement.models import UserCredit
 from dining.models import DiningList, DiningEntryUser, DiningEntryExternal, DiningComment
 from general.forms import ConcurrenflictFormMixin
 from general.util import SelectWithDisabled
@@ -88,7 +89,8 @@ class CreateSlotForm(ServeTimeCheckMixin, forms.ModelForm):
 
         # Check if user has enough money to claim a slot
         min_balance_exception = creator.has_min_balance_exception()
-        if not min_balance_exception and creator.usercredit.balance < settings.MINIMUM_BALANCE_FOR_DINING_SLOT_CLAIM:
+        balance = UserCredit.get_balance(creator)
+        if not min_balance_exception and balance < settings.MINIMUM_BALANCE_FOR_DINING_SLOT_CLAIM:
             raise ValidationError("Your balance is too low to claim a slot")
 
         # Check if user does not already own another dining list this day
@@ -219,7 +221,8 @@ class DiningEntryUserCreateForm(forms.ModelForm):
                 raise ValidationError("Dining list is limited for members only", code='members_only')
 
         # User balance check
-        if not user.has_min_balance_exception() and user.usercredit.balance < settings.MINIMUM_BALANCE_FOR_DINING_SIGN_UP:
+        balance = UserCredit.get_balance(user)
+        if not user.has_min_balance_exception() and balance < settings.MINIMUM_BALANCE_FOR_DINING_SIGN_UP:
             raise ValidationError("The balance of the user is too low to add", code='nomoneyzz')
 
         return cleaned_data
@@ -0,0 +1,48 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Min
+from django.db.models.functions import TruncDate
+
+from creditmanagement.models import FixedTransaction
+from dining import statistics
+from dining.models import DiningList, DailyAssociationStats
+
+
+class Command(BaseCommand):
+    help = 'Stores the daily association statistics of all days that can no longer change'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rebuild', action='store_true', help='Remove and recompute all stored statistics')
+        parser.add_argument('--chunk-days', type=int, default=31, help='The number of days computed at once')
+
+    @staticmethod
+    def get_first_date():
+        """Returns the first day with dining lists or transactions."""
+        dates = [DiningList.objects.aggregate(first=Min('date'))['first'],
+                 FixedTransaction.objects.aggregate(first=Min(TruncDate('confirm_moment')))['first']]
+        dates = [d for d in dates if d is not None]
+        return min(dates) if dates else None
+
+    def handle(self, *args, **options):
+        if options['rebuild']:
+            DailyAssociationStats.objects.all().delete()
+
+        rolled_up_until = DailyAssociationStats.get_rolled_up_until()
+        date_start = rolled_up_until + timedelta(days=1) if rolled_up_until else self.get_first_date()
+        date_end = statistics.get_last_locked_date()
+        if date_start is None or date_start > date_end:
+            self.stdout.write(self.style.SUCCESS('The statistics are up to date'))
+            return
+
+        rows = 0
+        while date_start <= date_end:
+            chunk_end = min(date_start + timedelta(days=options['chunk_days'] - 1), date_end)
+            # Days are only marked as rolled up once all their rows are stored
+            with transaction.atomic():
+                rows += statistics.rollup(date_start, chunk_end)
+            date_start = chunk_end + timedelta(days=1)
+
+        self.stdout.write(self.style.SUCCESS('Stored {} rows, the statistics are rolled up until {}'.format(
+            rows, date_end)))
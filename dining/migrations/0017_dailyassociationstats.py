@@ -0,0 +1,36 @@
+from decimal import Decimal
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('userdetails', '0018_association_has_site_stats_access'),
+        ('dining', '0016_auto_20190514_1317'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyAssociationStats',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('lists', models.PositiveIntegerField(default=0)),
+                ('diners', models.PositiveIntegerField(default=0)),
+                ('guests', models.PositiveIntegerField(default=0)),
+                ('diners_own', models.PositiveIntegerField(default=0)),
+                ('weighted_eaters', models.FloatField(default=0)),
+                ('kitchen_cost', models.DecimalField(decimal_places=2, default=Decimal('0.00'), max_digits=12)),
+                ('inflow', models.DecimalField(decimal_places=2, default=Decimal('0.00'), max_digits=12)),
+                ('outflow', models.DecimalField(decimal_places=2, default=Decimal('0.00'), max_digits=12)),
+                ('association', models.ForeignKey(blank=True, null=True,
+                                                  on_delete=django.db.models.deletion.CASCADE,
+                                                  to='userdetails.Association')),
+            ],
+            options={
+                'unique_together': {('date', 'association')},
+            },
+        ),
+    ]
@@ -0,0 +1,34 @@
+from django.db import migrations, models
+from django.db.models import Count, Max
+import django.utils.timezone
+
+
+def remove_duplicate_visits(apps, schema_editor):
+    """Keeps only the latest visit of each user to the comments of each dining list."""
+    DiningCommentVisitTracker = apps.get_model('dining', 'DiningCommentVisitTracker')
+    duplicates = DiningCommentVisitTracker.objects.values('user', 'dining_list').annotate(
+        count=Count('id'), latest=Max('timestamp'))
+    for duplicate in duplicates.filter(count__gt=1):
+        visits = DiningCommentVisitTracker.objects.filter(user=duplicate['user'], dining_list=duplicate['dining_list'])
+        keep = visits.filter(timestamp=duplicate['latest']).first()
+        visits.exclude(pk=keep.pk).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dining', '0017_dailyassociationstats'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_visits, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='diningcommentvisittracker',
+            name='timestamp',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AlterUniqueTogether(
+            name='diningcommentvisittracker',
+            unique_together={('user', 'dining_list')},
+        ),
+    ]
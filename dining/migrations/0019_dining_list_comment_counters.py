@@ -0,0 +1,38 @@
+from django.db import migrations, models
+from django.db.models import Count, Max, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+
+def compute_comment_counters(apps, schema_editor):
+    DiningList = apps.get_model('dining', 'DiningList')
+    DiningComment = apps.get_model('dining', 'DiningComment')
+    comments = DiningComment.objects.filter(dining_list=OuterRef('pk')).order_by().values('dining_list')
+    DiningList.objects.update(
+        comment_count=Coalesce(Subquery(comments.annotate(count=Count('id')).values('count')), Value(0)),
+        latest_comment_timestamp=Subquery(comments.annotate(latest=Max('timestamp')).values('latest')),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dining', '0018_unique_comment_visits'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dininglist',
+            name='comment_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='dininglist',
+            name='latest_comment_timestamp',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AlterIndexTogether(
+            name='diningcomment',
+            index_together={('dining_list', 'timestamp')},
+        ),
+        migrations.RunPython(compute_comment_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dining', '0019_dining_list_comment_counters'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dininglist',
+            name='stats_version',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+    ]
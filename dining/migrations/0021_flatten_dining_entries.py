@@ -0,0 +1,124 @@
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+STATS_FIELDS = ('has_shopped', 'has_cooked', 'has_cleaned')
+
+
+def flatten_entries(apps, schema_editor):
+    """Copies the work stats and the guest names of the subclass tables to the entries."""
+    DiningEntry = apps.get_model('dining', 'DiningEntry')
+    DiningEntryUser = apps.get_model('dining', 'DiningEntryUser')
+    DiningEntryExternal = apps.get_model('dining', 'DiningEntryExternal')
+
+    users = DiningEntryUser.objects.filter(diningentry_ptr=OuterRef('pk'))
+    DiningEntry.objects.filter(pk__in=DiningEntryUser.objects.values('diningentry_ptr')).update(
+        entry_type='user', **{'new_' + field: Subquery(users.values(field)[:1]) for field in STATS_FIELDS})
+
+    externals = DiningEntryExternal.objects.filter(diningentry_ptr=OuterRef('pk'))
+    DiningEntry.objects.filter(pk__in=DiningEntryExternal.objects.values('diningentry_ptr')).update(
+        entry_type='external', new_name=Subquery(externals.values('name')[:1]))
+
+
+def restore_entries(apps, schema_editor):
+    """Creates the subclass rows of the entries again, the parent rows are kept."""
+    DiningEntry = apps.get_model('dining', 'DiningEntry')
+    DiningWork = apps.get_model('dining', 'DiningWork')
+    DiningEntryUser = apps.get_model('dining', 'DiningEntryUser')
+    DiningEntryExternal = apps.get_model('dining', 'DiningEntryExternal')
+
+    for entry in DiningEntry.objects.filter(entry_type='user'):
+        work = DiningWork.objects.create(**{field: getattr(entry, 'new_' + field) for field in STATS_FIELDS})
+        # Raw only inserts the row of the subclass table
+        DiningEntryUser(diningentry_ptr_id=entry.pk, diningwork_ptr_id=work.pk).save_base(raw=True, force_insert=True)
+    for entry in DiningEntry.objects.filter(entry_type='external'):
+        DiningEntryExternal(diningentry_ptr_id=entry.pk, name=entry.new_name).save_base(raw=True, force_insert=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dining', '0020_dininglist_stats_version'),
+    ]
+
+    # The new fields get a temporary name, as they clash with the fields of the subclasses until those are removed
+    operations = [
+        migrations.AddField(
+            model_name='diningentry',
+            name='entry_type',
+            field=models.CharField(choices=[('user', 'User'), ('external', 'External')], default='user',
+                                   max_length=8),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='diningentry',
+            name='new_has_shopped',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='diningentry',
+            name='new_has_cooked',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='diningentry',
+            name='new_has_cleaned',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='diningentry',
+            name='new_name',
+            field=models.CharField(blank=True, max_length=100),
+        ),
+        migrations.RunPython(flatten_entries, restore_entries),
+        migrations.DeleteModel(
+            name='DiningEntryExternal',
+        ),
+        migrations.DeleteModel(
+            name='DiningEntryUser',
+        ),
+        migrations.DeleteModel(
+            name='DiningWork',
+        ),
+        migrations.RenameField(
+            model_name='diningentry',
+            old_name='new_has_shopped',
+            new_name='has_shopped',
+        ),
+        migrations.RenameField(
+            model_name='diningentry',
+            old_name='new_has_cooked',
+            new_name='has_cooked',
+        ),
+        migrations.RenameField(
+            model_name='diningentry',
+            old_name='new_has_cleaned',
+            new_name='has_cleaned',
+        ),
+        migrations.RenameField(
+            model_name='diningentry',
+            old_name='new_name',
+            new_name='name',
+        ),
+        migrations.CreateModel(
+            name='DiningEntryExternal',
+            fields=[
+            ],
+            options={
+                'proxy': True,
+                'indexes': [],
+                'constraints': [],
+            },
+            bases=('dining.diningentry',),
+        ),
+        migrations.CreateModel(
+            name='DiningEntryUser',
+            fields=[
+            ],
+            options={
+                'proxy': True,
+                'indexes': [],
+                'constraints': [],
+            },
+            bases=('dining.diningentry',),
+        ),
+    ]
@@ -0,0 +1,19 @@
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dining', '0021_flatten_dining_entries'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='dailyassociationstats',
+            name='diners_own',
+        ),
+        migrations.RemoveField(
+            model_name='dailyassociationstats',
+            name='weighted_eaters',
+        ),
+    ]
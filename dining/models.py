@@ -1,11 +1,13 @@
+from copy import copy
 from datetime import time
 from decimal import Decimal
 
 from django.conf import settings
-from django.core.exceptions import ValidationError, MultipleObjectsReturned
+from django.core.exceptions import ValidationError
 from django.core.validators import MinValueValidator, MaxValueValidator
-from django.db import models
-from django.db.models import Sum
+from django.db import models, transaction
+from django.db.models import Sum, Count, Max, OuterRef, Subquery, Value, F
+from django.db.models.functions import Coalesce
 from django.utils import timezone
 
 from general.models import AbstractVisitTracker
@@ -81,6 +83,14 @@ class DiningList(models.Model):
                                   help_text='If specified, is shown on the dining list as the user who should receive '
                                             'the grocery shopping payments.')
 
+    # Maintained by the DiningComment receivers, so that the dining list pages do not need to count the comments
+    comment_count = models.PositiveIntegerField(default=0, editable=False)
+    latest_comment_timestamp = models.DateTimeField(null=True, blank=True, editable=False)
+    # Incremented on every change of the paid and work stats of the entries, to detect conflicting changes
+    stats_version = models.PositiveIntegerField(default=0, editable=False)
+    # The fields above are updated with separate queries and are not written by save()
+    MAINTAINED_FIELDS = ('comment_count', 'latest_comment_timestamp', 'stats_version')
+
     objects = DiningListManager()
 
     def is_owner(self, user: User) -> bool:
@@ -91,6 +101,15 @@ class DiningList(models.Model):
         """
         return self.owners.filter(pk=user.pk).exists()
 
+    def save(self, *args, **kwargs):
+        if not self._state.adding and kwargs.get('update_fields') is None:
+            # Do not overwrite the maintained fields with stale values
+            kwargs['update_fields'] = [field.name for field in self._meta.concrete_fields
+                                       if not field.primary_key and field.name not in self.MAINTAINED_FIELDS]
+        # Atomic so that the balance updates of kitchen cost changes are stored together with the list
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+
     def is_adjustable(self):
         """Whether the dining list has not expired and can still be modified."""
         days_since_date = (self.date + self.adjustable_duration)
@@ -119,6 +138,62 @@ class DiningList(models.Model):
     def __str__(self):
         return "{} {}".format(self.date, self.association)
 
+    @staticmethod
+    def update_comment_counters(dining_list_ids):
+        """Recomputes the comment counters of the given dining lists in a single query."""
+        comments = DiningComment.objects.filter(dining_list=OuterRef('pk')).order_by().values('dining_list')
+        DiningList.objects.filter(pk__in=dining_list_ids).update(
+            comment_count=Coalesce(Subquery(comments.annotate(count=Count('id')).values('count')), Value(0)),
+            latest_comment_timestamp=Subquery(comments.annotate(latest=Max('timestamp')).values('latest')),
+        )
+
+    def increment_stats_version(self, version):
+        """Increments the stats version if it is still equal to the given version.
+
+        Returns:
+            False when the stats have been changed by someone else since the given version was read.
+        """
+        updated = DiningList.objects.filter(pk=self.pk, stats_version=version).update(
+            stats_version=F('stats_version') + 1)
+        return updated == 1
+
+    @staticmethod
+    def invalidate_stats_versions(dining_list_ids):
+        """Increments the stats version of the given dining lists, so that stats posted for the old version fail."""
+        DiningList.objects.filter(pk__in=dining_list_ids).update(stats_version=F('stats_version') + 1)
+
+    def update_entry_stats(self, entry_ids, checked):
+        """Sets the paid and work stats of the given entries, only the changed entries are updated.
+
+        The updates skip the save signals, which is fine as the stats do not influence the balances.
+
+        Args:
+            entry_ids: The ids of the entries that are updated, other entries are left alone.
+            checked: A dictionary from entry id (as string) to the set of stats that are set, the others are cleared.
+        """
+        changed = []
+        for entry in self.dining_entries.filter(pk__in=entry_ids):
+            fields = checked.get(str(entry.pk), set())
+            stats = {'has_paid': 'has_paid' in fields}
+            if entry.is_internal():
+                stats.update({field: field in fields for field in DiningEntry.STATS_FIELDS})
+            if any(getattr(entry, field) != value for field, value in stats.items()):
+                for field, value in stats.items():
+                    setattr(entry, field, value)
+                changed.append(entry)
+
+        DiningEntry.objects.bulk_update(changed, ('has_paid',) + DiningEntry.STATS_FIELDS)
+
+    def has_unread_comments(self, last_visit):
+        """Returns whether a comment was posted since the last visit, using the comment counters.
+
+        Args:
+            last_visit: The datetime of the last visit to the comments, or None when they were never visited.
+        """
+        if last_visit is None:
+            return self.comment_count > 0
+        return self.latest_comment_timestamp is not None and self.latest_comment_timestamp >= last_visit
+
     def get_absolute_url(self):
         from django.shortcuts import reverse
         slug = self.association.slug
@@ -142,34 +217,98 @@ class DiningList(models.Model):
                     {'sign_up_deadline': ["Sign up deadline can't be later than the day dinner is served"]})
 
 
+class DiningEntryManager(models.Manager):
+    """Manager of the proxy models of DiningEntry, only returns the entries of the given type."""
+
+    def __init__(self, entry_type):
+        super().__init__()
+        self.entry_type = entry_type
+
+    def get_queryset(self):
+        return super().get_queryset().filter(entry_type=self.entry_type)
+
+
 class DiningEntry(models.Model):
-    """Represents an entry on a dining list."""
+    """Represents an entry on a dining list.
+
+    The entries of users and of external people (guests) are stored in this table, use the DiningEntryUser and
+    DiningEntryExternal proxy models to work with one type. Entries loaded from the database are always instances of
+    the proxy model of their type, also when they are loaded through DiningEntry or a relation.
+    """
+    USER = 'user'
+    EXTERNAL = 'external'
+    TYPE_CHOICES = (
+        (USER, 'User'),
+        (EXTERNAL, 'External'),
+    )
 
     dining_list = models.ForeignKey(DiningList, on_delete=models.PROTECT, related_name='dining_entries')
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.PROTECT)
     created_by = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.PROTECT,
                                    related_name='created_dining_entries')
+    entry_type = models.CharField(max_length=8, choices=TYPE_CHOICES)
 
     has_paid = models.BooleanField(default=False)
 
+    # The work stats, only used for user entries
+    has_shopped = models.BooleanField(default=False)
+    has_cooked = models.BooleanField(default=False)
+    has_cleaned = models.BooleanField(default=False)
+    STATS_FIELDS = ('has_shopped', 'has_cooked', 'has_cleaned')
+
+    # The name of the guest, only used for external entries
+    name = models.CharField(max_length=100, blank=True)
+
+    # The type of new instances, set by the proxy models
+    proxy_entry_type = None
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if not self.entry_type:
+            self.entry_type = self.proxy_entry_type
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        # Instantiate the proxy model of the type of the entry
+        if cls is DiningEntry and 'entry_type' in field_names:
+            cls = cls.get_proxy_model(values[field_names.index('entry_type')])
+        return super(DiningEntry, cls).from_db(db, field_names, values)
+
+    @staticmethod
+    def get_proxy_model(entry_type):
+        return {DiningEntry.USER: DiningEntryUser, DiningEntry.EXTERNAL: DiningEntryExternal}[entry_type]
+
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get('update_fields')
+        changes_stats = not self._state.adding and (
+            update_fields is None or set(update_fields) & {'has_paid', *self.STATS_FIELDS})
+        # Atomic so that the kitchen cost charged by the receivers is stored together with the entry
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            if changes_stats:
+                # The stats might have changed while the slot list was opened, see SlotListView
+                DiningList.invalidate_stats_versions([self.dining_list_id])
+
+    def delete(self, *args, **kwargs):
+        with transaction.atomic():
+            DiningList.invalidate_stats_versions([self.dining_list_id])
+            return super().delete(*args, **kwargs)
+
     def get_subclass(self):
-        """Return an instance of the correct subclass, either DiningEntryUser or DiningEntryExternal."""
-        try:
-            return self.diningentryuser
-        except DiningEntryUser.DoesNotExist:
-            pass
-        try:
-            return self.diningentryexternal
-        except DiningEntryExternal.DoesNotExist:
-            pass
-        raise RuntimeError("Invalid DiningEntry")
+        """Return the entry as instance of its proxy model, either DiningEntryUser or DiningEntryExternal."""
+        proxy_model = self.get_proxy_model(self.entry_type)
+        if isinstance(self, proxy_model):
+            return self
+        entry = copy(self)
+        entry.__class__ = proxy_model
+        return entry
 
     def get_name(self):
         """Return name of diner."""
         return self.user.get_full_name()
 
     def is_internal(self):
-        return True
+        return self.entry_type == self.USER
 
     def is_external(self):
         return not self.is_internal()
@@ -178,17 +317,13 @@ class DiningEntry(models.Model):
         return "{}: {}".format(self.dining_list.date, self.get_name())
 
 
-class DiningWork(models.Model):
-    # Define the unique id name to prevent conflicts with DiningEntry
-    w_id = models.AutoField(primary_key=True)
-
-    # Add the stats
-    has_shopped = models.BooleanField(default=False)
-    has_cooked = models.BooleanField(default=False)
-    has_cleaned = models.BooleanField(default=False)
+class DiningEntryUser(DiningEntry):
+    objects = DiningEntryManager(DiningEntry.USER)
+    proxy_entry_type = DiningEntry.USER
 
+    class Meta:
+        proxy = True
 
-class DiningEntryUser(DiningEntry, DiningWork):
     def clean(self):
         if not self.pk and hasattr(self, 'user') and hasattr(self, 'dining_list'):
             if DiningEntryUser.objects.filter(user=self.user, dining_list=self.dining_list).exists():
@@ -196,14 +331,20 @@ class DiningEntryUser(DiningEntry, DiningWork):
 
 
 class DiningEntryExternal(DiningEntry):
-    name = models.CharField(max_length=100)
+    objects = DiningEntryManager(DiningEntry.EXTERNAL)
+    proxy_entry_type = DiningEntry.EXTERNAL
+
+    class Meta:
+        proxy = True
+
+    def clean(self):
+        # The name is blank for the entries of users, which are stored in the same table
+        if not self.name:
+            raise ValidationError({'name': "The name of the guest is required"}, code='required')
 
     def get_name(self):
         return self.name
 
-    def is_internal(self):
-        return False
-
 
 class DiningComment(models.Model):
     dining_list = models.ForeignKey(DiningList, on_delete=models.CASCADE)
@@ -212,11 +353,19 @@ class DiningComment(models.Model):
     message = models.CharField(max_length=256)
     pinned_to_top = models.BooleanField(default=False)
 
+    class Meta:
+        index_together = ('dining_list', 'timestamp')
+
 
 class DiningCommentVisitTracker(AbstractVisitTracker):
     """Tracks whether certain comments have been read, i.e. the last time the comments page was visited."""
     dining_list = models.ForeignKey(DiningList, on_delete=models.CASCADE)
 
+    page_fields = ('dining_list_id',)
+
+    class Meta:
+        unique_together = ('user', 'dining_list')
+
     @classmethod
     def get_latest_visit(cls, dining_list, user, update=False):
         """Gets the datetime of the latest visit.
@@ -226,29 +375,9 @@ class DiningCommentVisitTracker(AbstractVisitTracker):
         Args:
             dining_list: The dining list the comment is part of.
             user: The user visiting the page.
-            update: Update(?)
+            update: Whether to record the current visit.
         """
-        try:
-            if update:
-                latest_visit_obj = cls.objects.get_or_create(user=user, dining_list=dining_list)[0]
-            else:
-                try:
-                    latest_visit_obj = cls.objects.get(user=user, dining_list=dining_list)
-                except cls.DoesNotExist:
-                    return None
-        except MultipleObjectsReturned:
-            # A race condition occured and multiple were created. Clean up the entries
-            visit_entries = cls.objects.filter(user=user, dining_list=dining_list)
-            # Store 1 object, remove the others this could result in dataloss, but the problem is not noticeable
-            latest_visit_obj = visit_entries.first()
-            visit_entries.exclude(id=latest_visit_obj.id)
-            visit_entries.delete()
-
-        timestamp = latest_visit_obj.timestamp
-        if update:
-            latest_visit_obj.timestamp = timezone.now()
-            latest_visit_obj.save()
-        return timestamp
+        return cls._get_latest_visit(user, update=update, dining_list_id=dining_list.pk)
 
     def __str__(self):
         return "{dining_list} - {user}".format(dining_list=self.dining_list, user=self.user)
@@ -262,3 +391,35 @@ class DiningDayAnnouncement(models.Model):
 
     def __str__(self):
         return self.title
+
+
+class DailyAssociationStats(models.Model):
+    """Aggregated dining and credit statistics of a single day and association.
+
+    The rows are filled by the rollup_daily_stats management command for days that can no longer change, see
+    dining/statistics.py. For every rolled up day there is a row without association containing the money flows of
+    the site itself (transactions without source or target), even if nothing happened on that day. The statistics
+    that depend on the memberships of the diners are not stored, as the memberships can still change.
+    """
+    date = models.DateField()
+    association = models.ForeignKey(Association, on_delete=models.CASCADE, null=True, blank=True)
+
+    lists = models.PositiveIntegerField(default=0)
+    # All entries, including guests
+    diners = models.PositiveIntegerField(default=0)
+    guests = models.PositiveIntegerField(default=0)
+    kitchen_cost = models.DecimalField(decimal_places=2, max_digits=12, default=Decimal('0.00'))
+
+    inflow = models.DecimalField(decimal_places=2, max_digits=12, default=Decimal('0.00'))
+    outflow = models.DecimalField(decimal_places=2, max_digits=12, default=Decimal('0.00'))
+
+    class Meta:
+        unique_together = ('date', 'association')
+
+    def __str__(self):
+        return "{} {}".format(self.date, self.association or "site")
+
+    @classmethod
+    def get_rolled_up_until(cls):
+        """Returns the last day that has been rolled up, or None."""
+        return cls.objects.filter(association__isnull=True).aggregate(models.Max('date'))['date__max']
@@ -1,8 +1,11 @@
 from django.conf import settings
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
 
-from dining.models import UserDiningSettings
+from dining import statistics
+from dining.models import UserDiningSettings, DiningEntryUser, DiningEntryExternal, DiningList, DiningComment
+from general import metrics
+from userdetails.models import Association, UserMembership
 
 
 @receiver(post_save, sender=settings.AUTH_USER_MODEL)
@@ -13,3 +16,25 @@ def create_user_dining_details(sender, instance=False, created=False, **kwargs):
     """
     if created:
         UserDiningSettings.objects.create(user=instance)
+
+
+@receiver(post_save, sender=UserMembership)
+@receiver(post_delete, sender=UserMembership)
+@receiver(post_save, sender=Association)
+@receiver(post_delete, sender=Association)
+def invalidate_dining_statistics(sender, **kwargs):
+    """The cached dining statistics depend on the (verified) memberships."""
+    statistics.invalidate()
+
+
+@receiver(post_save, sender=DiningEntryUser)
+@receiver(post_save, sender=DiningEntryExternal)
+def count_sign_up(sender, instance, created=False, **kwargs):
+    if created:
+        metrics.SIGN_UPS.inc(kind='user' if sender is DiningEntryUser else 'external')
+
+
+@receiver(post_save, sender=DiningComment)
+@receiver(post_delete, sender=DiningComment)
+def update_comment_counters(sender, instance, **kwargs):
+    DiningList.update_comment_counters([instance.dining_list_id])
@@ -0,0 +1,245 @@
+"""Dining and credit statistics per association, used by the site statistics pages.
+
+The statistics are computed per day and association by compute_daily_stats. Days that can no longer change (all
+dining lists are past their adjustable_duration) are stored in DailyAssociationStats by the rollup_daily_stats
+management command. A date range is answered from the stored rows, only the days that have not been rolled up yet
+are computed from the dining entries and transactions.
+
+The statistics that depend on the current memberships of the diners (cooked_for_own and weighted_eaters) are not
+rolled up, as the memberships still change. They are always computed from the dining entries by
+compute_member_stats.
+
+The association statistics of a closed date range are cached as well. A change of the memberships or associations
+invalidates all cached statistics, see dining/receivers.py. The invalidation only reaches the other worker processes
+when the cache is shared (DINING_CACHE_URL), otherwise they serve the old statistics for DINING_STATS_CACHE_TIMEOUT
+seconds.
+"""
+from collections import defaultdict
+from datetime import timedelta
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import models
+from django.db.models import Count, F, ExpressionWrapper, Sum, Q
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from creditmanagement.models import FixedTransaction
+from dining.models import DiningList, DiningEntry, DailyAssociationStats
+from userdetails.models import Association, UserMembership
+
+VERSION_KEY = 'dining_stats:version'
+
+# The values of DailyAssociationStats that are summed over a date range
+STAT_FIELDS = ('lists', 'diners', 'guests', 'kitchen_cost', 'inflow', 'outflow')
+
+
+def _get_version():
+    cache.add(VERSION_KEY, 1, timeout=None)
+    return cache.get(VERSION_KEY, 1)
+
+
+def invalidate():
+    """Invalidates all cached statistics."""
+    try:
+        cache.incr(VERSION_KEY)
+    except ValueError:
+        # There is no version yet, so nothing is cached
+        pass
+
+
+def _adjustable_lists():
+    return DiningList.objects.annotate(
+        lockdate=ExpressionWrapper(F('date') + F('adjustable_duration'), output_field=models.DateField())
+    ).filter(lockdate__gte=timezone.now().date())
+
+
+def is_closed_range(date_start, date_end):
+    """Whether none of the dining lists in the date range can be adjusted anymore."""
+    if date_end >= timezone.now().date():
+        return False
+    return not _adjustable_lists().filter(date__gte=date_start, date__lte=date_end).exists()
+
+
+def get_last_locked_date():
+    """Returns the last day of which the statistics can no longer change."""
+    last_date = timezone.now().date() - timedelta(days=1)
+    first_adjustable = _adjustable_lists().aggregate(models.Min('date'))['date__min']
+    if first_adjustable is not None:
+        last_date = min(last_date, first_adjustable - timedelta(days=1))
+    return last_date
+
+
+def _add_dining_stats(row, date_start, date_end):
+    dining_lists = DiningList.objects.filter(date__gte=date_start, date__lte=date_end)
+    for values in dining_lists.order_by().values('date', 'association_id').annotate(count=Count('id')):
+        row(values['date'], values['association_id']).lists = values['count']
+
+    entries = DiningEntry.objects.filter(dining_list__in=dining_lists)
+    guests = Count('id', filter=Q(entry_type=DiningEntry.EXTERNAL))
+    entry_counts = entries.order_by().values('dining_list__date', 'dining_list__association_id').annotate(
+        count=Count('id'), guests=guests, kitchen_cost=Sum('dining_list__kitchen_cost'))
+    for values in entry_counts:
+        stats = row(values['dining_list__date'], values['dining_list__association_id'])
+        stats.diners += values['count']
+        stats.guests += values['guests']
+        stats.kitchen_cost += values['kitchen_cost']
+
+
+def _add_money_flows(row, date_start, date_end):
+    # Transactions without target or source are paid to or received from outside the site
+    transactions = FixedTransaction.objects.filter(confirm_moment__date__gte=date_start,
+                                                   confirm_moment__date__lte=date_end)
+    flows = (
+        ('inflow', 'target_association_id', transactions.filter(target_association__isnull=False)),
+        ('outflow', 'source_association_id', transactions.filter(source_association__isnull=False)),
+        ('inflow', None, transactions.filter(target_user__isnull=True, target_association__isnull=True)),
+        ('outflow', None, transactions.filter(source_user__isnull=True, source_association__isnull=True)),
+    )
+    for field, group_by, queryset in flows:
+        queryset = queryset.annotate(day=TruncDate('confirm_moment')).order_by()
+        queryset = queryset.values('day', group_by) if group_by else queryset.values('day')
+        for values in queryset.annotate(total=Sum('amount')):
+            stats = row(values['day'], values[group_by] if group_by else None)
+            setattr(stats, field, getattr(stats, field) + Decimal(values['total']))
+
+
+def compute_daily_stats(date_start, date_end):
+    """Computes the statistics of every day and association in the date range.
+
+    Returns:
+        A dictionary from (date, association_id) to an unsaved DailyAssociationStats. There is a row with association
+        None for every day in the range.
+    """
+    rows = {}
+
+    def row(d, association_id):
+        if (d, association_id) not in rows:
+            rows[(d, association_id)] = DailyAssociationStats(date=d, association_id=association_id)
+        return rows[(d, association_id)]
+
+    d = date_start
+    while d <= date_end:
+        row(d, None)
+        d += timedelta(days=1)
+
+    _add_dining_stats(row, date_start, date_end)
+    _add_money_flows(row, date_start, date_end)
+    return rows
+
+
+def rollup(date_start, date_end):
+    """Stores the statistics of the given days, replacing any existing rows.
+
+    Returns:
+        The number of stored rows.
+    """
+    rows = compute_daily_stats(date_start, date_end)
+    DailyAssociationStats.objects.filter(date__gte=date_start, date__lte=date_end).delete()
+    DailyAssociationStats.objects.bulk_create(rows.values())
+    return len(rows)
+
+
+def get_totals(date_start, date_end):
+    """Sums the daily statistics over the date range.
+
+    Returns:
+        A dictionary from association id (None for the site) to a dictionary with the summed STAT_FIELDS.
+    """
+    totals = defaultdict(lambda: {field: 0 for field in STAT_FIELDS})
+
+    rolled_up_until = DailyAssociationStats.get_rolled_up_until()
+    if rolled_up_until is not None and date_start <= rolled_up_until:
+        stored = DailyAssociationStats.objects.filter(date__gte=date_start, date__lte=min(date_end, rolled_up_until))
+        for values in stored.order_by().values('association_id').annotate(*[Sum(field) for field in STAT_FIELDS]):
+            for field in STAT_FIELDS:
+                totals[values['association_id']][field] += values[field + '__sum']
+        date_start = rolled_up_until + timedelta(days=1)
+
+    if date_start <= date_end:
+        for (d, association_id), stats in compute_daily_stats(date_start, date_end).items():
+            for field in STAT_FIELDS:
+                totals[association_id][field] += getattr(stats, field)
+
+    return totals
+
+
+def compute_member_stats(date_start, date_end):
+    """Computes the statistics that depend on the current memberships of the diners.
+
+    Returns:
+        A dictionary from association id to a dictionary with diners_own, the entries of verified members of the
+        association, and weighted_eaters, the meals of all diners each divided over the associations the diner is a
+        member of.
+    """
+    entries = DiningEntry.objects.filter(dining_list__date__gte=date_start, dining_list__date__lte=date_end)
+
+    # The verified memberships of all users that dined in the date range
+    memberships = defaultdict(set)
+    verified = UserMembership.objects.filter(is_verified=True, related_user__in=entries.values('user_id'))
+    for user_id, association_id in verified.values_list('related_user_id', 'association_id'):
+        memberships[user_id].add(association_id)
+
+    member_stats = defaultdict(lambda: {'diners_own': 0, 'weighted_eaters': 0})
+    user_counts = defaultdict(int)
+    for values in entries.order_by().values('dining_list__association_id', 'user_id').annotate(count=Count('id')):
+        association_id, user_id = values['dining_list__association_id'], values['user_id']
+        if association_id in memberships[user_id]:
+            member_stats[association_id]['diners_own'] += values['count']
+        user_counts[user_id] += values['count']
+
+    # Each meal of a user is divided over the associations the user is a member of
+    for user_id, count in user_counts.items():
+        for association_id in memberships[user_id]:
+            member_stats[association_id]['weighted_eaters'] += count / len(memberships[user_id])
+    return member_stats
+
+
+def compute_association_stats(date_start, date_end):
+    """Computes the dining statistics of all associations.
+
+    Returns:
+        A dictionary from association id to a dictionary with the association, lists_claimed, cooked_for,
+        cooked_for_own and weighted_eaters.
+    """
+    totals = get_totals(date_start, date_end)
+    member_stats = compute_member_stats(date_start, date_end)
+    association_stats = {}
+    for association in Association.objects.all():
+        stats = totals[association.id]
+        association_stats[association.id] = {
+            'association': association,
+            'lists_claimed': stats['lists'],
+            'cooked_for': stats['diners'],
+            'cooked_for_own': member_stats[association.id]['diners_own'],
+            'weighted_eaters': member_stats[association.id]['weighted_eaters'],
+        }
+    return association_stats
+
+
+def get_association_stats(date_start, date_end):
+    """Returns the (cached) dining statistics of all associations, see compute_association_stats."""
+    if not is_closed_range(date_start, date_end):
+        return compute_association_stats(date_start, date_end)
+
+    key = 'dining_stats:{}:{}:{}'.format(_get_version(), date_start.isoformat(), date_end.isoformat())
+    stats = cache.get(key)
+    if stats is None:
+        stats = compute_association_stats(date_start, date_end)
+        cache.set(key, stats, timeout=settings.DINING_STATS_CACHE_TIMEOUT)
+    return stats
+
+
+def get_site_money_flow(date_start, date_end):
+    """Returns the money that entered (influx) and left (outflux) the site in the date range.
+
+    The end date itself is not included, the range ends at the start of that day.
+    """
+    stats = get_totals(date_start, date_end - timedelta(days=1))[None]
+    influx, outflux = Decimal(stats['inflow']), Decimal(stats['outflow'])
+    return {
+        'influx': influx,
+        'outflux': outflux,
+        'nettoflux': influx - outflux,
+    }
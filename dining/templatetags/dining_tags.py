@@ -7,13 +7,25 @@ from django.utils import timezone
 
 from dining.forms import DiningEntryUserCreateForm, DiningEntryDeleteForm
 from dining.models import DiningEntry, DiningEntryUser, DiningList
+from dining.viewer_state import format_owner_names
 from userdetails.models import User
 
 register = template.Library()
 
 
+def _get_viewer_state(dining_list, user):
+    """Returns the precomputed viewer state of the dining list (see dining/viewer_state.py) if available."""
+    state = getattr(dining_list, 'viewer_state', None)
+    if state is not None and state.is_for(user):
+        return state
+    return None
+
+
 @register.filter
 def can_join(dining_list, user):
+    state = _get_viewer_state(dining_list, user)
+    if state:
+        return state.can_join
     # Try creating an entry
     entry = DiningEntryUser(dining_list=dining_list, created_by=user)
     form = DiningEntryUserCreateForm({'user': str(user.pk)}, instance=entry)
@@ -23,6 +35,9 @@ def can_join(dining_list, user):
 @register.filter
 def cant_join_reason(dining_list, user):
     """Returns the reason why someone can't join (raises exception when they can join)."""
+    state = _get_viewer_state(dining_list, user)
+    if state and state.cant_join_reason:
+        return state.cant_join_reason
     entry = DiningEntryUser(dining_list=dining_list, created_by=user)
     form = DiningEntryUserCreateForm({'user': str(user.pk)}, instance=entry)
     return form.non_field_errors()[0]
@@ -45,18 +60,27 @@ def can_add_others(dining_list, user):
 
 @register.filter
 def has_joined(dining_list, user):
+    state = _get_viewer_state(dining_list, user)
+    if state:
+        return state.has_joined
     return dining_list.internal_dining_entries().filter(user=user).exists()
 
 
 @register.filter
 def can_delete_entry(entry, user):
     """Returns whether given user can delete the entry."""
+    state = _get_viewer_state(entry.dining_list, user)
+    if state and state.entry is entry:
+        return state.can_delete_entry
     return DiningEntryDeleteForm(entry, user, {}).is_valid()
 
 
 @register.filter
 def get_entry(dining_list, user):
     """Gets the user entry (not external) for given user."""
+    state = _get_viewer_state(dining_list, user)
+    if state:
+        return state.entry
     return DiningEntryUser.objects.filter(dining_list=dining_list, user=user).first()
 
 
@@ -78,6 +102,9 @@ def paid_count(dining_list):
 
 @register.filter
 def is_owner(dining_list, user):
+    state = _get_viewer_state(dining_list, user)
+    if state:
+        return state.is_owner
     return dining_list.is_owner(user)
 
 
@@ -133,15 +160,4 @@ def short_owners_string(dining_list: DiningList) -> str:
     Returns:
         Names of the owners separated by ',' and 'and'
     """
-    owners = dining_list.owners.all()
-
-    if len(owners) > 1:
-        names = [o.first_name for o in owners]
-    else:
-        names = [o.get_full_name() for o in owners]
-
-    if len(names) >= 2:
-        # Join all but last names by ',' and put 'and' in front of last name
-        commaseparated = ', '.join(names[0:-1])
-        return '{} and {}'.format(commaseparated, names[-1])
-    return names[0]
+    return format_owner_names(dining_list.owners.all())
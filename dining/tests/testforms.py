@@ -1,9 +1,11 @@
 from datetime import time, timedelta
 from decimal import Decimal
 
+from django.core.cache import cache
 from django.test import TestCase
 from django.utils import timezone
 
+from creditmanagement import balance_cache
 from creditmanagement.models import FixedTransaction
 from dining.forms import CreateSlotForm
 from dining.models import DiningList
@@ -70,6 +72,13 @@ class CreateSlotFormTestCase(TestCase):
         FixedTransaction.objects.create(source_user=self.user1, amount=Decimal('99'))
         self.assertFalse(self.form.is_valid())
 
+    def test_insufficient_balance_ignores_cache(self):
+        FixedTransaction.objects.create(source_user=self.user1, amount=Decimal('99'))
+        # An old balance that another worker process did not invalidate
+        cache.set(balance_cache._key('user', self.user1.pk), Decimal('10.00'))
+        self.addCleanup(cache.clear)
+        self.assertFalse(self.form.is_valid())
+
     def test_insufficient_balance_exception(self):
         FixedTransaction.objects.create(source_user=self.user1, amount=Decimal('99'))
         # Make user member of another association that has the exception
@@ -5,7 +5,7 @@ from django.core.exceptions import ValidationError
 from django.test import TestCase
 from django.utils import timezone
 
-from dining.models import DiningEntryUser, DiningEntryExternal
+from dining.models import DiningEntry, DiningEntryUser, DiningEntryExternal
 from dining.models import DiningList
 from userdetails.models import User, Association
 
@@ -101,3 +101,37 @@ class DiningEntryExternalTestCase(TestCase):
     def test_clean_valid_name(self):
         entry = DiningEntryExternal(user=self.user, dining_list=self.dining_list, name='Piet', created_by=self.user)
         entry.full_clean()  # No ValidationError
+
+
+class DiningEntryTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('piet')
+        cls.association = Association.objects.create(slug='assoc')
+        cls.dining_list = DiningList.objects.create(date=date(2123, 2, 1), association=cls.association,
+                                                    sign_up_deadline=datetime(2100, 1, 1, tzinfo=timezone.utc))
+        cls.user_entry = DiningEntryUser.objects.create(dining_list=cls.dining_list, user=cls.user,
+                                                        created_by=cls.user)
+        cls.external_entry = DiningEntryExternal.objects.create(dining_list=cls.dining_list, user=cls.user,
+                                                                created_by=cls.user, name='Guest')
+
+    def test_entry_type(self):
+        self.assertEqual(self.user_entry.entry_type, DiningEntry.USER)
+        self.assertEqual(self.external_entry.entry_type, DiningEntry.EXTERNAL)
+
+    def test_proxy_managers(self):
+        self.assertEqual(list(DiningEntryUser.objects.all()), [self.user_entry])
+        self.assertEqual(list(DiningEntryExternal.objects.all()), [self.external_entry])
+
+    def test_polymorphic(self):
+        """Entries are instances of their proxy model without additional queries."""
+        with self.assertNumQueries(1):
+            entries = list(self.dining_list.dining_entries.order_by('pk'))
+            self.assertEqual([type(entry) for entry in entries], [DiningEntryUser, DiningEntryExternal])
+            self.assertEqual([entry.get_subclass() for entry in entries], entries)
+        self.assertEqual(DiningEntry.objects.get(pk=self.external_entry.pk).get_name(), 'Guest')
+
+    def test_get_subclass(self):
+        entry = DiningEntry(entry_type=DiningEntry.EXTERNAL, name='Guest')
+        self.assertIsInstance(entry.get_subclass(), DiningEntryExternal)
+        self.assertFalse(entry.get_subclass().is_internal())
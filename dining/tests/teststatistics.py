@@ -0,0 +1,96 @@
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from io import StringIO
+
+from django.core.cache import cache
+from django.core.management import call_command
+from django.test import TestCase
+from django.utils import timezone
+
+from creditmanagement.models import FixedTransaction
+from dining import statistics
+from dining.models import DiningList, DiningEntryUser, DiningEntryExternal, DailyAssociationStats
+from userdetails.models import Association, User, UserMembership
+
+
+class AssociationStatsTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.association1 = Association.objects.create(name='Q', slug='q')
+        self.association2 = Association.objects.create(name='R', slug='r')
+        self.user1 = User.objects.create_user('ankie', 'ankie@universe.cat')
+        self.user2 = User.objects.create_user('noortje', 'noortje@universe.cat')
+        # user1 is a member of both, user2 of none
+        for association in (self.association1, self.association2):
+            UserMembership.objects.create(related_user=self.user1, association=association, is_verified=True,
+                                          verified_on=timezone.now())
+
+        for day in (1, 2):
+            dining_list = DiningList.objects.create(date=date(2020, 3, day), association=self.association1,
+                                                    sign_up_deadline=datetime(2020, 3, day, tzinfo=timezone.utc))
+            DiningEntryUser.objects.create(dining_list=dining_list, user=self.user1, created_by=self.user1)
+            DiningEntryUser.objects.create(dining_list=dining_list, user=self.user2, created_by=self.user2)
+        DiningEntryExternal.objects.create(dining_list=dining_list, user=self.user1, created_by=self.user1,
+                                           name='Guest')
+
+    def test_stats(self):
+        stats = statistics.get_association_stats(date(2020, 3, 1), date(2020, 3, 31))
+        q, r = stats[self.association1.pk], stats[self.association2.pk]
+        self.assertEqual((2, 5, 3), (q['lists_claimed'], q['cooked_for'], q['cooked_for_own']))
+        self.assertEqual((0, 0, 0), (r['lists_claimed'], r['cooked_for'], r['cooked_for_own']))
+        # The 3 entries of user1 are divided over both associations
+        self.assertEqual(1.5, q['weighted_eaters'])
+        self.assertEqual(1.5, r['weighted_eaters'])
+
+    def test_closed_range_cached(self):
+        statistics.get_association_stats(date(2020, 3, 1), date(2020, 3, 31))
+        with self.assertNumQueries(1):
+            # Only the check whether the range is closed
+            statistics.get_association_stats(date(2020, 3, 1), date(2020, 3, 31))
+
+    def test_membership_change_invalidates(self):
+        statistics.get_association_stats(date(2020, 3, 1), date(2020, 3, 31))
+        UserMembership.objects.create(related_user=self.user2, association=self.association1, is_verified=True,
+                                      verified_on=timezone.now())
+        stats = statistics.get_association_stats(date(2020, 3, 1), date(2020, 3, 31))
+        self.assertEqual(5, stats[self.association1.pk]['cooked_for_own'])
+
+    def test_membership_change_after_rollup(self):
+        call_command('rollup_daily_stats', stdout=StringIO())
+        UserMembership.objects.create(related_user=self.user2, association=self.association1, is_verified=True,
+                                      verified_on=timezone.now())
+        stats = statistics.get_association_stats(date(2020, 3, 1), date(2020, 3, 31))
+        self.assertEqual(5, stats[self.association1.pk]['cooked_for_own'])
+        # user2 is now a member of a single association
+        self.assertEqual(3.5, stats[self.association1.pk]['weighted_eaters'])
+
+    def test_open_range_not_cached(self):
+        self.assertFalse(statistics.is_closed_range(date(2020, 3, 1), timezone.now().date()))
+
+    def test_rollup(self):
+        FixedTransaction.objects.create(source_user=self.user1, amount=Decimal('3.00'))
+        FixedTransaction.objects.create(target_association=self.association2, amount=Decimal('5.00'))
+        live = statistics.compute_association_stats(date(2020, 3, 1), date(2020, 3, 31))
+
+        call_command('rollup_daily_stats', stdout=StringIO())
+        self.assertEqual(statistics.get_last_locked_date(), DailyAssociationStats.get_rolled_up_until())
+        day = DailyAssociationStats.objects.get(date=date(2020, 3, 2), association=self.association1)
+        self.assertEqual((1, 3, 1, Decimal('1.50')), (day.lists, day.diners, day.guests, day.kitchen_cost))
+
+        # The stored rows are used, only the statistics that depend on the memberships are computed from the entries
+        with self.assertNumQueries(5):
+            stored = statistics.compute_association_stats(date(2020, 3, 1), date(2020, 3, 31))
+        self.assertEqual(live, stored)
+
+        # Today is not rolled up yet and is computed from the transactions, the end date is not included
+        today = timezone.now().date()
+        flow = statistics.get_site_money_flow(date(2020, 3, 1), today)
+        self.assertEqual(Decimal('0.00'), flow['influx'])
+        flow = statistics.get_site_money_flow(date(2020, 3, 1), today + timedelta(days=1))
+        self.assertEqual(Decimal('3.00'), flow['influx'])
+        self.assertEqual(Decimal('5.00'), flow['outflux'])
+
+        # Running it again does nothing
+        out = StringIO()
+        call_command('rollup_daily_stats', stdout=out)
+        self.assertIn('up to date', out.getvalue())
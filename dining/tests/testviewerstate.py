@@ -0,0 +1,75 @@
+from datetime import timedelta
+
+from django.core.cache import cache
+from django.test import TestCase
+from django.utils import timezone
+
+from dining.models import DiningList, DiningEntryUser
+from dining.templatetags import dining_tags
+from dining.viewer_state import get_viewer_states
+from userdetails.models import Association, User, UserMembership
+
+
+class ViewerStateTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.association = Association.objects.create(name="Quadrivium", slug='q')
+        self.user = User.objects.create_user('jan', email='jan@universe.cat', first_name='Jan')
+        self.owner = User.objects.create_user('piet', email='piet@universe.cat', first_name='Piet')
+        self.date = timezone.now().date() + timedelta(days=2)
+        deadline = timezone.now() + timedelta(days=1)
+
+        def create_list(**kwargs):
+            dining_list = DiningList.objects.create(date=self.date, association=self.association,
+                                                    sign_up_deadline=kwargs.pop('sign_up_deadline', deadline),
+                                                    **kwargs)
+            dining_list.owners.add(self.owner)
+            return dining_list
+
+        self.open_list = create_list()
+        self.closed_list = create_list(sign_up_deadline=timezone.now() - timedelta(hours=1))
+        self.full_list = create_list(max_diners=1)
+        DiningEntryUser.objects.create(dining_list=self.full_list, user=self.owner, created_by=self.owner)
+        self.members_list = create_list(limit_signups_to_association_only=True)
+        self.joined_list = create_list()
+        DiningEntryUser.objects.create(dining_list=self.joined_list, user=self.user, created_by=self.user)
+        self.owned_list = create_list(sign_up_deadline=timezone.now() - timedelta(hours=1))
+        self.owned_list.owners.add(self.user)
+
+    def test_matches_filters(self):
+        """The precomputed state must give the same answers as the form based filters."""
+        states = {d.pk: d for d in get_viewer_states(DiningList.objects.filter(date=self.date), self.user)}
+        for dining_list in DiningList.objects.filter(date=self.date):
+            precomputed = states[dining_list.pk]
+            can_join = dining_tags.can_join(dining_list, self.user)
+            self.assertEqual(can_join, dining_tags.can_join(precomputed, self.user), dining_list.pk)
+            if not can_join:
+                self.assertEqual(dining_tags.cant_join_reason(dining_list, self.user),
+                                 dining_tags.cant_join_reason(precomputed, self.user))
+            self.assertEqual(dining_tags.has_joined(dining_list, self.user),
+                             dining_tags.has_joined(precomputed, self.user))
+            self.assertEqual(dining_tags.get_entry(dining_list, self.user),
+                             dining_tags.get_entry(precomputed, self.user))
+            self.assertEqual(dining_tags.is_owner(dining_list, self.user),
+                             dining_tags.is_owner(precomputed, self.user))
+            self.assertEqual(dining_tags.short_owners_string(dining_list),
+                             dining_tags.short_owners_string(precomputed))
+
+    def test_members_only(self):
+        UserMembership.objects.create(related_user=self.user, association=self.association, is_verified=True,
+                                      verified_on=timezone.now())
+        dining_list = get_viewer_states(DiningList.objects.filter(pk=self.members_list.pk), self.user)[0]
+        self.assertTrue(dining_list.viewer_state.can_join)
+
+    def test_constant_queries(self):
+        # Dining lists + owners + entries + memberships + balance
+        with self.assertNumQueries(5):
+            dining_lists = get_viewer_states(DiningList.objects.filter(date=self.date), self.user)
+        with self.assertNumQueries(0):
+            for dining_list in dining_lists:
+                dining_tags.can_join(dining_list, self.user)
+                dining_tags.has_joined(dining_list, self.user)
+                dining_tags.short_owners_string(dining_list)
+                entry = dining_tags.get_entry(dining_list, self.user)
+                if entry:
+                    dining_tags.can_delete_entry(entry, self.user)
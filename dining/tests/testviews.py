@@ -0,0 +1,239 @@
+import csv
+from datetime import date, datetime
+
+from django.core import mail
+from django.core.cache import cache
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from dining.models import DiningList, DiningEntry, DiningEntryUser, DiningEntryExternal, DiningComment
+from general.mail_control import send_queued_mail
+from userdetails.models import Association, User, UserMembership
+
+
+class DailyDinersCSVViewTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.superuser = User.objects.create_superuser('admin', 'admin@universe.cat', 'password')
+        cls.association1 = Association.objects.create(name='Q', slug='q')
+        cls.association2 = Association.objects.create(name='R', slug='r')
+        cls.user1 = User.objects.create_user('ankie', 'ankie@universe.cat', first_name='Ankie', last_name='Cat')
+        cls.user2 = User.objects.create_user('noortje', 'noortje@universe.cat', first_name='Noortje')
+        UserMembership.objects.create(related_user=cls.user1, association=cls.association1, is_verified=True,
+                                      verified_on=timezone.now())
+        UserMembership.objects.create(related_user=cls.user1, association=cls.association2, is_verified=True,
+                                      verified_on=timezone.now())
+        # Not verified
+        UserMembership.objects.create(related_user=cls.user2, association=cls.association2)
+
+        for day in (1, 2, 3):
+            dining_list = DiningList.objects.create(date=date(2020, 3, day), association=cls.association1,
+                                                    sign_up_deadline=datetime(2020, 3, day, tzinfo=timezone.utc))
+            DiningEntryUser.objects.create(dining_list=dining_list, user=cls.user1, created_by=cls.user1)
+            if day == 2:
+                DiningEntryUser.objects.create(dining_list=dining_list, user=cls.user2, created_by=cls.user2)
+
+    def test_csv(self):
+        self.client.force_login(self.superuser)
+        response = self.client.get(reverse('diners_csv'), {'from': '01/03/20', 'to': '02/03/20'})
+        rows = list(csv.reader(b''.join(response.streaming_content).decode().splitlines()))
+
+        self.assertEqual(['Name', 'Joined', 'Q', 'R'], rows[0])
+        self.assertCountEqual([['Ankie Cat', '2', '1', '1'], ['Noortje', '1', '0', '0']], rows[1:])
+
+    def test_no_superuser(self):
+        self.client.force_login(self.user1)
+        self.assertEqual(403, self.client.get(reverse('diners_csv')).status_code)
+
+
+class CommentCountersTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('ankie', 'ankie@universe.cat')
+        cls.poster = User.objects.create_user('noortje', 'noortje@universe.cat')
+        association = Association.objects.create(name='Q', slug='q')
+        cls.dining_list = DiningList.objects.create(date=date(2123, 1, 4), association=association,
+                                                    sign_up_deadline=datetime(2100, 2, 2, tzinfo=timezone.utc))
+
+    def setUp(self):
+        # Discard cached visits of other tests
+        cache.clear()
+
+    def post_comment(self, message):
+        self.client.force_login(self.poster)
+        self.client.post(self.dining_list.get_absolute_url(), {'message': message})
+
+    def get_comment_counts(self):
+        self.client.force_login(self.user)
+        context = self.client.get(reverse('slot_allergy', kwargs={
+            'year': 2123, 'month': 1, 'day': 4, 'identifier': 'q'})).context
+        return context['comments_total'], context['comments_unread']
+
+    def test_counters(self):
+        self.post_comment('Hello')
+        self.post_comment('World')
+        self.dining_list.refresh_from_db()
+        self.assertEqual(self.dining_list.comment_count, 2)
+        self.assertEqual(self.dining_list.latest_comment_timestamp, DiningComment.objects.latest('timestamp').timestamp)
+
+        DiningComment.objects.latest('timestamp').delete()
+        self.dining_list.refresh_from_db()
+        self.assertEqual(self.dining_list.comment_count, 1)
+        self.assertEqual(self.dining_list.latest_comment_timestamp, DiningComment.objects.get().timestamp)
+
+    def test_save_does_not_overwrite_counters(self):
+        dining_list = DiningList.objects.get(pk=self.dining_list.pk)
+        self.post_comment('Hello')
+        dining_list.dish = 'Pasta'
+        dining_list.save()
+        dining_list.refresh_from_db()
+        self.assertEqual(dining_list.comment_count, 1)
+
+    def test_unread(self):
+        self.post_comment('Hello')
+        self.assertEqual(self.get_comment_counts(), (1, True))
+        self.client.get(self.dining_list.get_absolute_url())
+        self.assertEqual(self.get_comment_counts(), (1, False))
+        self.post_comment('World')
+        self.assertEqual(self.get_comment_counts(), (2, True))
+
+    def test_no_comment_queries(self):
+        self.post_comment('Hello')
+        self.client.force_login(self.user)
+        self.client.get(self.dining_list.get_absolute_url())
+        self.post_comment('World')
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.get_comment_counts(), (2, True))
+        self.assertFalse([query['sql'] for query in queries if DiningComment._meta.db_table in query['sql']])
+
+
+class SlotListViewTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = User.objects.create_user('ankie', 'ankie@universe.cat')
+        association = Association.objects.create(name='Q', slug='q')
+        cls.dining_list = DiningList.objects.create(date=date(2123, 1, 4), association=association,
+                                                    sign_up_deadline=datetime(2100, 2, 2, tzinfo=timezone.utc))
+        cls.dining_list.owners.add(cls.owner)
+        cls.entry = DiningEntryUser.objects.create(dining_list=cls.dining_list, user=cls.owner, created_by=cls.owner)
+        cls.external = DiningEntryExternal.objects.create(dining_list=cls.dining_list, user=cls.owner,
+                                                          created_by=cls.owner, name='Guest')
+        cls.url = reverse('slot_list', kwargs={'year': 2123, 'month': 1, 'day': 4, 'identifier': 'q'})
+
+    def setUp(self):
+        self.client.force_login(self.owner)
+
+    def post_stats(self, checked, version=0, entries=None):
+        data = {'stats_version': version, 'entries': entries or [e.pk for e in self.dining_list.dining_entries.all()]}
+        data.update({key: 'on' for key in checked})
+        return self.client.post(self.url, data)
+
+    def test_update_stats(self):
+        self.post_stats(['{}:has_paid'.format(self.entry.pk), '{}:has_cooked'.format(self.entry.pk),
+                         '{}:has_paid'.format(self.external.pk)])
+        self.entry.refresh_from_db()
+        self.external.refresh_from_db()
+        self.assertTrue(self.entry.has_paid)
+        self.assertTrue(self.entry.has_cooked)
+        self.assertFalse(self.entry.has_shopped)
+        self.assertTrue(self.external.has_paid)
+
+        self.post_stats(['{}:has_cleaned'.format(self.entry.pk)], version=1)
+        self.entry.refresh_from_db()
+        self.assertFalse(self.entry.has_paid)
+        self.assertFalse(self.entry.has_cooked)
+        self.assertTrue(self.entry.has_cleaned)
+
+    def test_conflict(self):
+        self.post_stats(['{}:has_paid'.format(self.entry.pk)])
+        # The page was loaded before the first post
+        response = self.post_stats(['{}:has_cooked'.format(self.entry.pk)])
+        self.assertEqual(len(list(response.wsgi_request._messages)), 1)
+        self.entry.refresh_from_db()
+        self.assertTrue(self.entry.has_paid)
+        self.assertFalse(self.entry.has_cooked)
+
+    def test_conflict_with_other_change(self):
+        # E.g. changed on the admin site after the page was loaded
+        external = DiningEntry.objects.get(pk=self.external.pk)
+        external.has_paid = True
+        external.save()
+        response = self.post_stats(['{}:has_cooked'.format(self.entry.pk)])
+        self.assertEqual(len(list(response.wsgi_request._messages)), 1)
+        self.entry.refresh_from_db()
+        self.assertFalse(self.entry.has_cooked)
+
+        # A deleted entry changes the version as well
+        version = DiningList.objects.get(pk=self.dining_list.pk).stats_version
+        external.delete()
+        self.assertEqual(DiningList.objects.get(pk=self.dining_list.pk).stats_version, version + 1)
+
+    def test_entry_added_in_meantime(self):
+        user = User.objects.create_user('noortje', 'noortje@universe.cat')
+        entry = DiningEntryUser.objects.create(dining_list=self.dining_list, user=user, created_by=self.owner,
+                                               has_paid=True)
+        self.post_stats([], entries=[self.entry.pk])
+        entry.refresh_from_db()
+        self.assertTrue(entry.has_paid)
+
+    def test_number_of_queries(self):
+        """The number of queries does not depend on the number of entries."""
+        def count_queries():
+            checked = []
+            for entry in self.dining_list.dining_entries.all():
+                checked += ['{}:has_paid'.format(entry.pk), '{}:has_shopped'.format(entry.pk)]
+            version = DiningList.objects.get(pk=self.dining_list.pk).stats_version
+            with CaptureQueriesContext(connection) as queries:
+                self.post_stats(checked, version=version)
+            # All entries were updated
+            self.assertFalse(self.dining_list.dining_entries.filter(has_paid=False).exists())
+            DiningEntry.objects.update(has_paid=False)
+            return len(queries)
+
+        few = count_queries()
+        for i in range(40):
+            user = User.objects.create_user('diner{}'.format(i), 'diner{}@universe.cat'.format(i))
+            DiningEntryUser.objects.create(dining_list=self.dining_list, user=user, created_by=user)
+        self.assertEqual(count_queries(), few)
+
+
+@override_settings(EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend')
+class DeletionMailTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = User.objects.create_user('ankie', 'ankie@universe.cat', first_name='Ankie')
+        cls.diner = User.objects.create_user('noortje', 'noortje@universe.cat', first_name='Noortje')
+        association = Association.objects.create(name='Q', slug='q')
+        cls.dining_list = DiningList.objects.create(date=date(2123, 1, 4), association=association, dish='Kwark',
+                                                    sign_up_deadline=datetime(2100, 2, 2, tzinfo=timezone.utc))
+        cls.dining_list.owners.add(cls.owner)
+        cls.entry = DiningEntryUser.objects.create(dining_list=cls.dining_list, user=cls.diner, created_by=cls.diner)
+        cls.external = DiningEntryExternal.objects.create(dining_list=cls.dining_list, user=cls.diner,
+                                                          created_by=cls.diner, name='Guest')
+
+    def setUp(self):
+        self.client.force_login(self.owner)
+
+    def test_entry_removed(self):
+        for entry in (self.entry, self.external):
+            self.client.post(reverse('entry_delete', kwargs={'pk': entry.pk}))
+        self.assertFalse(DiningEntry.objects.exists())
+
+        # The mails are sent after the entries are deleted
+        send_queued_mail()
+        bodies = {message.subject: message.body for message in mail.outbox}
+        self.assertIn('your guest Guest', bodies["Your guest has been removed from the dining list of 2123-01-04"])
+        self.assertIn('Ankie has removed you', bodies["You've been removed from the dining list of 2123-01-04"])
+
+    def test_dining_list_deleted(self):
+        DiningEntry.objects.all().delete()
+        DiningEntryUser.objects.create(dining_list=self.dining_list, user=self.diner, created_by=self.owner)
+        self.client.post(reverse('slot_delete', kwargs={'year': 2123, 'month': 1, 'day': 4, 'identifier': 'q'}))
+        self.assertFalse(DiningList.objects.exists())
+
+        self.assertEqual(1, send_queued_mail().sent)
+        self.assertIn('Kwark', mail.outbox[0].body)
+        self.assertIn('Date: Monday 4 January\nDish: Kwark\nBy: Ankie', mail.outbox[0].body)
@@ -0,0 +1,109 @@
+"""Computes what a user can see and do on the dining lists of a day.
+
+The template filters in dining/templatetags/dining_tags.py evaluate a form for every dining list, which results in
+several queries per list. get_viewer_states computes the same information for all dining lists at once and stores
+it on the dining lists as `viewer_state`, the filters use it when it is available.
+"""
+from django.conf import settings
+from django.db.models import Count
+
+from creditmanagement.models import UserCredit
+from dining.models import DiningEntryUser
+
+
+def format_owner_names(owners) -> str:
+    """Returns the names of the owners in short form, see short_owners_string."""
+    if len(owners) > 1:
+        names = [o.first_name for o in owners]
+    else:
+        names = [o.get_full_name() for o in owners]
+
+    if len(names) >= 2:
+        # Join all but last names by ',' and put 'and' in front of last name
+        commaseparated = ', '.join(names[0:-1])
+        return '{} and {}'.format(commaseparated, names[-1])
+    return names[0]
+
+
+class DiningListViewerState:
+    """The state of a single dining list as seen by a user."""
+
+    def __init__(self, dining_list, user, is_owner, entry, cant_join_reason):
+        self.dining_list = dining_list
+        self.user = user
+        self.is_owner = is_owner
+        # The (internal) entry of the user on the list
+        self.entry = entry
+        # The reason why the user can't join, None when the user can join
+        self.cant_join_reason = cant_join_reason
+
+    @property
+    def has_joined(self):
+        return self.entry is not None
+
+    @property
+    def can_join(self):
+        return self.cant_join_reason is None
+
+    @property
+    def can_delete_entry(self):
+        """Whether the user can delete their own entry, see DiningEntryDeleteForm."""
+        return self.dining_list.is_adjustable() and (self.is_owner or self.dining_list.is_open())
+
+    def is_for(self, user):
+        return self.user.pk == user.pk
+
+
+def _get_cant_join_reason(dining_list, is_owner, is_member, has_low_balance, entry):
+    """Returns the first validation error of DiningEntryUserCreateForm for the user joining themselves."""
+    if not dining_list.is_adjustable():
+        return "Dining list can no longer be adjusted"
+    if not is_owner and not dining_list.is_open():
+        return "Dining list is closed"
+    if not is_owner and dining_list.diner_count >= dining_list.max_diners:
+        return "Dining list is full"
+    if dining_list.limit_signups_to_association_only and not is_owner and not is_member:
+        return "Dining list is limited for members only"
+    if has_low_balance:
+        return "The balance of the user is too low to add"
+    if entry is not None:
+        return "User is already on the dining list"
+    return None
+
+
+def get_viewer_states(dining_lists, user):
+    """Computes the viewer state of all given dining lists for the user in a constant number of queries.
+
+    Args:
+        dining_lists: A queryset of dining lists.
+        user: The user viewing the dining lists.
+
+    Returns:
+        A list of the dining lists, each with the attributes `diner_count` and `viewer_state`.
+    """
+    dining_lists = list(dining_lists.select_related('association').prefetch_related('owners').annotate(
+        diner_count=Count('dining_entries')))
+    if not dining_lists:
+        return dining_lists
+
+    entries = {}
+    for entry in DiningEntryUser.objects.filter(dining_list__in=dining_lists, user=user).order_by('-pk'):
+        # The first entry is used when there are several, same as get_entry
+        entries[entry.dining_list_id] = entry
+
+    memberships = list(user.get_verified_memberships().select_related('association'))
+    member_of = {membership.association_id for membership in memberships}
+    has_min_balance_exception = any(membership.association.has_min_exception for membership in memberships)
+    has_low_balance = not has_min_balance_exception and \
+        UserCredit.get_balance(user) < settings.MINIMUM_BALANCE_FOR_DINING_SIGN_UP
+
+    for dining_list in dining_lists:
+        is_owner = any(owner.pk == user.pk for owner in dining_list.owners.all())
+        entry = entries.get(dining_list.pk)
+        if entry is not None:
+            entry.dining_list = dining_list
+        reason = _get_cant_join_reason(dining_list, is_owner, dining_list.association_id in member_of,
+                                       has_low_balance, entry)
+        dining_list.viewer_state = DiningListViewerState(dining_list, user, is_owner, entry, reason)
+
+    return dining_lists
@@ -1,11 +1,12 @@
-import csv
+from collections import defaultdict
 from datetime import date, datetime
 
 from django.contrib import messages
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.core.exceptions import NON_FIELD_ERRORS, PermissionDenied
+from django.db import transaction
 from django.db.models import Q, Count
-from django.http import Http404, HttpResponseRedirect, HttpResponseForbidden, HttpResponse
+from django.http import Http404, HttpResponseRedirect, HttpResponseForbidden, HttpResponseBadRequest
 from django.shortcuts import redirect, get_object_or_404
 from django.urls import reverse
 from django.utils import timezone
@@ -19,8 +20,10 @@ from dining.forms import CreateSlotForm, DiningEntryUserCreateForm, DiningEntryE
     DiningEntryDeleteForm, DiningCommentForm, DiningInfoForm, DiningPaymentForm, DiningListDeleteForm
 from dining.models import DiningList, DiningDayAnnouncement, DiningCommentVisitTracker, DiningEntryExternal, \
     DiningEntryUser, DiningEntry
-from general.mail_control import send_templated_mass_mail, send_templated_mail
-from userdetails.models import User, Association
+from dining.viewer_state import get_viewer_states, format_owner_names
+from general.mail_control import queue_templated_mass_mail, queue_templated_mail
+from general.util import streaming_csv_response
+from userdetails.models import User, Association, UserMembership
 
 
 def index(request):
@@ -77,7 +80,8 @@ class DayView(LoginRequiredMixin, DayMixin, TemplateView):
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
 
-        context['dining_lists'] = DiningList.objects.filter(date=self.date)
+        # Precompute what the user can do on each list, the template filters use it
+        context['dining_lists'] = get_viewer_states(DiningList.objects.filter(date=self.date), self.request.user)
         context['Announcements'] = DiningDayAnnouncement.objects.filter(date=self.date)
 
         # Make the view clickable
@@ -93,7 +97,7 @@ class DailyDinersCSVView(LoginRequiredMixin, View):
 
         # Only superusers can access this page
         if not request.user.is_superuser:
-            return HttpResponseForbidden
+            return HttpResponseForbidden()
 
         # Get the end date
         date_end = request.GET.get('to', None)
@@ -118,41 +122,29 @@ class DailyDinersCSVView(LoginRequiredMixin, View):
         users = User.objects.annotate(diningentry_count=entry_count)
         users = users.filter(diningentry_count__gt=0)
 
-        # Get the related membership objects for speed optimisation
-        users.select_related('usermembership')
-
         # Get all associations
-        associations = Association.objects.all()
-
-        # Create the CSV file
-        # Set up
-        response = HttpResponse(content_type='text/csv')
-        response['Content-Disposition'] = 'attachment; filename="association_members.csv"'
-        csv_writer = csv.writer(response)
-
-        # Write header
-        header = ['Name', 'Joined']
-        for association in associations:
-            header += [association.name]
-
-        csv_writer.writerow(header)
-
-        # Write content
-        for user in users:
-            user_info = [user.get_full_name(), user.diningentry_count]
-
-            # Get all associated memberships
-            memberships = []
-            for association in associations:
-                if user.is_verified_member_of(association):
-                    memberships.append(1)
-                else:
-                    memberships.append(0)
+        associations = list(Association.objects.all())
+
+        # Build the membership matrix in memory, using a single query for all users
+        memberships = defaultdict(set)
+        verified = UserMembership.objects.filter(is_verified=True, related_user__in=users.values('pk'))
+        for user_id, association_id in verified.values_list('related_user_id', 'association_id'):
+            memberships[user_id].add(association_id)
 
-            csv_writer.writerow(user_info + memberships)
+        def rows():
+            # Header
+            yield ['Name', 'Joined'] + [association.name for association in associations]
 
-        # Return the CSV file
-        return response
+            # Content
+            user_rows = users.order_by().values_list('pk', 'first_name', 'last_name', 'diningentry_count')
+            for user_id, first_name, last_name, diningentry_count in user_rows.iterator():
+                # Same as User.get_full_name()
+                name = '{} {}'.format(first_name, last_name).strip()
+                user_memberships = memberships[user_id]
+                yield [name, diningentry_count] + [
+                    1 if association.pk in user_memberships else 0 for association in associations]
+
+        return streaming_csv_response(rows(), 'association_members.csv')
 
 
 class NewSlotView(LoginRequiredMixin, DayMixin, TemplateView):
@@ -209,19 +201,14 @@ class DiningListMixin(DayMixin):
 
 
 class UpdateSlotViewTrackerMixin:
-    """Sets comments_total and comments_unread context variables."""
+    """Sets comments_total and comments_unread context variables, comments_unread is whether there are any."""
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        # Get the amount of messages
-        context['comments_total'] = self.dining_list.diningcomment_set.count()
-        # Get the amount of unread messages
+        # The counters are stored on the dining list and the latest visit is cached
         view_time = DiningCommentVisitTracker.get_latest_visit(user=self.request.user, dining_list=self.dining_list)
-        if view_time is None:
-            context['comments_unread'] = context['comments_total']
-        else:
-            context['comments_unread'] = self.dining_list.diningcomment_set.filter(timestamp__gte=view_time).count()
-
+        context['comments_total'] = self.dining_list.comment_count
+        context['comments_unread'] = self.dining_list.has_unread_comments(view_time)
         return context
 
 
@@ -267,8 +254,8 @@ class EntryAddView(SlotMixin, TemplateView):
                     context = {'entry': entry, 'dining_list': entry.dining_list}
 
                     # Send mail to the people on the dining list
-                    send_templated_mail(subject=subject, template_name=template, context_data=context,
-                                        recipient=entry.user)
+                    queue_templated_mail(subject=subject, template_name=template, context_data=context,
+                                         recipient=entry.user)
                     msg = "You successfully added {} to the dining list".format(entry.user.get_short_name())
             else:
                 msg = "You successfully added {} to the dining list".format(entry.name)
@@ -303,17 +290,20 @@ class EntryDeleteView(LoginRequiredMixin, SingleObjectMixin, View):
                 subject = "Your guest has been removed from the dining list of {date}".format(
                     date=entry.dining_list.date)
                 template = "dining/dining_list_entry_external_removed_by"
-                context = {'entry': entry, 'dining_list': entry.dining_list, 'remover': request.user}
+                # The entry is deleted before the mail is sent
+                context = {'entry': {'name': entry.name, 'user': str(entry.user)}, 'dining_list': entry.dining_list,
+                           'remover': request.user}
 
                 # Send mail to the people on the dining list
-                send_templated_mail(subject=subject, template_name=template, context_data=context, recipient=entry.user)
+                queue_templated_mail(subject=subject, template_name=template, context_data=context, recipient=entry.user)
 
             success_msg = "The external diner is removed from the dining list"
         else:
             # Set up the mail
             subject = "You've been removed from the dining list of {date}".format(date=entry.dining_list.date)
             template = "dining/dining_list_entry_removed_by"
-            context = {'entry': entry, 'dining_list': entry.dining_list, 'remover': request.user}
+            # The entry is deleted before the mail is sent
+            context = {'entry': {'user': str(entry.user)}, 'dining_list': entry.dining_list, 'remover': request.user}
 
             success_msg = "The user is removed from the dining list"
 
@@ -324,7 +314,7 @@ class EntryDeleteView(LoginRequiredMixin, SingleObjectMixin, View):
 
             if entry.user != request.user:
                 # Send mail to the removed user
-                send_templated_mail(subject=subject, template_name=template, context_data=context, recipient=entry.user)
+                queue_templated_mail(subject=subject, template_name=template, context_data=context, recipient=entry.user)
 
             messages.success(request, success_msg)
         else:
@@ -345,96 +335,35 @@ class SlotListView(SlotMixin, TemplateView):
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         # Select related eliminates the extra queries during rendering of the template
-        entries = self.dining_list.dining_entries.select_related('user', 'diningentryuser', 'diningentryexternal')
+        entries = self.dining_list.dining_entries.select_related('user')
         entries = entries.order_by('user__first_name')
         context['entries'] = entries
         return context
 
-    # Todo: fix complexity
-    def post(self, request, *args, **kwargs):  # noqa: C901
+    def post(self, request, *args, **kwargs):
         if not self.dining_list.is_owner(request.user):
             raise PermissionDenied
 
-        # Check for edit conflict, not very elegant but this post method needs to be rewritten anyway
-        conflict = False
-        for entry in self.dining_list.dining_entries.all():
-            entry = entry.get_subclass()
-            if entry.is_internal():
-                initial_shop = request.POST.get('initial_entry{}_shop'.format(entry.pk))
-                if initial_shop and initial_shop != str(entry.has_shopped):
-                    conflict = True
-                    break
-                initial_cook = request.POST.get('initial_entry{}_cook'.format(entry.pk))
-                if initial_cook and initial_cook != str(entry.has_cooked):
-                    conflict = True
-                    break
-                initial_clean = request.POST.get('initial_entry{}_clean'.format(entry.pk))
-                if initial_clean and initial_clean != str(entry.has_cleaned):
-                    conflict = True
-                    break
-            initial_paid = request.POST.get('initial_entry{}_paid'.format(entry.pk))
-            if initial_paid and initial_paid != str(entry.has_paid):
-                conflict = True
-                break
-        if conflict:
-            messages.error(request, 'Someone else modified the stats while you were changing them, your changes have '
-                                    'not been saved. We apologize for the inconvenience')
-            return HttpResponseRedirect(self.reverse('slot_list'))
-
-        # Get all the keys in the post and put all relevant ones in a list
-        post_requests = []
+        try:
+            version = int(request.POST.get('stats_version'))
+        except (TypeError, ValueError):
+            return HttpResponseBadRequest()
+        # The entries that were on the page, the stats of entries that were added in the meantime are not changed
+        entry_ids = request.POST.getlist('entries')
+        # The checked boxes are posted as '<entry id>:<field>'
+        checked = defaultdict(set)
         for key in request.POST:
-            key = key.split(":")
+            key = key.split(':')
             if len(key) == 2:
-                post_requests.append(key)
-
-        # Process payment for all entries
-        entries = {}
-
-        # For all entries in the dining list, set the paid value to false
-        for entry in self.dining_list.dining_entries.all():
-            entry.has_paid = False
-            entries[str(entry.id)] = entry
-
-        # Go over all keys in the request containing has_paid, adjust the state on that object
-        for key in post_requests:
-            if key[1] == 'has_paid':
-                try:
-                    entries[key[0]].has_paid = True
-                except KeyError:
-                    # Entry doesn't exist any more
-                    pass
-
-        # save all has_paid values
-        for entry in entries.values():
-            entry.save()
-
-        # Adjust the help stats
-        entries = {}
-
-        # For all entries in the dining list, set the values to false
-        for entry in self.dining_list.internal_dining_entries():
-            entry.has_shopped = False
-            entry.has_cooked = False
-            entry.has_cleaned = False
-            entries[str(entry.id)] = entry
-
-        # Go over all keys in the request containing has_paid, adjust the state on that object
-        for key in post_requests:
-            try:
-                if key[1] == "has_shopped":
-                    entries[key[0]].has_shopped = True
-                elif key[1] == "has_cooked":
-                    entries[key[0]].has_cooked = True
-                elif key[1] == "has_cleaned":
-                    entries[key[0]].has_cleaned = True
-            except KeyError:
-                # Entry doesn't exist any more
-                pass
-
-        # save all has_paid values
-        for entry in entries.values():
-            entry.save()
+                checked[key[0]].add(key[1])
+
+        with transaction.atomic():
+            if not self.dining_list.increment_stats_version(version):
+                messages.error(request, 'Someone else modified the stats while you were changing them, your changes '
+                                        'have not been saved. We apologize for the inconvenience')
+                return HttpResponseRedirect(self.reverse('slot_list'))
+
+            self.dining_list.update_entry_stats(entry_ids, checked)
 
         return HttpResponseRedirect(self.reverse('slot_list'))
 
@@ -569,7 +498,10 @@ class SlotDeleteView(SlotMixin, SlotOwnerMixin, DeleteView):
             # Set up the mail
             subject = "Dining list {date} cancelled".format(date=instance.date)
             template = "dining/dining_list_deleted"
-            context = {'dining_list': instance,
+            # The dining list is deleted before the mail is sent
+            context = {'dining_list': {'association': str(instance.association), 'date': instance.date,
+                                       'dish': instance.dish},
+                       'owners': format_owner_names(instance.owners.all()),
                        'cancelled_by': request.user,
                        'day_view_url': day_view_url}
             diners = instance.diners
@@ -585,10 +517,10 @@ class SlotDeleteView(SlotMixin, SlotOwnerMixin, DeleteView):
             form.execute()
 
             # Send mail to the people on the dining list
-            send_templated_mass_mail(template_name=template,
-                                     subject=subject,
-                                     context_data=context,
-                                     recipients=diners)
+            queue_templated_mass_mail(template_name=template,
+                                      subject=subject,
+                                      context_data=context,
+                                      recipients=diners)
 
             messages.success(request, "Dining list is deleted")
 
@@ -620,10 +552,10 @@ class SlotPaymentView(SlotMixin, SlotOwnerMixin, View):
 
             users = User.objects.filter(diningentry__in=unpaid_user_entries)
 
-            send_templated_mass_mail(template_name=template,
-                                     subject=subject,
-                                     context_data=context,
-                                     recipients=users)
+            queue_templated_mass_mail(template_name=template,
+                                      subject=subject,
+                                      context_data=context,
+                                      recipients=users)
             is_informed = True
 
         if unpaid_guest_entries.count() > 0:
@@ -644,17 +576,17 @@ class SlotPaymentView(SlotMixin, SlotOwnerMixin, View):
                 if len(guests) == 1:
                     context["guest"] = guests[0]
                     context["guests"] = None
-                    send_templated_mail(subject=subject,
-                                        template_name=template,
-                                        context_data=context,
-                                        recipient=user)
+                    queue_templated_mail(subject=subject,
+                                         template_name=template,
+                                         context_data=context,
+                                         recipient=user)
                 else:
                     context["guest"] = None
                     context["guests"] = guests
-                    send_templated_mail(subject=subject,
-                                        template_name=template,
-                                        context_data=context,
-                                        recipient=user)
+                    queue_templated_mail(subject=subject,
+                                         template_name=template,
+                                         context_data=context,
+                                         recipient=user)
 
             is_informed = True
 
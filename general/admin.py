@@ -1,6 +1,6 @@
 from django.contrib import admin
 
-from .models import SiteUpdate, PageVisitTracker
+from .models import SiteUpdate, PageVisitTracker, QueuedMail
 
 
 def mail_users(modeladmin, request, queryset):
@@ -16,3 +16,13 @@ class SiteUpdateAdmin(admin.ModelAdmin):
 
 admin.site.register(SiteUpdate, SiteUpdateAdmin)
 admin.site.register(PageVisitTracker)
+
+
+class QueuedMailAdmin(admin.ModelAdmin):
+    list_display = ('subject', 'recipient', 'created_on', 'send_after', 'attempts')
+    list_filter = ('attempts',)
+    readonly_fields = ('recipient', 'subject', 'template_name', 'created_on', 'last_error')
+    exclude = ('data',)
+
+
+admin.site.register(QueuedMail, QueuedMailAdmin)
@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class GeneralConfig(AppConfig):
     name = 'general'
+
+    def ready(self):
+        # noinspection PyUnresolvedReferences
+        import general.receivers  # noqa F401
@@ -0,0 +1,238 @@
+"""Performance benchmark of the heaviest pages and commands.
+
+Seeds a synthetic dataset and measures the number of queries, the wall time and the peak (Python) memory usage of
+each scenario. Use the benchmark management command to run it on a fresh test database, the results are written as
+JSON so that they can be compared between commits.
+"""
+import random
+import tracemalloc
+from datetime import timedelta
+from decimal import Decimal
+from io import StringIO
+from statistics import median
+from time import perf_counter
+
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.test import Client, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from creditmanagement.models import AbstractTransaction, FixedTransaction, PendingTransaction
+from dining.datesequence import sequenced_date
+from dining.models import DiningList, DiningEntryUser, DiningEntryExternal, UserDiningSettings
+from userdetails.models import Association, User, UserMembership
+
+DEFAULT_SCALE = {
+    'users': 2000,
+    'associations': 10,
+    'days': 60,
+    'lists_per_day': 5,
+    'diners_per_list': 12,
+    'transactions': 10000,
+}
+
+
+class BenchmarkData:
+    """The objects that the scenarios use, created by seed()."""
+
+    def __init__(self, user, association, dining_list, date_start, date_end):
+        self.user = user
+        self.association = association
+        self.dining_list = dining_list
+        self.date_start = date_start
+        self.date_end = date_end
+
+
+def seed(scale=None, random_seed=0):
+    """Fills the database with a synthetic dataset.
+
+    Args:
+        scale: A dictionary overriding the sizes in DEFAULT_SCALE.
+        random_seed: Seed for the random generator, the same seed results in the same dataset.
+
+    Returns:
+        A BenchmarkData instance.
+    """
+    scale = dict(DEFAULT_SCALE, **(scale or {}))
+    rng = random.Random(random_seed)
+    now = timezone.now()
+    today = now.date()
+
+    with transaction.atomic():
+        associations = [Association.objects.create(name='Association {}'.format(i), slug='assoc{}'.format(i),
+                                                   has_site_stats_access=True)
+                        for i in range(scale['associations'])]
+
+        # Bulk creation skips the receivers, the credits are rebuilt at the end
+        User.objects.bulk_create([
+            User(username='user{}'.format(i), email='user{}@example.com'.format(i), first_name='First{}'.format(i),
+                 last_name='Last{}'.format(i)) for i in range(scale['users'])
+        ])
+        users = list(User.objects.order_by('pk'))
+        UserDiningSettings.objects.bulk_create([UserDiningSettings(user=user) for user in users])
+        UserMembership.objects.bulk_create([
+            UserMembership(related_user=user, association=rng.choice(associations), is_verified=True,
+                           verified_on=now) for user in users
+        ])
+
+        user = users[0]
+        user.is_superuser = True
+        user.is_staff = True
+        user.save()
+        user.groups.add(associations[0])
+
+        # Dining lists in the past (finalisable) and in the coming week
+        for day in range(-scale['days'], 7):
+            date = today + timedelta(days=day)
+            if not sequenced_date.in_sequence(date):
+                continue
+            for association in associations[:scale['lists_per_day']]:
+                dining_list = DiningList.objects.create(
+                    date=date, association=association, max_diners=scale['diners_per_list'] + 10,
+                    sign_up_deadline=now + timedelta(days=day))
+                owner = user if association == associations[0] else rng.choice(users)
+                dining_list.owners.add(owner)
+                for diner in rng.sample(users, min(scale['diners_per_list'], len(users))):
+                    DiningEntryUser.objects.create(dining_list=dining_list, user=diner, created_by=diner)
+                DiningEntryExternal.objects.create(dining_list=dining_list, user=owner, created_by=owner,
+                                                   name='Guest')
+
+        # Mostly fixed transactions, the expired pending transactions are used by the finalise scenario
+        fixed_transactions = []
+        pending_transactions = []
+        for i in range(scale['transactions']):
+            moment = now - timedelta(minutes=rng.randint(60, scale['days'] * 24 * 60))
+            kwargs = {
+                'amount': Decimal(rng.randint(1, 2000)) / 100,
+                'order_moment': moment,
+                'confirm_moment': moment,
+                'description': 'Benchmark transaction {}'.format(i),
+                'target_user': rng.choice(users),
+            }
+            if i % 3 == 0:
+                kwargs['source_association'] = rng.choice(associations)
+            else:
+                kwargs['source_user'] = rng.choice(users)
+            if i % 10 == 0:
+                pending_transactions.append(PendingTransaction(**kwargs))
+            else:
+                fixed_transactions.append(FixedTransaction(**kwargs))
+        FixedTransaction.objects.bulk_create(fixed_transactions)
+        PendingTransaction.objects.bulk_create(pending_transactions)
+
+        call_command('reconcile_balances', '--rebuild', stdout=StringIO())
+
+    dining_list = DiningList.objects.get(date=sequenced_date.upcoming(), association=associations[0])
+    return BenchmarkData(user, associations[0], dining_list, today - timedelta(days=scale['days']), today)
+
+
+def get_scenarios(data):
+    """Returns the benchmark scenarios as a list of (name, function, repeatable) tuples."""
+    client = Client()
+    client.force_login(data.user)
+
+    d = data.dining_list.date
+    date_kwargs = {'day': d.day, 'month': d.month, 'year': d.year}
+    slot_kwargs = dict(date_kwargs, identifier=data.association.slug)
+    association_kwargs = {'association_name': data.association.slug}
+
+    def get(url, params=None):
+        def scenario():
+            response = client.get(url, params)
+            if response.streaming:
+                # Streamed content is only generated when it is read
+                for _ in response.streaming_content:
+                    pass
+            return response.status_code
+        return scenario
+
+    def finalise():
+        call_command('finalise_transactions', stdout=StringIO())
+        return None
+
+    def balances(engine):
+        def scenario():
+            with override_settings(BALANCE_ENGINE=engine):
+                list(AbstractTransaction.annotate_balance(users=User.objects.all()))
+            return None
+        return scenario
+
+    return [
+        ('day_view', get(reverse('day_view', kwargs=date_kwargs)), True),
+        ('slot_list_view', get(reverse('slot_list', kwargs=slot_kwargs)), True),
+        ('slot_info_view', get(reverse('slot_details', kwargs=slot_kwargs)), True),
+        ('dining_history_view', get(reverse('history_lists')), True),
+        ('transaction_list_view', get(reverse('credits:transaction_list')), True),
+        ('credits_overview', get(reverse('association_credits', kwargs=association_kwargs)), True),
+        ('association_site_dining_view', get(reverse('association_site_dining_stats', kwargs=association_kwargs),
+                                             {'date_start': data.date_start.isoformat(),
+                                              'date_end': data.date_end.isoformat()}), True),
+        ('daily_diners_csv_view', get(reverse('diners_csv'), {'from': data.date_start.strftime('%d/%m/%y'),
+                                                              'to': data.date_end.strftime('%d/%m/%y')}), True),
+        # The balances of all users, compare the engines with a varying number of users (see the README)
+        ('user_balances_subquery', balances('subquery'), True),
+        ('user_balances_grouped', balances('grouped'), True),
+        # Finalising changes the data, so it can only be measured once and is done last
+        ('finalise_transactions', finalise, False),
+    ]
+
+
+class QueryCounter:
+    """Database execute wrapper that counts the queries, unlike connection.queries it has no limit."""
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+def measure(function, repeat=1):
+    """Runs function repeat times and measures the queries, wall time and peak memory.
+
+    Memory tracing slows down the code considerably, so the peak memory and the number of queries are measured in
+    the first run and the wall time in the other runs (unless there is only one).
+
+    Returns:
+        A dictionary with the results.
+    """
+    queries = QueryCounter()
+    tracemalloc.start()
+    with connection.execute_wrapper(queries):
+        start = perf_counter()
+        status = function()
+        wall_times = [perf_counter() - start]
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    if repeat > 1:
+        wall_times = []
+        for _ in range(repeat - 1):
+            start = perf_counter()
+            function()
+            wall_times.append(perf_counter() - start)
+
+    return {
+        'status': status,
+        'queries': queries.count,
+        'wall_time': median(wall_times),
+        'wall_time_min': min(wall_times),
+        'peak_memory': peak_memory,
+        'runs': repeat,
+    }
+
+
+def run(data, repeat=3, only=None):
+    """Runs all (or only the given) scenarios on the seeded data.
+
+    Returns:
+        A dictionary from scenario name to the measure() result.
+    """
+    results = {}
+    for name, function, repeatable in get_scenarios(data):
+        if only and name not in only:
+            continue
+        results[name] = measure(function, repeat=repeat if repeatable else 1)
+    return results
@@ -1,4 +1,5 @@
 from django.db import migrations
+from django.db.migrations.exceptions import IrreversibleError
 from django.apps import apps
 
 
@@ -17,6 +18,9 @@ def drop_view(schema_editor, model):
 
 
 def create_view(schema_editor, model):
+    if not hasattr(model, 'view'):
+        # The model is no longer a database view, its definition can not be generated from the current models
+        return
     args = {
         'table': schema_editor.quote_name(model._meta.db_table),
         'definition': str(model.view()),
@@ -51,6 +55,9 @@ class DeleteView(migrations.DeleteModel):
     def database_backwards(self, app_label, schema_editor, from_state, to_state):
         models = apps.get_app_config(app_label).models_module
         model = getattr(models, self.name)
+        if not hasattr(model, 'view'):
+            raise IrreversibleError("The view of {} can no longer be created, as the model is no longer a view".format(
+                self.name))
 
         # Ensure there is no view with this name
         drop_view(schema_editor, model)
@@ -1,8 +1,19 @@
+import json
+from datetime import date, datetime, time
+from decimal import Decimal
+from time import perf_counter
+
+from django.apps import apps
+from django.conf import settings
 from django.core.mail import EmailMultiAlternatives, get_connection
+from django.db import models, transaction
 from django.template.loader import get_template, TemplateDoesNotExist
+from django.utils import timezone
+
+from general.models import QueuedMail
 
 
-def _render_and_send_mail(*args, txt_template=None, html_template=None, context_data={}, fail_silently=False, **kwargs):
+def _render_mail(*args, txt_template=None, html_template=None, context_data={}, **kwargs):
     # Set up the Email template with the txt_template
     mail_obj = EmailMultiAlternatives(*args, **kwargs, body=txt_template.render(context_data))
 
@@ -11,8 +22,12 @@ def _render_and_send_mail(*args, txt_template=None, html_template=None, context_
         content_html = html_template.render(context_data)
         mail_obj.attach_alternative(content_html, "text/html")
 
+    return mail_obj
+
+
+def _render_and_send_mail(*args, fail_silently=False, **kwargs):
     # Send the mail
-    mail_obj.send(fail_silently=fail_silently)
+    _render_mail(*args, **kwargs).send(fail_silently=fail_silently)
 
 
 def _get_mail_templates(full_template_name):
@@ -70,5 +85,204 @@ def send_templated_mass_mail(subject=None, template_name=None, context_data: dic
                               txt_template=txt_template,
                               html_template=html_template,
                               context_data=context_data,
-                              to=to, **kwargs)
+                              to=to, connection=connection, **kwargs)
     connection.close()
+
+
+# Mail queue
+#
+# The functions below store the mails in the QueuedMail table instead of sending them directly, so that requests do
+# not have to wait for the mail server. The send_queued_mail management command sends them.
+#
+# The template context is stored as JSON. Model instances are stored as a reference and are loaded again when the
+# mail is sent, objects that are deleted before that (e.g. a removed entry) must be passed as plain values.
+
+_TYPES = {'datetime': datetime.fromisoformat, 'date': date.fromisoformat, 'time': time.fromisoformat,
+          'decimal': Decimal}
+
+
+def _encode_value(value):
+    if isinstance(value, models.Model):
+        if value.pk is None:
+            raise ValueError("Can't queue a mail with an unsaved or deleted {}".format(type(value).__name__))
+        return {'__model__': value._meta.label_lower, 'pk': value.pk}
+    # datetime before date, as it is a subclass
+    for name, cls in (('datetime', datetime), ('date', date), ('time', time)):
+        if isinstance(value, cls):
+            return {'__' + name + '__': value.isoformat()}
+    if isinstance(value, Decimal):
+        return {'__decimal__': str(value)}
+    raise TypeError("Can't queue a mail with a {} in the context".format(type(value).__name__))
+
+
+def encode_mail_data(context_data, kwargs) -> str:
+    """Returns the JSON of QueuedMail.data."""
+    return json.dumps({'context': context_data, 'kwargs': kwargs}, default=_encode_value)
+
+
+def decode_mail_data(data, objects=None) -> dict:
+    """Decodes QueuedMail.data, the referenced model instances are loaded from the database.
+
+    Args:
+        objects: A dictionary in which the loaded instances are stored, so that mails that refer to the same
+            objects can share them.
+
+    Raises:
+        ObjectDoesNotExist: When a referenced object no longer exists.
+    """
+    objects = {} if objects is None else objects
+
+    def decode(value):
+        if '__model__' in value:
+            key = (value['__model__'], value['pk'])
+            if key not in objects:
+                objects[key] = apps.get_model(value['__model__'])._default_manager.get(pk=value['pk'])
+            return objects[key]
+        for name, parse in _TYPES.items():
+            if '__' + name + '__' in value:
+                return parse(value['__' + name + '__'])
+        return value
+
+    return json.loads(data, object_hook=decode)
+
+
+def queue_templated_mass_mail(subject=None, template_name=None, context_data: dict = None, recipients=None, **kwargs):
+    """Queues a mail for all recipients, see send_templated_mass_mail for the arguments.
+
+    The plain values in the context data are stored directly, later changes to them are not included in the mail.
+    Model instances are loaded again when the mail is sent.
+    """
+    data = encode_mail_data(context_data or {}, kwargs)
+    QueuedMail.objects.bulk_create([
+        QueuedMail(recipient=recipient, subject=subject, template_name=template_name, data=data)
+        for recipient in recipients
+    ])
+
+
+def queue_templated_mail(subject=None, template_name=None, context_data=None, recipient=None, **kwargs):
+    """Queues a mail for a single recipient, see send_templated_mail for the arguments."""
+    if recipient is None:
+        raise KeyError("No email target given. Please define the recipient")
+    queue_templated_mass_mail(subject=subject, template_name=template_name, context_data=context_data,
+                              recipients=[recipient], **kwargs)
+
+
+class MailQueueResult:
+    """The number of mails that were sent or failed by send_queued_mail and the duration."""
+
+    def __init__(self):
+        self.sent = 0
+        self.failed = 0
+        self.duration = 0.0
+        # The error of the mail connection that stopped the run
+        self.error = None
+
+    @property
+    def throughput(self):
+        """Returns the number of mails sent per second."""
+        return self.sent / self.duration if self.duration else 0.0
+
+    def __str__(self):
+        text = "Sent {} mails ({} failed) in {:.2f}s, {:.1f} mails/s".format(
+            self.sent, self.failed, self.duration, self.throughput)
+        if self.error:
+            text += ", stopped: {}".format(self.error)
+        return text
+
+
+def _format_error(e):
+    return "{}: {}".format(type(e).__name__, e)
+
+
+def _render_queued_mail(queued_mail, connection, objects):
+    data = decode_mail_data(queued_mail.data, objects)
+    context_data = data['context']
+    context_data['user'] = queued_mail.recipient
+    return _render_mail(subject=queued_mail.subject,
+                        txt_template=_get_mail_templates(queued_mail.template_name + ".txt"),
+                        html_template=_get_mail_templates(queued_mail.template_name + ".html"),
+                        context_data=context_data,
+                        to=[queued_mail.recipient.email], connection=connection, **data['kwargs'])
+
+
+def _claim_batch(size, max_attempts):
+    """Returns the next due mails and postpones them, so that other workers skip them while they are sent.
+
+    A mail of which the worker stops is sent again after MAIL_QUEUE_CLAIM_DURATION.
+    """
+    with transaction.atomic():
+        # Rows locked by another worker are skipped (on databases that support it)
+        batch = list(QueuedMail.objects.select_for_update(skip_locked=True).filter(
+            attempts__lt=max_attempts, send_after__lte=timezone.now()
+        ).select_related('recipient').order_by('id')[:size])
+        QueuedMail.objects.filter(id__in=[queued_mail.id for queued_mail in batch]).update(
+            send_after=timezone.now() + settings.MAIL_QUEUE_CLAIM_DURATION)
+    return batch
+
+
+def _release(queued_mails):
+    """Makes the claimed mails due again, without counting an attempt."""
+    QueuedMail.objects.filter(id__in=[queued_mail.id for queued_mail in queued_mails]).update(
+        send_after=timezone.now())
+
+
+def send_queued_mail(batch_size=None, max_attempts=None, limit=None):
+    """Sends the queued mails that are due in batches over a single connection.
+
+    Each mail is removed from the queue as soon as it is sent. A mail that fails is retried later with an exponential
+    backoff, until it has failed max_attempts times. Those mails stay in the queue for inspection. When the connection
+    to the mail server can't be opened the run stops and the remaining mails stay due.
+
+    Args:
+        batch_size: The number of mails that are fetched and sent at once.
+        max_attempts: The number of times a mail is tried.
+        limit: The maximum number of mails that are processed, None for all due mails.
+
+    Returns:
+        A MailQueueResult.
+    """
+    batch_size = batch_size or settings.MAIL_QUEUE_BATCH_SIZE
+    max_attempts = max_attempts or settings.MAIL_QUEUE_MAX_ATTEMPTS
+    result = MailQueueResult()
+    start = perf_counter()
+    # The model instances referred to by the mails, shared by all mails of the run
+    objects = {}
+
+    connection = get_connection()
+    is_open = False
+    try:
+        while limit is None or result.sent + result.failed < limit:
+            size = batch_size if limit is None else min(batch_size, limit - result.sent - result.failed)
+            batch = _claim_batch(size, max_attempts)
+            if not batch:
+                break
+
+            for i, queued_mail in enumerate(batch):
+                try:
+                    if not is_open:
+                        connection.open()
+                        is_open = True
+                except Exception as e:
+                    result.error = _format_error(e)
+                    _release(batch[i:])
+                    return result
+
+                try:
+                    _render_queued_mail(queued_mail, connection, objects).send()
+                except Exception as e:
+                    queued_mail.attempts += 1
+                    queued_mail.last_error = _format_error(e)
+                    queued_mail.send_after = timezone.now() + \
+                        settings.MAIL_QUEUE_RETRY_DELAY * 2 ** (queued_mail.attempts - 1)
+                    queued_mail.save(update_fields=['attempts', 'last_error', 'send_after'])
+                    result.failed += 1
+                    # The connection might be broken, it is opened again for the next mail
+                    connection.close()
+                    is_open = False
+                else:
+                    QueuedMail.objects.filter(id=queued_mail.id).delete()
+                    result.sent += 1
+    finally:
+        connection.close()
+        result.duration = perf_counter() - start
+    return result
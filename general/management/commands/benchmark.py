@@ -0,0 +1,64 @@
+import json
+import subprocess
+import sys
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import setup_databases, teardown_databases, setup_test_environment, \
+    teardown_test_environment
+from django.utils import timezone
+
+from general import benchmark
+
+
+def _get_git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Command(BaseCommand):
+    help = 'Seeds a synthetic dataset in a test database and benchmarks the heaviest pages and commands'
+
+    def add_arguments(self, parser):
+        for name, default in benchmark.DEFAULT_SCALE.items():
+            parser.add_argument('--' + name.replace('_', '-'), type=int, default=default, dest=name,
+                                help='Size of the dataset (default {})'.format(default))
+        parser.add_argument('--repeat', type=int, default=3, help='Number of runs per scenario')
+        parser.add_argument('--seed', type=int, default=0, help='Seed of the random dataset')
+        parser.add_argument('--scenario', action='append', dest='scenarios',
+                            help='Only run the given scenario, can be used multiple times')
+        parser.add_argument('--output', help='Write the JSON results to this file instead of stdout')
+        parser.add_argument('--keepdb', action='store_true', help='Keep the test database between runs')
+
+    def handle(self, *args, **options):
+        scale = {name: options[name] for name in benchmark.DEFAULT_SCALE}
+
+        # Never touch the real database, the dataset is created in the test database
+        setup_test_environment()
+        old_config = setup_databases(verbosity=0, interactive=False, keepdb=options['keepdb'])
+        try:
+            start = timezone.now()
+            data = benchmark.seed(scale, random_seed=options['seed'])
+            self.stderr.write('Seeded the dataset in {:.1f}s'.format((timezone.now() - start).total_seconds()))
+            results = benchmark.run(data, repeat=options['repeat'], only=options['scenarios'])
+        finally:
+            teardown_databases(old_config, verbosity=0, keepdb=options['keepdb'])
+            teardown_test_environment()
+
+        report = {
+            'commit': _get_git_commit(),
+            'timestamp': timezone.now().isoformat(),
+            'database': connection.vendor,
+            'python': sys.version.split()[0],
+            'scale': scale,
+            'results': results,
+        }
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output + '\n')
+        else:
+            self.stdout.write(output)
@@ -0,0 +1,34 @@
+from time import sleep
+
+from django.core.management.base import BaseCommand
+
+from general import metrics
+from general.mail_control import send_queued_mail
+
+
+class Command(BaseCommand):
+    help = 'Sends the mails in the mail queue'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=None,
+                            help='The number of mails sent at once, defaults to the MAIL_QUEUE_BATCH_SIZE setting')
+        parser.add_argument('--max-attempts', type=int, default=None,
+                            help='The number of times a mail is tried, defaults to MAIL_QUEUE_MAX_ATTEMPTS')
+        parser.add_argument('--limit', type=int, default=None, help='Stop after this number of mails')
+        parser.add_argument('--loop', action='store_true', help='Keep checking the queue for new mails')
+        parser.add_argument('--sleep', type=float, default=10, help='Seconds between queue checks with --loop')
+
+    def handle(self, *args, **options):
+        while True:
+            result = send_queued_mail(batch_size=options['batch_size'], max_attempts=options['max_attempts'],
+                                      limit=options['limit'])
+            metrics.MAILS_SENT.inc(result.sent)
+            metrics.MAILS_FAILED.inc(result.failed)
+            metrics.MAIL_SEND_DURATION.observe(result.duration)
+            metrics.flush()
+            if result.sent or result.failed or result.error or not options['loop']:
+                style = self.style.SUCCESS if not result.failed and not result.error else self.style.WARNING
+                self.stdout.write(style(str(result)))
+            if not options['loop']:
+                break
+            sleep(options['sleep'])
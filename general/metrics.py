@@ -0,0 +1,191 @@
+"""Runtime metrics in the Prometheus text format, aggregated over all worker processes.
+
+Every process adds its counter increments and histogram observations to an in-memory buffer, which is added to a
+SQLite database at METRICS_PATH at most every METRICS_FLUSH_INTERVAL seconds (and when the metrics are read). The
+database is shared by all gunicorn workers and management commands on the same machine, SQLite takes care of the
+locking between the processes. MetricsView serves the totals at /metrics. Nothing is recorded unless METRICS_ENABLED
+is set.
+
+The metrics are defined at the bottom of this module, e.g.
+
+    SIGN_UPS.inc(kind='user')
+    FINALISATION_DURATION.observe(1.5, kind='PendingTransaction')
+"""
+import sqlite3
+import threading
+from collections import defaultdict
+from time import monotonic, perf_counter
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.http import HttpResponse, Http404
+from django.utils.crypto import constant_time_compare
+from django.views import View
+
+_registry = []
+_buffer = defaultdict(float)
+_lock = threading.Lock()
+_last_flush = monotonic()
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+QUERY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels):
+    return ','.join('{}="{}"'.format(name, _escape(value)) for name, value in sorted(labels.items()))
+
+
+class Metric:
+    metric_type = None
+
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        _registry.append(self)
+
+    @staticmethod
+    def _add(name, labels, value):
+        if not settings.METRICS_ENABLED:
+            return
+        with _lock:
+            _buffer[(name, _format_labels(labels))] += value
+
+
+class Counter(Metric):
+    metric_type = 'counter'
+
+    def inc(self, value=1, **labels):
+        self._add(self.name + '_total', labels, value)
+
+
+class Histogram(Metric):
+    metric_type = 'histogram'
+
+    def __init__(self, name, documentation, buckets=DURATION_BUCKETS):
+        super().__init__(name, documentation)
+        self.buckets = buckets
+
+    def observe(self, value, **labels):
+        # The buckets are cumulative, the empty buckets are added as well so that every bucket is exported
+        for bound in self.buckets:
+            self._add(self.name + '_bucket', dict(labels, le=bound), 1 if value <= bound else 0)
+        self._add(self.name + '_bucket', dict(labels, le='+Inf'), 1)
+        self._add(self.name + '_sum', labels, value)
+        self._add(self.name + '_count', labels, 1)
+
+
+def _connect():
+    connection = sqlite3.connect(settings.METRICS_PATH, timeout=10, isolation_level=None)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('PRAGMA synchronous=NORMAL')
+    connection.execute('CREATE TABLE IF NOT EXISTS sample (name TEXT, labels TEXT, value REAL, '
+                       'PRIMARY KEY (name, labels))')
+    return connection
+
+
+def flush():
+    """Adds the buffered values of this process to the shared database."""
+    global _last_flush
+    with _lock:
+        values = list(_buffer.items())
+        _buffer.clear()
+        _last_flush = monotonic()
+    if not values:
+        return
+
+    connection = _connect()
+    try:
+        connection.execute('BEGIN IMMEDIATE')
+        connection.executemany(
+            'INSERT INTO sample (name, labels, value) VALUES (?, ?, ?) '
+            'ON CONFLICT (name, labels) DO UPDATE SET value = value + excluded.value',
+            [(name, labels, value) for (name, labels), value in values])
+        connection.execute('COMMIT')
+    finally:
+        connection.close()
+
+
+def maybe_flush():
+    """Flushes the buffer when the flush interval has passed."""
+    if monotonic() - _last_flush >= settings.METRICS_FLUSH_INTERVAL:
+        flush()
+
+
+def render():
+    """Returns the totals of all processes in the Prometheus text format."""
+    flush()
+    connection = _connect()
+    try:
+        samples = connection.execute('SELECT name, labels, value FROM sample ORDER BY name, labels').fetchall()
+    finally:
+        connection.close()
+
+    lines = []
+    for metric in sorted(_registry, key=lambda m: m.name):
+        lines.append('# HELP {} {}'.format(metric.name, metric.documentation))
+        lines.append('# TYPE {} {}'.format(metric.name, metric.metric_type))
+        for name, labels, value in samples:
+            if name.rpartition('_')[0] == metric.name:
+                lines.append('{}{{{}}} {}'.format(name, labels, repr(value)) if labels else
+                             '{} {}'.format(name, repr(value)))
+    return '\n'.join(lines) + '\n'
+
+
+class _QueryCounter:
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+class MetricsMiddleware:
+    """Records the duration and the number of queries of every request per URL name."""
+
+    def __init__(self, get_response):
+        if not settings.METRICS_ENABLED:
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+
+    def __call__(self, request):
+        counter = _QueryCounter()
+        start = perf_counter()
+        with connections['default'].execute_wrapper(counter):
+            response = self.get_response(request)
+        duration = perf_counter() - start
+
+        match = getattr(request, 'resolver_match', None)
+        view = match.view_name if match else 'unmatched'
+        REQUEST_DURATION.observe(duration, view=view, method=request.method)
+        REQUEST_QUERIES.observe(counter.count, view=view)
+        maybe_flush()
+        return response
+
+
+class MetricsView(View):
+    """Serves the metrics when they are enabled, the scraper needs to send the METRICS_TOKEN as bearer token."""
+
+    def get(self, request):
+        token = settings.METRICS_TOKEN
+        authorization = request.META.get('HTTP_AUTHORIZATION', '')
+        if not settings.METRICS_ENABLED or not token or not constant_time_compare(authorization, 'Bearer ' + token):
+            raise Http404()
+        return HttpResponse(render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+REQUEST_DURATION = Histogram('dining_request_duration_seconds', 'Duration of the requests per URL name.')
+REQUEST_QUERIES = Histogram('dining_request_queries', 'Number of database queries per request per URL name.',
+                            buckets=QUERY_BUCKETS)
+SIGN_UPS = Counter('dining_sign_ups', 'Dining list sign-ups, per kind of entry.')
+FINALISATION_DURATION = Histogram('dining_finalisation_duration_seconds',
+                                  'Duration of the finalisation of the expired pending transactions, per model.')
+FINALISED_TRANSACTIONS = Counter('dining_finalised_transactions', 'Finalised pending transactions, per model.')
+MAILS_SENT = Counter('dining_mails_sent', 'Mails sent by the mail queue worker.')
+MAILS_FAILED = Counter('dining_mails_failed', 'Mails of the mail queue that failed to send.')
+MAIL_SEND_DURATION = Histogram('dining_mail_send_duration_seconds', 'Duration of the mail queue runs.')
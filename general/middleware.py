@@ -0,0 +1,182 @@
+"""Instrumentation of the database queries of each request and profiling of single requests.
+
+QueryInstrumentationMiddleware counts the queries of a request and measures their duration with a database execute
+wrapper, which unlike connection.queries also works without DEBUG. The results are added to the response as a
+Server-Timing header and logged as a single JSON line. Requests that are slower or run more queries than the
+configured thresholds are logged as a warning and a sample of them is written as a report with the slowest
+statements and the repeated (N+1) statements grouped by call site.
+
+Queries of streaming responses that run while the content is streamed are not included.
+
+ProfilerMiddleware profiles a request of a superuser with cProfile, see general/profiling.py.
+"""
+import cProfile
+import json
+import logging
+import os
+import random
+import re
+import sys
+from collections import defaultdict
+from time import perf_counter
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.utils import timezone
+
+from general.profiling import save_profile
+
+logger = logging.getLogger(__name__)
+
+# Lists of placeholders, e.g. pk__in lookups, are collapsed so that they have the same fingerprint for any length
+_PLACEHOLDER_LIST = re.compile(r'\((?:%s|\?)(?:\s*,\s*(?:%s|\?))+\)')
+_WHITESPACE = re.compile(r'\s+')
+
+_SOURCE_ROOT = str(settings.BASE_DIR) + os.sep
+_THIS_FILE = os.path.abspath(__file__)
+
+
+def fingerprint(sql):
+    """Returns the normalised SQL statement, the parameters are already separate from the statement."""
+    return _PLACEHOLDER_LIST.sub('(...)', _WHITESPACE.sub(' ', sql)).strip()
+
+
+def _get_call_site():
+    """Returns the innermost frame in the project code as 'path:line in function'."""
+    frame = sys._getframe(2)
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if filename.startswith(_SOURCE_ROOT) and filename != _THIS_FILE and 'site-packages' not in filename:
+            return '{}:{} in {}'.format(filename[len(_SOURCE_ROOT):], frame.f_lineno, frame.f_code.co_name)
+        frame = frame.f_back
+    return 'unknown'
+
+
+class QueryRecorder:
+    """Database execute wrapper that records the fingerprint, duration and call site of every query."""
+
+    def __init__(self):
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        start = perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append((sql, perf_counter() - start, _get_call_site()))
+
+    @property
+    def count(self):
+        return len(self.queries)
+
+    @property
+    def duration(self):
+        return sum(duration for _, duration, _ in self.queries)
+
+    def get_slowest(self, number):
+        """Returns the slowest statements as a list of dictionaries."""
+        slowest = sorted(self.queries, key=lambda query: query[1], reverse=True)[:number]
+        return [{'sql': fingerprint(sql), 'ms': round(duration * 1000, 2), 'call_site': call_site}
+                for sql, duration, call_site in slowest]
+
+    def get_duplicates(self):
+        """Returns the statements that ran more than once grouped by fingerprint and call site, most frequent first."""
+        groups = defaultdict(lambda: [0, 0.0])
+        for sql, duration, call_site in self.queries:
+            group = groups[(fingerprint(sql), call_site)]
+            group[0] += 1
+            group[1] += duration
+        duplicates = [{'sql': sql, 'call_site': call_site, 'count': count, 'ms': round(duration * 1000, 2)}
+                      for (sql, call_site), (count, duration) in groups.items() if count > 1]
+        return sorted(duplicates, key=lambda duplicate: duplicate['count'], reverse=True)
+
+
+class QueryInstrumentationMiddleware:
+    """Measures the queries of each request, see the module documentation.
+
+    Configured with the QUERY_INSTRUMENTATION* settings, QUERY_INSTRUMENTATION_REPORT_DIR is the directory of the
+    slow request reports (they are logged when it is empty).
+    """
+
+    def __init__(self, get_response):
+        if not settings.QUERY_INSTRUMENTATION:
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+
+    def __call__(self, request):
+        recorder = QueryRecorder()
+        wrapped = []
+        start = perf_counter()
+        try:
+            for connection in connections.all():
+                connection.execute_wrappers.append(recorder)
+                wrapped.append(connection)
+            response = self.get_response(request)
+        finally:
+            for connection in wrapped:
+                connection.execute_wrappers.remove(recorder)
+        duration = perf_counter() - start
+
+        response['Server-Timing'] = 'db;dur={:.1f};desc="{} queries", total;dur={:.1f}'.format(
+            recorder.duration * 1000, recorder.count, duration * 1000)
+        self.log(request, response, recorder, duration)
+        return response
+
+    def log(self, request, response, recorder, duration):
+        """Logs the request and writes a report when it exceeds the thresholds."""
+        duplicates = recorder.get_duplicates()
+        record = {
+            'method': request.method,
+            'path': request.path,
+            'status': response.status_code,
+            'ms': round(duration * 1000, 1),
+            'queries': recorder.count,
+            'db_ms': round(recorder.duration * 1000, 1),
+            'duplicate_queries': sum(duplicate['count'] - 1 for duplicate in duplicates),
+        }
+        too_slow = duration * 1000 >= settings.QUERY_INSTRUMENTATION_SLOW_MS
+        too_many_queries = recorder.count >= settings.QUERY_INSTRUMENTATION_MAX_QUERIES
+        if not too_slow and not too_many_queries:
+            logger.info(json.dumps(record))
+            return
+
+        logger.warning(json.dumps(record))
+        if random.random() < settings.QUERY_INSTRUMENTATION_REPORT_RATE:
+            report = dict(record, time=timezone.now().isoformat(),
+                          slowest=recorder.get_slowest(settings.QUERY_INSTRUMENTATION_REPORT_SLOWEST),
+                          duplicates=duplicates[:settings.QUERY_INSTRUMENTATION_REPORT_SLOWEST])
+            self.write_report(report)
+
+    @staticmethod
+    def write_report(report):
+        directory = settings.QUERY_INSTRUMENTATION_REPORT_DIR
+        if not directory:
+            logger.warning(json.dumps(report))
+            return
+        os.makedirs(directory, exist_ok=True)
+        filename = '{}-{}.json'.format(timezone.now().strftime('%Y%m%d-%H%M%S-%f'), os.getpid())
+        with open(os.path.join(directory, filename), 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+class ProfilerMiddleware:
+    """Profiles the request when a superuser adds the PROFILER_TRIGGER query parameter or cookie.
+
+    The profile includes the template rendering of the view and is stored with general.profiling.save_profile, the
+    name is returned in the X-Profile header. Needs to come after AuthenticationMiddleware.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        trigger = settings.PROFILER_TRIGGER
+        # Only look at the user when the trigger is present, so other requests do not load it
+        if (trigger not in request.GET and not request.COOKIES.get(trigger)) or not request.user.is_superuser:
+            return self.get_response(request)
+
+        profiler = cProfile.Profile()
+        response = profiler.runcall(self.get_response, request)
+        response['X-Profile'] = save_profile(profiler, request)
+        return response
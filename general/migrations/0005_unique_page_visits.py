@@ -0,0 +1,33 @@
+from django.db import migrations, models
+from django.db.models import Count, Max
+import django.utils.timezone
+
+
+def remove_duplicate_visits(apps, schema_editor):
+    """Keeps only the latest visit of each user to each page."""
+    PageVisitTracker = apps.get_model('general', 'PageVisitTracker')
+    duplicates = PageVisitTracker.objects.values('user', 'page').annotate(count=Count('id'), latest=Max('timestamp'))
+    for duplicate in duplicates.filter(count__gt=1):
+        visits = PageVisitTracker.objects.filter(user=duplicate['user'], page=duplicate['page'])
+        keep = visits.filter(timestamp=duplicate['latest']).first()
+        visits.exclude(pk=keep.pk).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('general', '0004_queuedmail'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_visits, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='pagevisittracker',
+            name='timestamp',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AlterUniqueTogether(
+            name='pagevisittracker',
+            unique_together={('user', 'page')},
+        ),
+    ]
@@ -0,0 +1,59 @@
+import pickle
+
+from django.core.exceptions import ObjectDoesNotExist
+from django.db import migrations, models
+
+from general.mail_control import encode_mail_data, decode_mail_data
+
+
+def pickle_to_json(apps, schema_editor):
+    """Converts the context of the mails that are still queued."""
+    QueuedMail = apps.get_model('general', 'QueuedMail')
+    for queued_mail in QueuedMail.objects.all():
+        # The pickles were written by this application itself
+        data = pickle.loads(queued_mail.data)
+        queued_mail.json_data = encode_mail_data(data['context'], data['kwargs'])
+        queued_mail.save(update_fields=['json_data'])
+
+
+def json_to_pickle(apps, schema_editor):
+    """Converts the context back, mails that refer to objects that no longer exist can't be converted and are removed."""
+    QueuedMail = apps.get_model('general', 'QueuedMail')
+    for queued_mail in QueuedMail.objects.all():
+        try:
+            queued_mail.data = pickle.dumps(decode_mail_data(queued_mail.json_data))
+        except ObjectDoesNotExist:
+            queued_mail.delete()
+        else:
+            queued_mail.save(update_fields=['data'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('general', '0005_unique_page_visits'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='queuedmail',
+            name='json_data',
+            field=models.TextField(default=''),
+            preserve_default=False,
+        ),
+        migrations.AlterField(
+            model_name='queuedmail',
+            name='data',
+            field=models.BinaryField(default=b''),
+        ),
+        migrations.RunPython(pickle_to_json, json_to_pickle),
+        migrations.RemoveField(
+            model_name='queuedmail',
+            name='data',
+        ),
+        migrations.RenameField(
+            model_name='queuedmail',
+            old_name='json_data',
+            new_name='data',
+        ),
+    ]
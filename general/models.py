@@ -1,8 +1,8 @@
 from django.conf import settings
-from django.db import models
+from django.db import models, connections, router, transaction
 from django.utils import timezone
 
-from general.mail_control import send_templated_mass_mail
+from general import visits
 
 
 class SiteUpdate(models.Model):
@@ -20,24 +20,81 @@ class SiteUpdate(models.Model):
         context = {}
         context['update'] = self.message
 
+        from general.mail_control import queue_templated_mass_mail
         from userdetails.models import User
-        send_templated_mass_mail(subject=subject,
-                                 template_name=template,
-                                 context_data=context,
-                                 recipients=User.objects.all())
+        queue_templated_mass_mail(subject=subject,
+                                  template_name=template,
+                                  context_data=context,
+                                  recipients=User.objects.all())
 
 
 class AbstractVisitTracker(models.Model):
+    """The latest visit of a user to a page, visits are written behind by general/visits.py."""
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
-    timestamp = models.DateTimeField(auto_now_add=True)
+    timestamp = models.DateTimeField(default=timezone.now)
+
+    # The fields that identify the page, they are unique together with the user
+    page_fields = ()
 
     class Meta:
         abstract = True
 
+    @classmethod
+    def _get_latest_visit(cls, user, update=False, **page):
+        """Returns the datetime of the latest visit to the page, see get_latest_visit of the subclasses."""
+        timestamp = visits.get_latest_visit(cls, user.pk, page)
+        if update:
+            now = timezone.now()
+            visits.record_visit(cls, user.pk, page, now)
+            if timestamp is None:
+                timestamp = now
+        return timestamp
+
+    @classmethod
+    def upsert_visits(cls, page_visits):
+        """Inserts or updates the visits in a single statement, a visit does not overwrite a more recent one.
+
+        Visits of users or pages that have been deleted in the meantime are skipped.
+
+        Args:
+            page_visits: A list of (user id, tuple of the page field values, timestamp) tuples.
+        """
+        fields = [cls._meta.get_field(name) for name in ('user_id',) + cls.page_fields]
+        rows = [(user_id,) + page + (timestamp,) for user_id, page, timestamp in page_visits]
+        for index, field in enumerate(fields):
+            if field.is_relation:
+                existing = set(field.related_model._base_manager.filter(
+                    pk__in={row[index] for row in rows}).values_list('pk', flat=True))
+                rows = [row for row in rows if row[index] in existing]
+        if not rows:
+            return
+
+        db = router.db_for_write(cls)
+        connection = connections[db]
+        quote = connection.ops.quote_name
+        timestamp_field = cls._meta.get_field('timestamp')
+        table = quote(cls._meta.db_table)
+        columns = [quote(field.column) for field in fields]
+        timestamp = quote(timestamp_field.column)
+        sql = (
+            "INSERT INTO {table} ({columns}, {timestamp}) VALUES ({placeholders}) "
+            "ON CONFLICT ({columns}) DO UPDATE SET {timestamp} = excluded.{timestamp} "
+            "WHERE {table}.{timestamp} < excluded.{timestamp}"
+        ).format(table=table, columns=", ".join(columns), timestamp=timestamp,
+                 placeholders=", ".join(["%s"] * (len(columns) + 1)))
+        params = [row[:-1] + (timestamp_field.get_db_prep_value(row[-1], connection),) for row in rows]
+        with transaction.atomic(using=db), connection.cursor() as cursor:
+            cursor.executemany(sql, params)
+
 
 class PageVisitTracker(AbstractVisitTracker):
     page = models.IntegerField()
 
+    page_fields = ('page',)
+
+    class Meta:
+        unique_together = ('user', 'page')
+
     @classmethod
     def __get_page_int__(cls, page_name):
         """Returns the integer form for the type of page."""
@@ -57,17 +114,30 @@ class PageVisitTracker(AbstractVisitTracker):
 
         :param page_name: The name of the page
         :param user: The user visiting the page
+        :param update: Whether to record the current visit
         """
-        if update:
-            latest_visit_obj = cls.objects.get_or_create(user=user, page=cls.__get_page_int__(page_name))[0]
-        else:
-            try:
-                latest_visit_obj = cls.objects.get(user=user, page=cls.__get_page_int__(page_name))
-            except cls.DoesNotExist:
-                return None
-
-        timestamp = latest_visit_obj.timestamp
-        if update:
-            latest_visit_obj.timestamp = timezone.now()
-            latest_visit_obj.save()
-        return timestamp
+        return cls._get_latest_visit(user, update=update, page=cls.__get_page_int__(page_name))
+
+
+class QueuedMail(models.Model):
+    """An outgoing mail, sent by the send_queued_mail management command.
+
+    The mail is rendered when it is sent. The template context is stored as JSON, model instances in it are stored
+    as a reference and loaded again when the mail is sent, see general/mail_control.py.
+    """
+    recipient = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
+    subject = models.CharField(max_length=255)
+    template_name = models.CharField(max_length=255)
+    # JSON of the template context and the additional EmailMultiAlternatives arguments
+    data = models.TextField()
+
+    created_on = models.DateTimeField(default=timezone.now)
+    send_after = models.DateTimeField(default=timezone.now)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+
+    class Meta:
+        index_together = ('attempts', 'send_after')
+
+    def __str__(self):
+        return "{} - {}".format(self.recipient, self.subject)
@@ -0,0 +1,71 @@
+"""Storage of the request profiles captured by ProfilerMiddleware.
+
+The profiles are cProfile (pstats) dumps in PROFILER_DIR, which must not be served by the web server (it is not
+inside MEDIA_ROOT by default). They can be listed and downloaded on the profiles page of the admin site and opened
+locally with e.g. `python -m pstats` or snakeviz.
+"""
+import io
+import os
+import pstats
+import re
+from datetime import datetime
+
+from django.conf import settings
+from django.utils import timezone
+from django.utils.text import slugify
+
+# <timestamp>_<user id>_<path>.prof, see save_profile
+_PROFILE_NAME = re.compile(r'^(\d{8}-\d{6}-\d{6})_(\d+)_([\w-]*)\.prof$')
+
+
+class Profile:
+    """A stored profile."""
+
+    def __init__(self, name, created_on, user_id, path, size):
+        self.name = name
+        self.created_on = created_on
+        self.user_id = user_id
+        self.path = path
+        self.size = size
+
+
+def save_profile(profiler, request):
+    """Writes the statistics of the profiler to a new file and returns its name."""
+    os.makedirs(settings.PROFILER_DIR, exist_ok=True)
+    name = '{}_{}_{}.prof'.format(timezone.now().strftime('%Y%m%d-%H%M%S-%f'), request.user.pk,
+                                  slugify(request.path.replace('/', '-'))[:100])
+    profiler.dump_stats(os.path.join(settings.PROFILER_DIR, name))
+    return name
+
+
+def get_profile_path(name):
+    """Returns the file path of the profile with the given name, or None when it does not exist."""
+    # The pattern does not allow separators, so the path is always inside PROFILER_DIR
+    if not _PROFILE_NAME.match(name):
+        return None
+    path = os.path.join(settings.PROFILER_DIR, name)
+    return path if os.path.isfile(path) else None
+
+
+def list_profiles():
+    """Returns all stored profiles, newest first."""
+    if not os.path.isdir(settings.PROFILER_DIR):
+        return []
+
+    profiles = []
+    for name in os.listdir(settings.PROFILER_DIR):
+        match = _PROFILE_NAME.match(name)
+        if not match:
+            continue
+        created_on = timezone.make_aware(datetime.strptime(match.group(1), '%Y%m%d-%H%M%S-%f'))
+        size = os.path.getsize(os.path.join(settings.PROFILER_DIR, name))
+        profiles.append(Profile(name, created_on, int(match.group(2)), match.group(3), size))
+    return sorted(profiles, key=lambda profile: profile.name, reverse=True)
+
+
+def get_summary(name, sort='cumulative', limit=50):
+    """Returns the pstats report of the slowest functions of the profile as text."""
+    output = io.StringIO()
+    stats = pstats.Stats(get_profile_path(name), stream=output)
+    stats.strip_dirs().sort_stats(sort).print_stats(limit)
+    return output.getvalue()
@@ -0,0 +1,10 @@
+from django.core.signals import request_finished
+from django.dispatch import receiver
+
+from general import visits
+
+
+@receiver(request_finished)
+def flush_visits(sender, **kwargs):
+    """Writes the buffered page visits after the response has been sent, once per flush interval."""
+    visits.maybe_flush()
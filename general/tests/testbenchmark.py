@@ -0,0 +1,20 @@
+from django.core.cache import cache
+from django.test import TestCase
+
+from general import benchmark
+
+
+class BenchmarkTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_scenarios(self):
+        """Runs all scenarios on a tiny dataset, so that the benchmark does not silently measure error pages."""
+        data = benchmark.seed({'users': 20, 'associations': 3, 'days': 5, 'lists_per_day': 2, 'diners_per_list': 4,
+                               'transactions': 30})
+        results = benchmark.run(data, repeat=1)
+
+        self.assertEqual(len(results), 11)
+        for name, result in results.items():
+            self.assertIn(result['status'], (200, None), name)
+            self.assertGreater(result['queries'], 0, name)
@@ -0,0 +1,143 @@
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from io import StringIO
+from unittest.mock import patch
+
+from django.core import mail
+from django.core.mail import EmailMultiAlternatives
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from dining.models import DiningList
+from general.mail_control import queue_templated_mass_mail, queue_templated_mail, send_queued_mail, \
+    encode_mail_data, decode_mail_data
+from general.models import QueuedMail, SiteUpdate
+from userdetails.models import User, Association
+
+
+@override_settings(EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend')
+class MailQueueTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = [User.objects.create_user('user{}'.format(i), 'user{}@universe.cat'.format(i),
+                                              first_name='User{}'.format(i)) for i in range(3)]
+
+    def test_queue_and_send(self):
+        SiteUpdate.objects.create(title='New feature', message='Mails are queued').mail_users()
+        self.assertEqual(3, QueuedMail.objects.count())
+        self.assertEqual(0, len(mail.outbox))
+
+        result = send_queued_mail(batch_size=2)
+        self.assertEqual((3, 0), (result.sent, result.failed))
+        self.assertFalse(QueuedMail.objects.exists())
+        self.assertEqual(3, len(mail.outbox))
+        self.assertEqual(['user0@universe.cat'], mail.outbox[0].to)
+        self.assertIn('Mails are queued', mail.outbox[0].body)
+
+    def test_context_snapshot(self):
+        context = {'update': 'Before'}
+        queue_templated_mail(subject='Test', template_name='general/update_broadcast', context_data=context,
+                             recipient=self.users[0])
+        context['update'] = 'After'
+        send_queued_mail()
+        self.assertIn('Before', mail.outbox[0].body)
+
+    def test_encode_values(self):
+        association = Association.objects.create(name='Q')
+        context = {'association': association, 'date': date(2020, 1, 2), 'moment': datetime(2020, 1, 2, 17, 30),
+                   'cost': Decimal('1.50'), 'guests': ['Ankie']}
+        data = encode_mail_data(context, {})
+        self.assertNotIn('Q', data)
+        with self.assertNumQueries(1):
+            self.assertEqual({'context': context, 'kwargs': {}}, decode_mail_data(data))
+        with self.assertRaises(ValueError):
+            encode_mail_data({'association': Association(name='Unsaved')}, {})
+
+    def test_objects_are_loaded_again(self):
+        association = Association.objects.create(name='Q', slug='q')
+        dining_list = DiningList.objects.create(date=date(2020, 1, 2), association=association,
+                                                sign_up_deadline=datetime(2020, 1, 2, 15, tzinfo=timezone.utc))
+        dining_list.owners.add(self.users[0])
+        queue_templated_mass_mail(subject='Test', template_name='dining/dining_list_payment_reminder',
+                                  context_data={'dining_list': dining_list, 'reminder': self.users[0]},
+                                  recipients=self.users)
+        # Later changes of the objects are included in the mail
+        DiningList.objects.filter(pk=dining_list.pk).update(dish='Kwark')
+        self.assertEqual(3, send_queued_mail().sent)
+        self.assertIn('Kwark', mail.outbox[2].body)
+
+    def test_missing_object_fails(self):
+        association = Association.objects.create(name='Q')
+        queue_templated_mail(subject='Test', template_name='general/update_broadcast',
+                             context_data={'update': association}, recipient=self.users[0])
+        association.delete()
+        result = send_queued_mail()
+        self.assertEqual((0, 1), (result.sent, result.failed))
+        self.assertIn('DoesNotExist', QueuedMail.objects.get().last_error)
+
+    def test_retry_with_backoff(self):
+        queue_templated_mass_mail(subject='Test', template_name='general/update_broadcast',
+                                  context_data={'update': 'Text'}, recipients=self.users[:1])
+        with patch('django.core.mail.EmailMultiAlternatives.send', side_effect=ConnectionError('Refused')):
+            result = send_queued_mail(max_attempts=3)
+        self.assertEqual((0, 1), (result.sent, result.failed))
+
+        queued_mail = QueuedMail.objects.get()
+        self.assertEqual(1, queued_mail.attempts)
+        self.assertIn('Refused', queued_mail.last_error)
+        self.assertGreater(queued_mail.send_after, timezone.now())
+
+        # Not due yet
+        self.assertEqual(0, send_queued_mail().sent)
+
+        QueuedMail.objects.update(send_after=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(1, send_queued_mail().sent)
+        self.assertEqual(1, len(mail.outbox))
+
+    def test_sent_mails_are_removed_when_connection_fails(self):
+        queue_templated_mass_mail(subject='Test', template_name='general/update_broadcast',
+                                  context_data={'update': 'Text'}, recipients=self.users)
+        send = EmailMultiAlternatives.send
+        sends = []
+
+        def send_once(message, *args, **kwargs):
+            sends.append(message)
+            if len(sends) > 1:
+                raise ConnectionError('Lost')
+            return send(message, *args, **kwargs)
+
+        # The first mail is sent, the second fails and the connection can't be opened again
+        with patch('django.core.mail.EmailMultiAlternatives.send', send_once), \
+                patch('django.core.mail.backends.locmem.EmailBackend.open',
+                      side_effect=[None, ConnectionError('Refused')]):
+            result = send_queued_mail()
+        self.assertEqual((1, 1), (result.sent, result.failed))
+        self.assertIn('Refused', result.error)
+
+        first, second, third = self.users
+        self.assertFalse(QueuedMail.objects.filter(recipient=first).exists())
+        failed = QueuedMail.objects.get(recipient=second)
+        self.assertEqual(1, failed.attempts)
+        self.assertGreater(failed.send_after, timezone.now())
+        # The mail that was not tried is due again without an attempt
+        remaining = QueuedMail.objects.get(recipient=third)
+        self.assertEqual(0, remaining.attempts)
+        self.assertLessEqual(remaining.send_after, timezone.now())
+
+    def test_connection_fails(self):
+        queue_templated_mass_mail(subject='Test', template_name='general/update_broadcast',
+                                  context_data={'update': 'Text'}, recipients=self.users)
+        with patch('django.core.mail.backends.locmem.EmailBackend.open', side_effect=ConnectionError('Refused')):
+            result = send_queued_mail()
+        self.assertEqual((0, 0), (result.sent, result.failed))
+        self.assertIn('stopped: ConnectionError: Refused', str(result))
+        self.assertEqual(3, QueuedMail.objects.filter(attempts=0, send_after__lte=timezone.now()).count())
+
+    def test_command(self):
+        queue_templated_mass_mail(subject='Test', template_name='general/update_broadcast',
+                                  context_data={'update': 'Text'}, recipients=self.users)
+        out = StringIO()
+        call_command('send_queued_mail', '--limit', '2', stdout=out)
+        self.assertIn('Sent 2 mails (0 failed)', out.getvalue())
+        self.assertEqual(1, QueuedMail.objects.count())
@@ -0,0 +1,88 @@
+import os
+import tempfile
+from datetime import date, datetime
+
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from dining.models import DiningList, DiningEntryUser
+from general import metrics
+from userdetails.models import User, Association
+
+
+def get_samples(content):
+    """Returns the samples in the exposition text as a dictionary from series to value."""
+    samples = {}
+    for line in content.decode().splitlines():
+        if line and not line.startswith('#'):
+            series, value = line.rsplit(' ', 1)
+            samples[series] = float(value)
+    return samples
+
+
+class MetricsTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('ankie', 'ankie@cats.cat')
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        settings_override = override_settings(METRICS_ENABLED=True, METRICS_TOKEN='secret',
+                                              METRICS_PATH=os.path.join(directory.name, 'metrics.sqlite3'))
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        # Discard the values of other tests
+        metrics._buffer.clear()
+
+    def get_metrics(self):
+        response = self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(response.status_code, 200)
+        return get_samples(response.content)
+
+    def test_counter_and_histogram(self):
+        metrics.MAILS_SENT.inc(3)
+        metrics.flush()
+        # Flushed by another process
+        metrics.MAILS_SENT.inc(2)
+        metrics.FINALISATION_DURATION.observe(0.3, model='PendingTransaction')
+
+        samples = self.get_metrics()
+        self.assertEqual(samples['dining_mails_sent_total'], 5)
+        labels = 'model="PendingTransaction"'
+        self.assertEqual(samples['dining_finalisation_duration_seconds_count{%s}' % labels], 1)
+        self.assertEqual(samples['dining_finalisation_duration_seconds_bucket{le="0.25",%s}' % labels], 0)
+        self.assertEqual(samples['dining_finalisation_duration_seconds_bucket{le="0.5",%s}' % labels], 1)
+        self.assertEqual(samples['dining_finalisation_duration_seconds_bucket{le="+Inf",%s}' % labels], 1)
+
+    def test_request_metrics(self):
+        self.client.get(reverse('help_page'))
+        samples = self.get_metrics()
+        self.assertEqual(samples['dining_request_duration_seconds_count{method="GET",view="help_page"}'], 1)
+        self.assertIn('dining_request_queries_sum{view="help_page"}', samples)
+
+    def test_sign_ups(self):
+        dining_list = DiningList.objects.create(date=date(2123, 1, 2), association=Association.objects.create(),
+                                                sign_up_deadline=datetime(2100, 2, 2, tzinfo=timezone.utc))
+        DiningEntryUser.objects.create(dining_list=dining_list, user=self.user, created_by=self.user)
+        self.assertEqual(self.get_metrics()['dining_sign_ups_total{kind="user"}'], 1)
+
+    def test_token(self):
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 404)
+        self.assertEqual(self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer wrong').status_code, 404)
+        with override_settings(METRICS_TOKEN=''):
+            self.assertEqual(self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer ').status_code, 404)
+
+    def test_disabled(self):
+        with override_settings(METRICS_ENABLED=False):
+            metrics.MAILS_SENT.inc()
+            self.client.get(reverse('help_page'))
+            self.assertEqual(self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer secret').status_code, 404)
+        self.assertFalse(metrics._buffer)
+        self.assertNotIn('dining_mails_sent_total', self.get_metrics())
+
+    def test_escape_labels(self):
+        metrics.SIGN_UPS.inc(kind='a "quoted"\nvalue')
+        self.assertIn(b'kind="a \\"quoted\\"\\nvalue"', self.client.get(
+            reverse('metrics'), HTTP_AUTHORIZATION='Bearer secret').content)
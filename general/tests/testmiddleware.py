@@ -0,0 +1,61 @@
+import json
+import os
+import tempfile
+
+from django.http import HttpResponse
+from django.test import TestCase, RequestFactory, override_settings
+
+from general.middleware import QueryInstrumentationMiddleware, fingerprint
+from userdetails.models import User
+
+
+def n_plus_one_view(request):
+    for user in User.objects.all():
+        # One query per user
+        user.groups.count()
+    return HttpResponse()
+
+
+# Off by default when DEBUG is off
+@override_settings(QUERY_INSTRUMENTATION=True)
+class QueryInstrumentationMiddlewareTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        for i in range(3):
+            User.objects.create_user('user{}'.format(i), 'user{}@example.com'.format(i))
+
+    def get(self):
+        return QueryInstrumentationMiddleware(n_plus_one_view)(RequestFactory().get('/users/'))
+
+    def test_fingerprint(self):
+        self.assertEqual(fingerprint('SELECT *  FROM "a"\n WHERE "id" IN (%s, %s,%s)'),
+                         'SELECT * FROM "a" WHERE "id" IN (...)')
+
+    def test_server_timing(self):
+        response = self.get()
+        self.assertRegex(response['Server-Timing'], r'^db;dur=[\d.]+;desc="4 queries", total;dur=[\d.]+$')
+
+    def test_log_line(self):
+        with self.assertLogs('general.middleware', 'INFO') as logs:
+            self.get()
+        record = json.loads(logs.records[0].getMessage())
+        self.assertEqual(record['path'], '/users/')
+        self.assertEqual(record['queries'], 4)
+        self.assertEqual(record['duplicate_queries'], 2)
+
+    def test_slow_request_report(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with override_settings(QUERY_INSTRUMENTATION_MAX_QUERIES=4, QUERY_INSTRUMENTATION_REPORT_RATE=1,
+                                   QUERY_INSTRUMENTATION_REPORT_DIR=directory):
+                with self.assertLogs('general.middleware', 'WARNING'):
+                    self.get()
+            files = os.listdir(directory)
+            self.assertEqual(len(files), 1)
+            with open(os.path.join(directory, files[0])) as f:
+                report = json.load(f)
+
+        self.assertEqual(len(report['slowest']), 4)
+        duplicate, = report['duplicates']
+        self.assertEqual(duplicate['count'], 3)
+        self.assertIn('testmiddleware.py', duplicate['call_site'])
+        self.assertIn('n_plus_one_view', duplicate['call_site'])
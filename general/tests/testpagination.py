@@ -0,0 +1,92 @@
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from unittest.mock import patch
+
+from django.core.cache import cache
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from creditmanagement.models import FixedTransaction, PendingTransaction
+from dining.models import DiningList, DiningEntryUser
+from userdetails.models import Association, User
+from userdetails.views_association import CreditsOverview
+
+
+class CursorPaginationTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.association = Association.objects.create(name='Q', slug='q')
+        cls.user = User.objects.create_user('ankie', 'ankie@cats.cat')
+        cls.user.groups.add(cls.association)
+        moment = timezone.now() - timedelta(days=30)
+        for i in range(25):
+            # Pairs of transactions at the same moment, so that the primary key decides the order
+            FixedTransaction.objects.create(source_association=cls.association, target_user=cls.user,
+                                            amount=Decimal('1.00'), order_moment=moment + timedelta(hours=i // 2),
+                                            description=str(i))
+        PendingTransaction.objects.create(source_user=cls.user, target_association=cls.association,
+                                          amount=Decimal('2.00'), description='pending')
+        dining_list = DiningList.objects.create(date=date(2100, 1, 1), association=cls.association,
+                                                sign_up_deadline=datetime(2100, 1, 1, tzinfo=timezone.utc))
+        DiningEntryUser.objects.create(dining_list=dining_list, user=cls.user, created_by=cls.user)
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.user)
+        # Use small pages so that the test data spans multiple pages
+        patcher = patch.object(CreditsOverview, 'paginate_by', 10)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get_all_pages(self, url, context_name='object_list'):
+        """Follows the next links and returns the objects of all pages."""
+        objects = []
+        params = {}
+        while True:
+            response = self.client.get(url, params)
+            self.assertEqual(response.status_code, 200)
+            objects += list(response.context[context_name])
+            page = response.context['page_obj']
+            if not page.has_next:
+                return objects
+            params = {'cursor': page.next_cursor}
+
+    def test_association_credits(self):
+        url = reverse('association_credits', kwargs={'association_name': self.association.slug})
+        transactions = self.get_all_pages(url)
+
+        self.assertEqual(len(transactions), 26)
+        self.assertEqual(len({t.pk for t in transactions}), 26)
+        self.assertEqual(transactions[0].description, 'pending')
+        keys = [(t.order_moment, t.pk) for t in transactions]
+        self.assertEqual(keys, sorted(keys, reverse=True))
+
+    def test_approximate_count(self):
+        url = reverse('association_credits', kwargs={'association_name': self.association.slug})
+        self.assertEqual(self.client.get(url).context['page_obj'].count, 26)
+
+    def test_transaction_list_includes_dining_costs(self):
+        transactions = self.get_all_pages(reverse('credits:transaction_list'), 'transactions')
+
+        # 25 fixed, 1 pending and 1 pending dining transaction
+        self.assertEqual(len(transactions), 27)
+        self.assertEqual(transactions[0].description, 'DINING')
+
+    def test_page_query_count_is_constant(self):
+        url = reverse('association_credits', kwargs={'association_name': self.association.slug})
+        # Fill the cached count
+        cursor = self.client.get(url).context['page_obj'].next_cursor
+        with CaptureQueriesContext(connection) as first_page:
+            self.client.get(url)
+        with CaptureQueriesContext(connection) as next_page:
+            self.client.get(url, {'cursor': cursor})
+        self.assertEqual(len(first_page), len(next_page))
+        counts = [query['sql'] for query in next_page.captured_queries if 'COUNT' in query['sql']]
+        self.assertFalse([sql for sql in counts if 'creditmanagement_transaction' in sql])
+
+    def test_invalid_cursor(self):
+        url = reverse('association_credits', kwargs={'association_name': self.association.slug})
+        self.assertEqual(self.client.get(url, {'cursor': 'nonsense'}).status_code, 404)
@@ -0,0 +1,51 @@
+import tempfile
+
+from django.test import TestCase, override_settings
+from django.urls import reverse
+
+from userdetails.models import User
+
+
+class ProfilerTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.superuser = User.objects.create_superuser('ankie', 'ankie@cats.cat', 'password')
+        cls.user = User.objects.create_user('noortje', 'noortje@cats.cat')
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        settings_override = override_settings(PROFILER_DIR=directory.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def test_profile_request(self):
+        self.client.force_login(self.superuser)
+        response = self.client.get(reverse('help_page'), {'profile': 1})
+        name = response['X-Profile']
+
+        response = self.client.get(reverse('admin:profiles'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([profile.name for profile in response.context['profiles']], [name])
+
+        response = self.client.get(reverse('admin:profiles'), {'summary': name})
+        # The template rendering is included
+        self.assertIn('render', response.context['summary'])
+
+        response = self.client.get(reverse('admin:profile_download', kwargs={'name': name}))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('attachment', response['Content-Disposition'])
+
+    def test_cookie(self):
+        self.client.force_login(self.superuser)
+        self.client.cookies['profile'] = '1'
+        self.assertIn('X-Profile', self.client.get(reverse('help_page')))
+
+    def test_only_superusers(self):
+        self.client.force_login(self.user)
+        self.assertNotIn('X-Profile', self.client.get(reverse('help_page'), {'profile': 1}))
+
+    def test_invalid_name(self):
+        self.client.force_login(self.superuser)
+        response = self.client.get(reverse('admin:profile_download', kwargs={'name': '..secret.prof'}))
+        self.assertEqual(response.status_code, 404)
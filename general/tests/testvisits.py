@@ -0,0 +1,104 @@
+from datetime import date, datetime, timedelta
+from unittest.mock import patch
+
+from django.core.cache import cache
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from dining.models import DiningList, DiningCommentVisitTracker
+from general import visits
+from general.models import PageVisitTracker
+from userdetails.models import User, Association
+
+
+def is_write(query):
+    return query['sql'].lstrip().upper().startswith(('INSERT', 'UPDATE', 'DELETE'))
+
+
+class VisitTrackerTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('ankie', 'ankie@cats.cat')
+        association = Association.objects.create(name='Quadrivium', slug='quadrivium')
+        cls.dining_list = DiningList.objects.create(date=date(2123, 1, 4), association=association,
+                                                    sign_up_deadline=datetime(2100, 2, 2, tzinfo=timezone.utc))
+
+    def setUp(self):
+        # Discard the visits of other tests
+        cache.clear()
+        visits._pending.clear()
+        self.client.force_login(self.user)
+
+    def test_page_visits_do_not_write(self):
+        for url in [reverse('site_updates'), reverse('rules_and_regulations'), self.dining_list.get_absolute_url()]:
+            with CaptureQueriesContext(connection) as queries:
+                self.assertEqual(self.client.get(url).status_code, 200)
+            self.assertEqual([query['sql'] for query in queries if is_write(query)], [])
+        self.assertFalse(PageVisitTracker.objects.exists())
+
+        self.assertEqual(visits.flush(), 3)
+        self.assertEqual(PageVisitTracker.objects.count(), 2)
+        self.assertEqual(DiningCommentVisitTracker.objects.get().user, self.user)
+
+    def test_latest_visit(self):
+        self.assertIsNone(PageVisitTracker.get_latest_visit('rules', self.user))
+        first = PageVisitTracker.get_latest_visit('rules', self.user, update=True)
+        second = PageVisitTracker.get_latest_visit('rules', self.user, update=True)
+        # The previous visit is returned, which is the current one on the first visit
+        self.assertLessEqual(first, second)
+        with self.assertNumQueries(0):
+            self.assertGreaterEqual(PageVisitTracker.get_latest_visit('rules', self.user), second)
+
+    def test_read_from_database(self):
+        timestamp = timezone.now() - timedelta(days=1)
+        DiningCommentVisitTracker.objects.create(user=self.user, dining_list=self.dining_list, timestamp=timestamp)
+        self.assertEqual(DiningCommentVisitTracker.get_latest_visit(self.dining_list, self.user), timestamp)
+
+    def test_unflushed_visit(self):
+        PageVisitTracker.get_latest_visit('rules', self.user, update=True)
+        cache.clear()
+        with self.assertNumQueries(0):
+            self.assertIsNotNone(PageVisitTracker.get_latest_visit('rules', self.user))
+
+    # The test transaction is never committed, the value read from the database is cached directly instead
+    @patch('general.visits.transaction.on_commit', lambda callback: callback())
+    def test_database_visit_cached_until_flush_interval(self):
+        with override_settings(VISIT_FLUSH_INTERVAL=0):
+            self.assertIsNone(DiningCommentVisitTracker.get_latest_visit(self.dining_list, self.user))
+            # Flushed by another process
+            timestamp = timezone.now()
+            DiningCommentVisitTracker.upsert_visits([(self.user.pk, (self.dining_list.pk,), timestamp)])
+            self.assertEqual(DiningCommentVisitTracker.get_latest_visit(self.dining_list, self.user), timestamp)
+
+    def test_recorded_visit_timeout(self):
+        # The tests use locmem://, which is not shared by the processes
+        with override_settings(VISIT_FLUSH_INTERVAL=0):
+            PageVisitTracker.get_latest_visit('rules', self.user, update=True)
+            visits.flush()
+            timestamp = timezone.now() + timedelta(minutes=1)
+            PageVisitTracker.upsert_visits([(self.user.pk, (PageVisitTracker.objects.get().page,), timestamp)])
+            self.assertEqual(PageVisitTracker.get_latest_visit('rules', self.user), timestamp)
+
+    def test_upsert(self):
+        now = timezone.now()
+        PageVisitTracker.upsert_visits([(self.user.pk, (1,), now)])
+        PageVisitTracker.upsert_visits([(self.user.pk, (1,), now + timedelta(minutes=1))])
+        # An older visit that is flushed later does not overwrite the latest visit
+        PageVisitTracker.upsert_visits([(self.user.pk, (1,), now - timedelta(minutes=1))])
+        self.assertEqual(PageVisitTracker.objects.get().timestamp, now + timedelta(minutes=1))
+
+    def test_upsert_skips_deleted(self):
+        DiningCommentVisitTracker.upsert_visits([(self.user.pk, (self.dining_list.pk + 1,), timezone.now()),
+                                                 (self.user.pk + 1, (self.dining_list.pk,), timezone.now())])
+        self.assertFalse(DiningCommentVisitTracker.objects.exists())
+
+    def test_failed_flush_keeps_visits(self):
+        PageVisitTracker.get_latest_visit('rules', self.user, update=True)
+        with patch.object(PageVisitTracker, 'upsert_visits', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                visits.flush()
+        self.assertEqual(visits.flush(), 1)
+        self.assertTrue(PageVisitTracker.objects.exists())
@@ -1,6 +1,8 @@
 import copy
+import csv
 
 import django.forms
+from django.http import StreamingHttpResponse
 
 
 class SelectWithDisabled(django.forms.Select):
@@ -40,3 +42,23 @@ class SelectWithDisabled(django.forms.Select):
             index += 1
 
         return groups
+
+
+class Echo:
+    """File-like object that returns what is written to it, for use with csv.writer."""
+
+    def write(self, value):
+        return value
+
+
+def streaming_csv_response(rows, filename):
+    """Returns a CSV file download that is written while the rows are generated.
+
+    Args:
+        rows: An iterable (preferably a generator) of rows, each row a list of values.
+        filename: The file name shown to the user.
+    """
+    csv_writer = csv.writer(Echo())
+    response = StreamingHttpResponse((csv_writer.writerow(row) for row in rows), content_type='text/csv')
+    response['Content-Disposition'] = 'attachment; filename="{}"'.format(filename)
+    return response
@@ -1,12 +1,20 @@
+import hashlib
+import json
 from datetime import datetime, timedelta
 
-from django.db.models import ObjectDoesNotExist
-from django.http import HttpResponseForbidden, Http404
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ValidationError, PermissionDenied
+from django.db.models import ObjectDoesNotExist, Q
+from django.http import HttpResponseForbidden, Http404, FileResponse
 from django.shortcuts import render
 from django.template.loader import get_template, TemplateDoesNotExist
 from django.utils import timezone
+from django.utils.encoding import force_bytes, force_text
+from django.utils.http import urlsafe_base64_encode, urlsafe_base64_decode
 from django.views.generic import View, ListView, TemplateView
 
+from general import profiling
 from general.forms import DateRangeForm
 from general.models import SiteUpdate, PageVisitTracker
 from userdetails.models import Association
@@ -39,6 +47,122 @@ class DateRangeFilterMixin:
         return context
 
 
+class CursorPage:
+    """A page of a CursorPaginationMixin view, used as page_obj in the template."""
+
+    def __init__(self, object_list, next_cursor, has_previous, count=None):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.has_previous = has_previous
+        # The approximate total number of objects, None if not computed
+        self.count = count
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_other_pages(self):
+        return self.has_next or self.has_previous
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+
+class CursorPaginationMixin:
+    """Paginates a ListView on a cursor instead of a page number.
+
+    The objects are ordered on cursor_ordering, of which the last field must be unique (e.g. the primary key).
+    The link to the next page contains the ordering values of the last object of the current page as an opaque
+    token and the next page is retrieved with a filter on those values. Unlike an offset, this filter can use an
+    index, so every page costs the same as the first one. The total number of pages is not counted, only when
+    approximate_count is set the number of objects is counted and cached for PAGINATION_COUNT_CACHE_TIMEOUT seconds.
+
+    Use the template snippets/cursor_paginator.html to show the page links.
+    """
+    cursor_ordering = ('-pk',)
+    cursor_query_param = 'cursor'
+    approximate_count = False
+
+    def _get_field(self, model, path):
+        """Returns the model field of a (related) ordering field such as dining_list__date."""
+        field = None
+        for name in path.split('__'):
+            field = model._meta.pk if name == 'pk' else model._meta.get_field(name)
+            if field.is_relation:
+                model = field.related_model
+        return field
+
+    def get_cursor_values(self, obj):
+        """Returns the values of the cursor_ordering fields of the object."""
+        values = []
+        for field in self.cursor_ordering:
+            value = obj
+            for name in field.lstrip('-').split('__'):
+                value = getattr(value, name)
+            values.append(value)
+        return values
+
+    def encode_cursor(self, values):
+        # Dates and times are stored with full precision, they are parsed again by the model field
+        data = [value.isoformat() if hasattr(value, 'isoformat') else str(value) for value in values]
+        return urlsafe_base64_encode(force_bytes(json.dumps(data)))
+
+    def decode_cursor(self, model, token):
+        """Returns the ordering values encoded in the token, raises Http404 when it is invalid."""
+        try:
+            data = json.loads(force_text(urlsafe_base64_decode(token)))
+            if not isinstance(data, list) or len(data) != len(self.cursor_ordering):
+                raise ValueError("Wrong number of values")
+            return [self._get_field(model, field.lstrip('-')).to_python(value)
+                    for field, value in zip(self.cursor_ordering, data)]
+        except (ValueError, TypeError, ValidationError):
+            raise Http404("Invalid cursor")
+
+    def get_cursor_filter(self, values):
+        """Returns a Q object selecting the objects that come after the given ordering values."""
+        result = Q()
+        for i, field in enumerate(self.cursor_ordering):
+            lookup = 'lt' if field.startswith('-') else 'gt'
+            condition = Q(**{'{}__{}'.format(field.lstrip('-'), lookup): values[i]})
+            for previous_field, value in zip(self.cursor_ordering[:i], values):
+                condition &= Q(**{previous_field.lstrip('-'): value})
+            result |= condition
+        return result
+
+    def get_page_objects(self, queryset, values, limit):
+        """Returns the first limit objects after the given ordering values (or the first objects if None)."""
+        queryset = queryset.order_by(*self.cursor_ordering)
+        if values is not None:
+            queryset = queryset.filter(self.get_cursor_filter(values))
+        return list(queryset[:limit])
+
+    def get_approximate_count(self, queryset):
+        key = 'cursor_count:' + hashlib.md5(force_bytes(str(queryset.query))).hexdigest()
+        count = cache.get(key)
+        if count is None:
+            count = queryset.count()
+            cache.set(key, count, timeout=settings.PAGINATION_COUNT_CACHE_TIMEOUT)
+        return count
+
+    def paginate_queryset(self, queryset, page_size):
+        token = self.request.GET.get(self.cursor_query_param)
+        values = self.decode_cursor(queryset.model, token) if token else None
+
+        # Retrieve one extra object to know whether there is a next page
+        object_list = self.get_page_objects(queryset, values, page_size + 1)
+        next_cursor = None
+        if len(object_list) > page_size:
+            object_list = object_list[:page_size]
+            next_cursor = self.encode_cursor(self.get_cursor_values(object_list[-1]))
+
+        count = self.get_approximate_count(queryset) if self.approximate_count else None
+        page = CursorPage(object_list, next_cursor, has_previous=values is not None, count=count)
+        return None, page, object_list, page.has_other_pages()
+
+
 class SiteUpdateView(ListView):
     template_name = "general/site_updates.html"
     paginate_by = 4
@@ -186,3 +310,39 @@ class EmailTemplateView(View):
         context['request'] = request
         context['user'] = request.user
         return render(None, template_location, context, using='EmailTemplates')
+
+
+class SuperuserRequiredMixin:
+    def dispatch(self, request, *args, **kwargs):
+        if not request.user.is_superuser:
+            raise PermissionDenied
+        return super().dispatch(request, *args, **kwargs)
+
+
+class ProfileListView(SuperuserRequiredMixin, TemplateView):
+    """Admin page that lists the request profiles and shows the summary of one of them."""
+    template_name = 'admin/profiles.html'
+    admin_site = None
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context.update(self.admin_site.each_context(self.request))
+        context['title'] = 'Request profiles'
+        context['profiles'] = profiling.list_profiles()
+        context['trigger'] = settings.PROFILER_TRIGGER
+
+        name = self.request.GET.get('summary')
+        if name:
+            if not profiling.get_profile_path(name):
+                raise Http404("Profile does not exist")
+            context['summary_name'] = name
+            context['summary'] = profiling.get_summary(name)
+        return context
+
+
+class ProfileDownloadView(SuperuserRequiredMixin, View):
+    def get(self, request, name):
+        path = profiling.get_profile_path(name)
+        if not path:
+            raise Http404("Profile does not exist")
+        return FileResponse(open(path, 'rb'), as_attachment=True, filename=name)
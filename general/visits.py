@@ -0,0 +1,102 @@
+"""Write-behind tracking of the latest visit of a user to a page, for the visit tracker models.
+
+Visiting a page does not write to the database. The visit is stored in a buffer of the process and in the cache.
+The buffer is written to the database with a single upsert per tracker model at most every VISIT_FLUSH_INTERVAL
+seconds after a request has finished, see general/receivers.py. The latest visit is read from the buffer, the cache
+and the database, in that order.
+
+The cache backend is configured with DINING_CACHE_URL. A visit read from the database is cached for at most
+VISIT_FLUSH_INTERVAL seconds, as a visit that another process has not flushed yet is missing from it. A recorded
+visit is cached for VISIT_CACHE_TIMEOUT seconds when the cache is shared by the processes. With a cache per process
+(the default locmem://) another process can record a newer visit, so it is also cached for VISIT_FLUSH_INTERVAL
+seconds. The visits of the last interval of a process that stops are lost, which only means that some comments or
+updates are shown as unread again.
+"""
+import threading
+from time import monotonic
+
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import transaction
+
+KEY_PREFIX = 'visit'
+
+_pending = {}
+_lock = threading.Lock()
+_last_flush = monotonic()
+# Cache value of a page that has not been visited, None can not be distinguished from a missing key
+_NOT_VISITED = 'never'
+
+
+def _key(model, user_id, keys):
+    return '{}:{}:{}:{}'.format(KEY_PREFIX, model._meta.label_lower, user_id,
+                                ':'.join(str(keys[field]) for field in model.page_fields))
+
+
+def _page(model, keys):
+    return tuple(keys[field] for field in model.page_fields)
+
+
+def _get_visit_timeout():
+    """Returns the number of seconds a recorded visit is cached."""
+    if isinstance(caches['default'], (LocMemCache, DummyCache)):
+        return settings.VISIT_FLUSH_INTERVAL
+    return settings.VISIT_CACHE_TIMEOUT
+
+
+def get_latest_visit(model, user_id, keys):
+    """Returns the moment of the latest visit of the page identified by keys, or None when it was never visited."""
+    timestamp = _pending.get((model, user_id, _page(model, keys)))
+    if timestamp is not None:
+        return timestamp
+
+    key = _key(model, user_id, keys)
+    timestamp = cache.get(key)
+    if timestamp is not None:
+        return None if timestamp == _NOT_VISITED else timestamp
+
+    timestamp = model.objects.filter(user_id=user_id, **keys).values_list('timestamp', flat=True).first()
+    value = _NOT_VISITED if timestamp is None else timestamp
+    # Only cache the visit once it is committed, a value read inside a transaction can still be rolled back.
+    # add() does not overwrite a visit that was recorded in the meantime.
+    transaction.on_commit(lambda: cache.add(key, value, timeout=settings.VISIT_FLUSH_INTERVAL))
+    return timestamp
+
+
+def record_visit(model, user_id, keys, timestamp):
+    """Stores the visit in the cache and adds it to the buffer of this process."""
+    cache.set(_key(model, user_id, keys), timestamp, timeout=_get_visit_timeout())
+    with _lock:
+        _pending[(model, user_id, _page(model, keys))] = timestamp
+
+
+def flush():
+    """Writes the buffered visits of this process to the database, returns the number of visits."""
+    global _last_flush
+    with _lock:
+        visits = dict(_pending)
+        _pending.clear()
+        _last_flush = monotonic()
+
+    models = {model for model, _, _ in visits}
+    try:
+        for model in models:
+            model.upsert_visits([(user_id, page, timestamp)
+                                 for (visit_model, user_id, page), timestamp in visits.items()
+                                 if visit_model is model])
+    except Exception:
+        # Keep the visits for the next flush, a visit recorded in the meantime is newer. Writing the visits of the
+        # models that did succeed again is harmless.
+        with _lock:
+            for visit, timestamp in visits.items():
+                _pending.setdefault(visit, timestamp)
+        raise
+    return len(visits)
+
+
+def maybe_flush():
+    """Flushes the buffer when the flush interval has passed."""
+    if _pending and monotonic() - _last_flush >= settings.VISIT_FLUSH_INTERVAL:
+        flush()
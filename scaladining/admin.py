@@ -1,4 +1,7 @@
 from django.contrib.admin import AdminSite
+from django.urls import path
+
+from general.views import ProfileListView, ProfileDownloadView
 
 
 class MyAdminSite(AdminSite):
@@ -12,3 +15,9 @@ class MyAdminSite(AdminSite):
         """Whether the request user has access to the admin site."""
         # Need to check for anonymous user because she doesn't have the has_admin_site_access method
         return not request.user.is_anonymous and request.user.has_admin_site_access()
+
+    def get_urls(self):
+        return [
+            path('profiles/', self.admin_view(ProfileListView.as_view(admin_site=self)), name='profiles'),
+            path('profiles/<str:name>', self.admin_view(ProfileDownloadView.as_view()), name='profile_download'),
+        ] + super().get_urls()
@@ -23,9 +23,59 @@ MINIMUM_BALANCE_FOR_DINING_SIGN_UP = Decimal('-2.00') + KITCHEN_COST
 MINIMUM_BALANCE_FOR_DINING_SLOT_CLAIM = Decimal('-2.00') + KITCHEN_COST
 MINIMUM_BALANCE_FOR_USER_TRANSACTION = Decimal('0.00')
 
+# Balance checkpoints can only be created this long in the past, so that no transactions confirmed before the
+# checkpoint are still being committed
+BALANCE_CHECKPOINT_MARGIN = timedelta(hours=1)
+
+# Number of seconds a balance is cached for display, changes invalidate the cache before that. This is also how long
+# other workers can show an old balance when each worker has its own cache (locmem://)
+BALANCE_CACHE_TIMEOUT = 60
+
+# Page visits are written to the database at most every VISIT_FLUSH_INTERVAL seconds per process. Visits read from the
+# database are cached for VISIT_FLUSH_INTERVAL seconds, recorded visits for VISIT_CACHE_TIMEOUT seconds when the cache
+# is shared by the processes, see general/visits.py
+VISIT_FLUSH_INTERVAL = 30
+VISIT_CACHE_TIMEOUT = 60 * 60
+
+# How AbstractTransaction.annotate_balance computes the balances of all users or associations:
+# 'subquery' annotates correlated subqueries per row, 'grouped' uses one grouped query over the ledger
+BALANCE_ENGINE = 'subquery'
+
+# Number of seconds the dining statistics of past date ranges are cached. A membership change invalidates them, but
+# when each worker has its own cache (locmem://) the other workers serve the old statistics for this long
+DINING_STATS_CACHE_TIMEOUT = 5 * 60
+
+# Number of seconds the approximate number of objects of a cursor paginated list is cached
+PAGINATION_COUNT_CACHE_TIMEOUT = 5 * 60
+
 # The duration that pending transactions should last
 TRANSACTION_PENDING_DURATION = timedelta(days=2)
 
+# The number of pending transactions or dining lists that are finalised per database transaction
+FINALISATION_BATCH_SIZE = 1000
+
+# Outgoing mail queue, see general/mail_control.py
+MAIL_QUEUE_BATCH_SIZE = 100
+MAIL_QUEUE_MAX_ATTEMPTS = 5
+# Delay before the first retry of a failed mail, doubled on every next attempt
+MAIL_QUEUE_RETRY_DELAY = timedelta(minutes=1)
+# A batch is claimed by a worker for this long, after that the mails that were not sent are due again
+MAIL_QUEUE_CLAIM_DURATION = timedelta(minutes=15)
+
+# Query instrumentation, see general/middleware.py
+# Requests that take longer or run more queries are logged as a warning
+QUERY_INSTRUMENTATION_SLOW_MS = 1000
+QUERY_INSTRUMENTATION_MAX_QUERIES = 100
+# Fraction of the slow requests of which a report is written, and the number of statements in the report
+QUERY_INSTRUMENTATION_REPORT_RATE = 0.1
+QUERY_INSTRUMENTATION_REPORT_SLOWEST = 10
+
+# Query parameter or cookie with which a superuser profiles a request, see general/middleware.py
+PROFILER_TRIGGER = 'profile'
+
+# Seconds between the writes of the metrics of a process to the shared metrics database, see general/metrics.py
+METRICS_FLUSH_INTERVAL = 10
+
 # Membership change settings
 DURATION_AFTER_MEMBERSHIP_CONFIRMATION = timedelta(days=30)
 DURATION_AFTER_MEMBERSHIP_REJECTION = timedelta(days=30)
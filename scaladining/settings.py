@@ -2,6 +2,7 @@
 
 import os
 from email.utils import getaddresses
+from tempfile import gettempdir
 
 from environs import Env
 
@@ -61,6 +62,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'general.middleware.QueryInstrumentationMiddleware',
+    'general.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -70,6 +73,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'general.middleware.ProfilerMiddleware',
 ]
 
 ROOT_URLCONF = 'scaladining.urls'
@@ -113,10 +117,16 @@ STATICFILES_DIRS = [os.path.join(BASE_DIR, 'assets/static')]
 MEDIA_ROOT = env.str('DINING_MEDIA_ROOT', default=os.path.join(BASE_DIR, 'uploads'))
 MEDIA_URL = env.str('DINING_MEDIA_URL', default='/media/')
 
+# The request profiles of ProfilerMiddleware, outside MEDIA_ROOT as they may only be downloaded by superusers
+PROFILER_DIR = env.str('DINING_PROFILER_DIR', default=os.path.join(BASE_DIR, 'profiles'))
+
 DATABASES = {'default': env.dj_db_url('DINING_DATABASE_URL', default='sqlite:///db.sqlite3')}
 if not DATABASES['default'].get('PASSWORD'):
     DATABASES['default']['PASSWORD'] = env.file('DINING_DATABASE_PASSWORD_FILE', default='')
 
+# See https://github.com/epicserve/django-cache-url, e.g. locmem:// or redis://localhost:6379/0
+CACHES = {'default': env.dj_cache_url('DINING_CACHE_URL', default='locmem://')}
+
 AUTH_PASSWORD_VALIDATORS = [
     {
         'NAME': 'django.contrib.auth.password_validation.UserAttributeSimilarityValidator',
@@ -174,6 +184,35 @@ ACCOUNT_SESSION_REMEMBER = True
 ACCOUNT_UNIQUE_EMAIL = True
 SOCIALACCOUNT_ADAPTER = "userdetails.externalaccounts.SocialAccountAdapter"
 
+# Query instrumentation of each request, see general/middleware.py. Off by default in production, as it records
+# the call site of every query
+QUERY_INSTRUMENTATION = env.bool('DINING_QUERY_INSTRUMENTATION', default=DEBUG)
+# Directory of the slow request reports, they are logged when it is empty
+QUERY_INSTRUMENTATION_REPORT_DIR = env.str('DINING_SLOW_REQUEST_DIR', default='')
+
+# Metrics of all workers on this machine, see general/metrics.py. /metrics is disabled when the token is empty
+METRICS_ENABLED = env.bool('DINING_METRICS', default=False)
+METRICS_PATH = env.str('DINING_METRICS_PATH', default=os.path.join(gettempdir(), 'dining-metrics.sqlite3'))
+METRICS_TOKEN = env.str('DINING_METRICS_TOKEN', default='')
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        # Use INFO to log every request with its number of queries
+        'general.middleware': {
+            'handlers': ['console'],
+            'level': env.str('DINING_REQUEST_LOG_LEVEL', default='WARNING'),
+            'propagate': False,
+        },
+    },
+}
+
 # HTTP security
 if env.bool('DINING_COOKIE_SECURE', default=False):
     CSRF_COOKIE_SECURE = True
@@ -3,9 +3,12 @@ from django.conf.urls.static import static
 from django.contrib import admin
 from django.urls import include, path
 
+from general.metrics import MetricsView
+
 
 urlpatterns = [
     path('admin/', admin.site.urls),
+    path('metrics', MetricsView.as_view(), name='metrics'),
     path('credit/', include('creditmanagement.urls')),
     path('site/', include('general.urls')),
     path('', include('dining.urls')),
@@ -0,0 +1,110 @@
+import csv
+from decimal import Decimal
+
+from django.http import StreamingHttpResponse
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from creditmanagement.models import FixedTransaction, PendingTransaction, UserCredit, AssociationCredit
+from userdetails.models import Association, User, UserMembership
+
+
+class TransactionsCsvViewTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.association = Association.objects.create(name='Q', slug='q')
+        cls.user = User.objects.create_user('ankie', 'ankie@cats.cat', first_name='Ankie', last_name='Cat')
+        cls.user.groups.add(cls.association)
+        for i in range(5):
+            FixedTransaction.objects.create(source_association=cls.association, target_user=cls.user,
+                                            amount=Decimal('1.50'), description='Transaction {}'.format(i))
+        FixedTransaction.objects.create(source_user=cls.user, target_association=cls.association,
+                                        amount=Decimal('2.00'))
+
+    def setUp(self):
+        self.client.force_login(self.user)
+
+    def test_streaming_csv(self):
+        url = reverse('association_transactions_csv', kwargs={'association_name': self.association.slug})
+        response = self.client.get(url)
+        self.assertIsInstance(response, StreamingHttpResponse)
+
+        # The related users and associations are joined, so the number of queries does not depend on the rows
+        with self.assertNumQueries(1):
+            content = b''.join(response.streaming_content).decode()
+        rows = list(csv.reader(content.splitlines()))
+
+        self.assertEqual(7, len(rows))
+        self.assertEqual(['Association', 'Q', '', 'User', 'Ankie Cat', 'ankie@cats.cat', '1.50', 'Transaction 0'],
+                         rows[1][2:])
+        self.assertEqual(['User', 'Ankie Cat', 'ankie@cats.cat', 'Association', 'Q', ''], rows[6][2:8])
+
+
+class AutoCreateNegativeCreditsViewTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.association = Association.objects.create(name='Q', slug='q', has_min_exception=True)
+        cls.other = Association.objects.create(name='R', slug='r')
+        cls.board = User.objects.create_user('ankie', 'ankie@cats.cat')
+        cls.board.groups.add(cls.association)
+        cls.members = [User.objects.create_user('member{}'.format(i), 'member{}@cats.cat'.format(i))
+                       for i in range(5)]
+        for i, member in enumerate(cls.members):
+            UserMembership.objects.create(related_user=member, association=cls.association)
+            # Members 0-3 are negative
+            if i < 4:
+                FixedTransaction.objects.create(source_user=member, target_association=cls.other,
+                                                amount=Decimal(i + 1))
+        cls.url = reverse('association_process_negatives', kwargs={'association_name': cls.association.slug})
+
+    def setUp(self):
+        self.client.force_login(self.board)
+
+    def test_preview(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.context['form'].preview, (4, Decimal('10.00')))
+
+    def test_process(self):
+        response = self.client.post(self.url, {'expected_count': 4, 'expected_total': '10.00'})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(PendingTransaction.objects.filter(source_association=self.association).count(), 4)
+        for member in self.members:
+            self.assertEqual(UserCredit.get_balance(member), Decimal('0.00'))
+        self.assertEqual(AssociationCredit.get_balance(self.association), Decimal('-10.00'))
+
+    def test_changed_balances(self):
+        FixedTransaction.objects.create(source_user=self.members[4], target_association=self.other,
+                                        amount=Decimal('5.00'))
+        response = self.client.post(self.url, {'expected_count': 4, 'expected_total': '10.00'}, follow=True)
+        self.assertContains(response, 'The balances have changed')
+        self.assertFalse(PendingTransaction.objects.exists())
+        self.assertEqual(response.context['form'].preview, (5, Decimal('15.00')))
+
+    def test_number_of_queries_does_not_depend_on_members(self):
+        with CaptureQueriesContext(connection) as few:
+            self.client.post(self.url, {'expected_count': 4, 'expected_total': '10.00'})
+        for i in range(10):
+            member = User.objects.create_user('extra{}'.format(i), 'extra{}@cats.cat'.format(i))
+            UserMembership.objects.create(related_user=member, association=self.association)
+            FixedTransaction.objects.create(source_user=member, target_association=self.other, amount=Decimal('1.00'))
+        with CaptureQueriesContext(connection) as many:
+            response = self.client.post(self.url, {'expected_count': 10, 'expected_total': '10.00'})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(len(few), len(many))
+
+
+class SiteCreditViewTestCase(TestCase):
+    def test_association_without_credit(self):
+        association = Association.objects.create(name='Q', slug='q', has_site_stats_access=True)
+        board = User.objects.create_user('ankie', 'ankie@cats.cat')
+        board.groups.add(association)
+        # E.g. loaded from a fixture, which skips the receiver that creates the row
+        AssociationCredit.objects.filter(association=association).delete()
+
+        self.client.force_login(board)
+        response = self.client.get(reverse('association_site_credit_stats',
+                                           kwargs={'association_name': association.slug}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['association_balances'][association.pk]['balance'], Decimal('0.00'))
@@ -8,6 +8,7 @@ from django.urls import reverse
 from django.views.generic import TemplateView, ListView
 
 from dining.models import DiningEntryUser, DiningList
+from general.views import CursorPaginationMixin
 from userdetails.forms import RegisterUserForm, RegisterUserDetails, AssociationLinkForm
 from userdetails.models import User
 
@@ -48,21 +49,23 @@ class RegisterView(TemplateView):
         return self.render_to_response(context)
 
 
-class DiningJoinHistoryView(LoginRequiredMixin, ListView):
+class DiningJoinHistoryView(LoginRequiredMixin, CursorPaginationMixin, ListView):
     context = {}
     template_name = "accounts/user_history_joined.html"
     paginate_by = 20
+    cursor_ordering = ('-dining_list__date', '-pk')
 
     def get_queryset(self):
-        return DiningEntryUser.objects.filter(user=self.request.user).order_by('-dining_list__date')
+        return DiningEntryUser.objects.filter(user=self.request.user).select_related('dining_list__association')
 
 
-class DiningClaimHistoryView(LoginRequiredMixin, ListView):
+class DiningClaimHistoryView(LoginRequiredMixin, CursorPaginationMixin, ListView):
     template_name = "accounts/user_history_claimed.html"
     paginate_by = 20
+    cursor_ordering = ('-date', '-pk')
 
     def get_queryset(self):
-        return DiningList.objects.filter(owners=self.request.user).order_by('-date')
+        return DiningList.objects.filter(owners=self.request.user).select_related('association')
 
 
 class PeopleAutocompleteView(LoginRequiredMixin, Select2QuerySetView):
@@ -1,11 +1,10 @@
-import csv
 import decimal
 
 from django.contrib import messages
 from django.contrib.auth.mixins import LoginRequiredMixin
-from django.core.exceptions import PermissionDenied
-from django.db.models import Q, Count, Sum
-from django.http import HttpResponseRedirect, HttpResponse
+from django.core.exceptions import PermissionDenied, ValidationError
+from django.db.models import Q
+from django.http import HttpResponseRedirect
 from django.shortcuts import get_object_or_404, render
 from django.urls import reverse
 from django.utils.http import is_safe_url
@@ -13,9 +12,11 @@ from django.views import View
 from django.views.generic import ListView, TemplateView, FormView
 
 from creditmanagement.forms import ClearOpenExpensesForm
+from creditmanagement import balance_cache
 from creditmanagement.models import AbstractTransaction, FixedTransaction
-from dining.models import DiningList, DiningEntry
-from general.views import DateRangeFilterMixin
+from dining import statistics
+from general.util import streaming_csv_response
+from general.views import DateRangeFilterMixin, CursorPaginationMixin
 from userdetails.forms import AssociationSettingsForm
 from userdetails.models import UserMembership, Association, User
 
@@ -48,16 +49,19 @@ class AssociationHasSiteAccessMixin:
         return super(AssociationHasSiteAccessMixin, self).dispatch(request, *args, **kwargs)
 
 
-class CreditsOverview(LoginRequiredMixin, AssociationBoardMixin, ListView):
+class CreditsOverview(LoginRequiredMixin, AssociationBoardMixin, CursorPaginationMixin, ListView):
     template_name = "accounts/association_credits.html"
     paginate_by = 50
+    cursor_ordering = ('-order_moment', '-pk')
+    approximate_count = True
 
     def get_queryset(self):
-        return AbstractTransaction.get_all_transactions(association=self.association).order_by('-order_moment')
+        return AbstractTransaction.get_all_transactions(association=self.association).select_related(
+            'source_user', 'source_association', 'target_user', 'target_association')
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        context['balance'] = AbstractTransaction.get_association_balance(self.association)
+        context['balance'] = balance_cache.get_association_balance(self.association)
         return context
 
 
@@ -71,7 +75,12 @@ class AutoCreateNegativeCreditsView(LoginRequiredMixin, AssociationBoardMixin, F
         return kwargs
 
     def form_valid(self, form):
-        form.save()
+        try:
+            form.save()
+        except ValidationError as e:
+            # Show the new preview
+            messages.error(self.request, e.message)
+            return HttpResponseRedirect(self.request.path_info)
         messages.success(self.request, 'Member credits have successfully been processed')
         return super(AutoCreateNegativeCreditsView, self).form_valid(form)
 
@@ -80,36 +89,36 @@ class AutoCreateNegativeCreditsView(LoginRequiredMixin, AssociationBoardMixin, F
 
 
 class TransactionsCsvView(LoginRequiredMixin, AssociationBoardMixin, View):
-    """Returns a CSV file with all transactions."""
+    """Returns a CSV file with all transactions.
 
-    def get(self, request, *args, **kwargs):
-        response = HttpResponse(content_type='text/csv')
-        response['Content-Disposition'] = 'attachment; filename="association_transactions.csv"'
-        csv_writer = csv.writer(response)
+    The file is streamed, so that the memory usage is constant and the download starts immediately.
+    """
+    chunk_size = 2000
+
+    @staticmethod
+    def _party(user, association):
+        if user:
+            return ['User', user.get_full_name(), user.email]
+        elif association:
+            return ['Association', association.name, '']
+        return ['None', '', '']
+
+    def get_rows(self):
         # Write header
-        csv_writer.writerow(['Created on', 'Executed on', 'Source type', 'Source name', 'Source e-mail', 'Target type',
-                             'Target name', 'Target e-mail', 'Amount', 'Description'])
+        yield ['Created on', 'Executed on', 'Source type', 'Source name', 'Source e-mail', 'Target type',
+               'Target name', 'Target e-mail', 'Amount', 'Description']
         # Write transactions
-        for t in FixedTransaction.get_all_transactions(association=self.association):
+        transactions = FixedTransaction.get_all_transactions(association=self.association).select_related(
+            'source_user', 'source_association', 'target_user', 'target_association').order_by('pk')
+        for t in transactions.iterator(chunk_size=self.chunk_size):
             # Transaction moment
             moment = [t.order_moment.isoformat(), t.confirm_moment.isoformat()]
-            # Transaction source
-            if t.source_user:
-                source = ['User', t.source_user.get_full_name(), t.source_user.email]
-            elif t.source_association:
-                source = ['Association', t.source_association.name, '']
-            else:
-                source = ['None', '', '']
-            # Transaction target
-            if t.target_user:
-                target = ['User', t.target_user.get_full_name(), t.target_user.email]
-            elif t.target_association:
-                target = ['Association', t.target_association.name, '']
-            else:
-                target = ['None', '', '']
-            # Write to CSV
-            csv_writer.writerow(moment + source + target + [t.amount, t.description])
-        return response
+            source = self._party(t.source_user, t.source_association)
+            target = self._party(t.target_user, t.target_association)
+            yield moment + source + target + [t.amount, t.description]
+
+    def get(self, request, *args, **kwargs):
+        return streaming_csv_response(self.get_rows(), 'association_transactions.csv')
 
 
 class MembersOverview(LoginRequiredMixin, AssociationBoardMixin, ListView):
@@ -128,7 +137,7 @@ class AssociationOverview(LoginRequiredMixin, AssociationBoardMixin, TemplateVie
         context = super().get_context_data(**kwargs)
         context['pending_memberships'] = UserMembership.objects.filter(association=self.association,
                                                                        verified_on__isnull=True)
-        context['balance'] = AbstractTransaction.get_association_balance(self.association)
+        context['balance'] = balance_cache.get_association_balance(self.association)
         context['transactions'] = AbstractTransaction.get_all_transactions(
             association=self.association).order_by('-order_moment')[0:5]
 
@@ -208,40 +217,7 @@ class AssociationSiteDiningView(AssociationBoardMixin, AssociationHasSiteAccessM
         context = super(AssociationSiteDiningView, self).get_context_data(**kwargs)
 
         if self.date_range_form.is_valid():
-            dining_lists = DiningList.objects.filter(date__gte=self.date_start, date__lte=self.date_end)
-            association_stats = {}
-
-            # Get general data for each association
-            for association in Association.objects.all():
-                # Some general statistics
-                cooked_for = DiningEntry.objects.filter(
-                    dining_list__association=association,
-                    dining_list__in=dining_lists)
-                memberships = UserMembership.objects.filter(association=association, is_verified=True)
-                members = User.objects.filter(usermembership__in=memberships)
-
-                cooked_for_own = cooked_for.filter(user__in=members)
-
-                association_stats[association.id] = {
-                    'association': association,
-                    'lists_claimed': dining_lists.filter(association=association).count(),
-                    'cooked_for': cooked_for.count(),
-                    'cooked_for_own': cooked_for_own.count(),
-                    'weighted_eaters': 0,
-                }
-            # Get general data for all members. Note: this is done here as the length of members is significantly longer
-            # than the number of associations so this should be quicker
-            users = User.objects.filter(diningentry__dining_list__in=dining_lists).annotate(
-                dining_entry_count=Count('diningentry'))
-
-            for user in users:
-                memberships = UserMembership.objects.filter(is_verified=True, related_user=user)
-                if memberships:
-                    user_weight = user.dining_entry_count / memberships.count()
-
-                    for membership in memberships:
-                        association_stats[membership.association_id]['weighted_eaters'] += user_weight
-            context['stats'] = association_stats
+            context['stats'] = statistics.get_association_stats(self.date_start, self.date_end)
         return context
 
 
@@ -257,37 +233,12 @@ class AssociationSiteCreditView(AssociationBoardMixin, AssociationHasSiteAccessM
         for association in Association.objects.all():
             association_stats[association.id] = {
                 'association': association,
-                'balance': AbstractTransaction.get_association_balance(association),
+                'balance': balance_cache.get_association_balance(association),
             }
         context['association_balances'] = association_stats
 
         # Get the income through the dining list
         if self.date_range_form.is_valid():
-            transactions = FixedTransaction.objects. \
-                filter(confirm_moment__gte=self.date_start,
-                       confirm_moment__lte=self.date_end)
-            # Aggregate the values
-            influx = transactions.filter(
-                target_user__isnull=True,
-                target_association__isnull=True
-            ).aggregate(sum=Sum('amount'))['sum']
-
-            outflux = transactions.filter(
-                source_user__isnull=True,
-                source_association__isnull=True
-            ).aggregate(sum=Sum('amount'))['sum']
-
-            if influx is None:
-                influx = 0
-            influx = decimal.Decimal(influx)
-
-            if outflux is None:
-                outflux = 0
-            outflux = decimal.Decimal(outflux)
-
-            context['dining_balance'] = {
-                'influx': influx.quantize(decimal.Decimal('.01')),
-                'outflux': outflux.quantize(decimal.Decimal('.01')),
-                'nettoflux': (influx - outflux).quantize(decimal.Decimal('.01'))
-            }
+            flow = statistics.get_site_money_flow(self.date_start, self.date_end)
+            context['dining_balance'] = {key: value.quantize(decimal.Decimal('.01')) for key, value in flow.items()}
         return context